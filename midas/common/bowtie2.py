@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import os
 import numpy as np
-from midas.common.utils import tsprint, command, split, OutputStream
+from midas.common.utils import tsprint, command, split, OutputStream, InputStream, write_atomically
 
 
 def bowtie2_index_exists(bt2_db_dir, bt2_db_name):
@@ -42,10 +42,40 @@ def build_bowtie2_db(bt2_db_dir, bt2_db_name, downloaded_files, num_cores):
             tsprint(f"Bowtie2 index {bt2_db_prefix} run into error")
             command(f"rm -f {bt2_db_prefix}.1.bt2")
             raise
+        write_bowtie2_refs(bt2_db_prefix, downloaded_files)
 
     return bt2_db_prefix
 
 
+def write_bowtie2_refs(bt2_db_prefix, downloaded_files):
+    """ Species of each reference of the index, in index order which is also the BAM reference id order """
+    list_of_refs = []
+    for species_id, fasta_file in downloaded_files.items():
+        with InputStream(fasta_file, "grep '^>'") as stream:
+            for line in stream:
+                list_of_refs.append((line[1:].split(None, 1)[0], str(species_id)))
+            stream.ignore_errors()
+    ref_width = max((len(ref_id) for ref_id, _ in list_of_refs), default=1)
+    species_width = max((len(species_id) for _, species_id in list_of_refs), default=1)
+    refs = np.array(list_of_refs, dtype=[("ref_id", f"S{ref_width}"), ("species_id", f"S{species_width}")])
+
+    refs_fp = f"{bt2_db_prefix}.refs.npy"
+    write_atomically(refs_fp, lambda stream: np.save(stream, refs))
+    return refs_fp
+
+
+def load_bowtie2_refs(bt2_db_prefix, references_count):
+    """ Memory mapped species of each reference of the index, or None for indexes built without it """
+    refs_fp = f"{bt2_db_prefix}.refs.npy"
+    if not os.path.exists(refs_fp):
+        return None
+    refs = np.load(refs_fp, mmap_mode="r")
+    if len(refs) != references_count:
+        tsprint(f"{refs_fp} doesn't match the {references_count} references of the alignments, ignored")
+        return None
+    return refs
+
+
 def bowtie2_align(bt2_db_dir, bt2_db_name, bamfile_path, args):
     """ Use Bowtie2 to map reads to prebuilt bowtie2 database """
 
@@ -112,7 +142,7 @@ def samtools_idxstats(bamfile_path, debug, num_cores):
         tsprint(f"Skipping samtools idxstats in debug mode as temporary data exists: {bamfile_path}.idxstats")
         return
     try:
-        command(f"samtools idxstats -@ {num_cores} {bamfile_path} | awk \'$3 > 0 {{print $1}}\' > {bamfile_path}.idxstats", quiet=False)
+        command(f"samtools idxstats -@ {num_cores} {bamfile_path} | awk -v OFS='\\t' \'$3 > 0 {{print $1, $3, NR - 1}}\' > {bamfile_path}.idxstats", quiet=False)
     except:
         tsprint(f"Samtools idxstats {bamfile_path} run into error")
         command(f"rm -f {bamfile_path}.idxstats")
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from midas.common.utils import InputStream, write_atomically
+
+
+DEFAULT_KMER_SIZE = 31
+DEFAULT_SCALED = 1000
+SKETCH_BLOCK_SIZE = 4 * 1024 * 1024 # bytes of (decompressed) sequences hashed at once
+COMPACT_HASHES = 1 << 24 # pending hashes before the sketch is compacted
+
+# 2-bit codes of the nucleotides, 4 for anything else: newlines and ambiguous bases break k-mers
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    for _base in _bases:
+        BASE_CODES[_base] = _code
+
+
+def hash64(values):
+    """ MurmurHash3 64-bit finalizer, vectorized over an array of uint64 """
+    x = np.array(values, dtype=np.uint64)
+    x ^= x >> np.uint64(33)
+    x *= np.uint64(0xff51afd7ed558ccd)
+    x ^= x >> np.uint64(33)
+    x *= np.uint64(0xc4ceb9fe1a85ec53)
+    x ^= x >> np.uint64(33)
+    return x
+
+
+def max_hash_for(scaled):
+    """ FracMinHash keeps the k-mers whose hash falls in the lowest 1/scaled of the 64-bit space """
+    return np.uint64((2**64 - 1) // scaled)
+
+
+def packed_dtype(bits):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if bits <= 8 * np.dtype(dtype).itemsize:
+            return dtype
+    return np.uint64
+
+
+def shift_or(high, shift, low, bits):
+    """ (high << shift) | low, in a new array of an unsigned dtype wide enough for bits """
+    dtype = packed_dtype(bits)
+    values = high.astype(dtype)
+    values <<= dtype(shift)
+    values |= low
+    return values
+
+
+def kmer_values(codes, k):
+    """
+    Forward and reverse complement 2-bit packed k-mers starting at every position of codes.
+
+    k-mers of length 2m are concatenated from k-mers of length m, and the k-mers of length k from
+    the powers of two of its binary decomposition, so only about 2*log2(k) passes over the sequences
+    are needed instead of k.  Short k-mers are kept in the narrowest integer type.
+    """
+    n = len(codes)
+    base = codes & np.uint8(3)
+    fwd_powers = {1: base}
+    rc_powers = {1: np.uint8(3) - base}
+    m = 1
+    while 2 * m <= k:
+        size = n - 2 * m + 1
+        fwd, rc = fwd_powers[m], rc_powers[m]
+        fwd_powers[2 * m] = shift_or(fwd[:size], 2 * m, fwd[m:m+size], 4 * m)
+        rc_powers[2 * m] = shift_or(rc[m:m+size], 2 * m, rc[:size], 4 * m)
+        m *= 2
+    parts = [m for m in sorted(fwd_powers) if k & m]
+    size = n - k + 1
+
+    # Forward: shortest parts last, so they are combined in the lowest bits first
+    fwd, length = None, 0
+    for m in parts:
+        offset = k - length - m
+        part = fwd_powers[m][offset:offset+size]
+        fwd = part if fwd is None else shift_or(part, 2 * length, fwd, 2 * (length + m))
+        length += m
+
+    # Reverse complement: the part at offset o of the k-mer lands at bit 2*o, shortest parts first
+    rc, length = None, 0
+    for m in parts:
+        part = rc_powers[m][length:length+size]
+        rc = part if rc is None else shift_or(part, 2 * length, rc, 2 * (length + m))
+        length += m
+
+    return fwd.astype(np.uint64, copy=False), rc.astype(np.uint64, copy=False)
+
+
+def kmer_hashes(codes, k, max_hash):
+    """ FracMinHash hashes of the canonical k-mers of codes, the BASE_CODES of sequences separated by non ACGT bytes """
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4, dtype=np.int32)))
+    valid = invalid[k:] == invalid[:-k]
+    fwd, rc = kmer_values(codes, k)
+    np.minimum(fwd, rc, out=fwd)
+    hashes = hash64(fwd[valid])
+    return hashes[hashes <= max_hash]
+
+
+def kmer_hashes_positions(codes, k, max_hash):
+    """ Same as kmer_hashes, with the start position in codes of the k-mer of each hash """
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4, dtype=np.int32)))
+    positions = np.flatnonzero(invalid[k:] == invalid[:-k])
+    fwd, rc = kmer_values(codes, k)
+    np.minimum(fwd, rc, out=fwd)
+    hashes = hash64(fwd[positions])
+    kept = hashes <= max_hash
+    return hashes[kept], positions[kept]
+
+
+def fastq_sequences(arr, newlines):
+    """ Sequence lines of a block of complete 4-line FASTQ records, each followed by its newline """
+    line_lengths = np.diff(np.concatenate(([-1], newlines)))
+    is_sequence = np.arange(len(newlines)) % 4 == 1
+    return arr[np.repeat(is_sequence, line_lengths)]
+
+
+def fasta_sequences(arr):
+    """ Sequences of a block of complete FASTA records: headers are reduced to their '>' separator, line breaks dropped """
+    newlines = arr == 10
+    line_of_byte = np.concatenate(([0], np.cumsum(newlines[:-1], dtype=np.int64)))
+    line_starts = np.concatenate(([0], np.flatnonzero(newlines[:-1]) + 1))
+    is_header = (arr[line_starts] == 62)[line_of_byte]
+    keep = (~is_header & ~newlines) | (arr == 62)
+    return arr[keep]
+
+
+def iter_sequence_blocks(filename, max_reads=None):
+    """ Yield uint8 arrays of the sequences of a FASTA or FASTQ file, in blocks of whole records, with the number of records """
+    read_count = 0
+    carry = b""
+    with InputStream(filename, binary=True) as stream:
+        try:
+            data = stream.read(SKETCH_BLOCK_SIZE)
+            is_fastq = data.startswith(b"@")
+            while data or carry:
+                buf = carry + data
+                data = stream.read(SKETCH_BLOCK_SIZE)
+                if not data and buf and not buf.endswith(b"\n"):
+                    buf += b"\n"
+                arr = np.frombuffer(buf, dtype=np.uint8)
+                if is_fastq:
+                    newlines = np.flatnonzero(arr == 10)
+                    nrecords = len(newlines) // 4
+                    if max_reads is not None:
+                        nrecords = min(nrecords, max_reads - read_count)
+                    end = int(newlines[4 * nrecords - 1]) + 1 if nrecords > 0 else 0
+                else:
+                    # Cut before the last header, unless this is the end of the file
+                    end = len(buf) if not data else buf.rfind(b"\n>") + 1
+                    nrecords = buf.count(b"\n>", 0, end) + (1 if end and buf.startswith(b">") else 0)
+                carry = buf[end:]
+                if end:
+                    read_count += nrecords
+                    yield (fastq_sequences(arr[:end], newlines[:4 * nrecords]) if is_fastq else fasta_sequences(arr[:end])), nrecords
+                if max_reads is not None and read_count >= max_reads:
+                    stream.ignore_errors()
+                    break
+                if not data and not end:
+                    assert not carry.strip(), f"Truncated record at the end of {filename}"
+                    break
+        except GeneratorExit:
+            # The caller stopped early
+            stream.ignore_errors()
+            raise
+
+
+def fasta_records(filename):
+    """ Ids of the records of a FASTA file, and their sequences each preceded by a '>' separator """
+    with InputStream(filename, binary=True) as stream:
+        data = stream.read()
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    record_ids = [line[1:].split(None, 1)[0].decode() for line in data.split(b"\n") if line.startswith(b">")]
+    return record_ids, fasta_sequences(np.frombuffer(data, dtype=np.uint8))
+
+
+def reference_kmers(filename, kmer_size, scaled):
+    """ Sampled canonical k-mers of each record of a FASTA file: record ids, then hashes and record index of each distinct <hash, record> """
+    record_ids, seqs = fasta_records(filename)
+    hashes, positions = kmer_hashes_positions(BASE_CODES[seqs], kmer_size, max_hash_for(scaled))
+    records = np.searchsorted(np.flatnonzero(seqs == 62), positions, side="right") - 1
+    order = np.lexsort((records, hashes))
+    hashes, records = hashes[order], records[order]
+    distinct = np.ones(len(hashes), dtype=bool)
+    distinct[1:] = (hashes[1:] != hashes[:-1]) | (records[1:] != records[:-1])
+    return record_ids, hashes[distinct], records[distinct]
+
+
+def assign_reads(index, seqs, kmer_size, max_hash):
+    """
+    Best reference of each read of a block of sequences, separated by newlines (FASTQ) or '>' (FASTA),
+    by number of sampled k-mers shared with the reads.  index holds the sorted "hashes" of the references
+    and the "references" of each, out of references_count.
+
+    Returns, per read, its number of A/C/G/T bases, its best reference or -1, and the k-mers shared with it.
+    """
+    codes = BASE_CODES[seqs]
+    read_of_base = np.cumsum((seqs == 10) | (seqs == 62))
+    reads_count = int(read_of_base[-1]) + 1 if len(seqs) else 0
+    bases = np.bincount(read_of_base[codes != 4], minlength=reads_count)
+    best_refs = np.full(reads_count, -1, dtype=np.int64)
+    best_hits = np.zeros(reads_count, dtype=np.int64)
+
+    hashes, positions = kmer_hashes_positions(codes, kmer_size, max_hash)
+    lo = np.searchsorted(index["hashes"], hashes, side="left")
+    matches = np.searchsorted(index["hashes"], hashes, side="right") - lo
+    total = int(matches.sum())
+    if total == 0:
+        return bases, best_refs, best_hits
+
+    # One vote per <k-mer, reference> match, counted by <read, reference>
+    first_match = np.repeat(np.cumsum(matches) - matches, matches)
+    match_refs = index["references"][np.repeat(lo, matches) + np.arange(total) - first_match]
+    match_reads = np.repeat(read_of_base[positions], matches)
+    references_count = index["references_count"]
+    pairs, votes = np.unique(match_reads.astype(np.int64) * references_count + match_refs, return_counts=True)
+    reads, refs = pairs // references_count, pairs % references_count
+
+    # Most votes first, ties to the first reference
+    order = np.lexsort((refs, -votes, reads))
+    is_best = np.concatenate(([True], reads[order][1:] != reads[order][:-1]))
+    best = order[is_best]
+    best_refs[reads[best]] = refs[best]
+    best_hits[reads[best]] = votes[best]
+    return bases, best_refs, best_hits
+
+
+class FracMinHash:
+    """
+    Scaled MinHash sketch with abundances: the k-mers whose hash is in the lowest 1/scaled of the hash space,
+    with the number of times each was seen.
+
+        sketch = FracMinHash(31, 1000)
+        sketch.add_file("reads_1.fastq.gz")
+        hashes, counts = sketch.finalize()
+    """
+
+    def __init__(self, kmer_size=DEFAULT_KMER_SIZE, scaled=DEFAULT_SCALED):
+        assert 0 < kmer_size <= 31, f"k-mer size {kmer_size} does not fit 64 bits"
+        self.kmer_size = kmer_size
+        self.scaled = scaled
+        self.max_hash = max_hash_for(scaled)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.pending_count = 0
+        self.reads_count = 0
+        self.bases_count = 0
+
+
+    def add_sequences(self, seqs):
+        codes = BASE_CODES[seqs]
+        self.bases_count += int(np.count_nonzero(codes != 4))
+        hashes = kmer_hashes(codes, self.kmer_size, self.max_hash)
+        self.pending.append(hashes)
+        self.pending_count += len(hashes)
+        if self.pending_count >= COMPACT_HASHES:
+            self.compact()
+
+
+    def add_file(self, filename, max_reads=None):
+        for seqs, nrecords in iter_sequence_blocks(filename, max_reads):
+            self.reads_count += nrecords
+            self.add_sequences(seqs)
+
+
+    def compact(self):
+        if not self.pending:
+            return
+        all_hashes = np.concatenate([self.hashes] + self.pending)
+        weights = np.concatenate([self.counts, np.ones(self.pending_count, dtype=np.int64)])
+        self.hashes, inverse = np.unique(all_hashes, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(self.hashes)).astype(np.int64)
+        self.pending = []
+        self.pending_count = 0
+
+
+    def finalize(self):
+        """ Sorted unique hashes and their abundance """
+        self.compact()
+        return self.hashes, self.counts
+
+
+def sketch_component(kmer_size, scaled):
+    """ Sketches built with different parameters can't be compared, and live side by side """
+    return f"k{kmer_size}.s{scaled}"
+
+
+def write_sketch_index(index_path, dict_of_sketches, kmer_size, scaled):
+    """ Collate the hashes of the reference sketches into one hash sorted index, with the reference of each hash """
+    reference_ids = list(dict_of_sketches.keys())
+    list_of_hashes = [dict_of_sketches[refid] for refid in reference_ids]
+    sketch_sizes = np.array([len(hashes) for hashes in list_of_hashes], dtype=np.int64)
+    hashes = np.concatenate(list_of_hashes) if list_of_hashes else np.empty(0, dtype=np.uint64)
+    references = np.repeat(np.arange(len(reference_ids), dtype=np.uint32), sketch_sizes)
+    order = np.argsort(hashes, kind="stable")
+    write_atomically(index_path, lambda stream: np.savez(stream, hashes=hashes[order], references=references[order],
+        reference_ids=np.array(reference_ids, dtype=str), sketch_sizes=sketch_sizes, kmer_size=kmer_size, scaled=scaled))
+
+
+def load_sketch_index(index_path, kmer_size, scaled):
+    with np.load(index_path) as index:
+        assert int(index["kmer_size"]) == kmer_size and int(index["scaled"]) == scaled, \
+            f"Sketch index {index_path} was built with k={int(index['kmer_size'])} and scaled={int(index['scaled'])}"
+        return {key: index[key] for key in ("hashes", "references", "reference_ids", "sketch_sizes")}
+
+
+def contain(index, hashes, counts):
+    """
+    Compare a sketch with abundances to the index of reference sketches.
+    Returns, per reference, the number of its hashes found in the sketch, their summed abundance,
+    and the hash position and reference of every match.
+    """
+    positions = np.minimum(np.searchsorted(hashes, index["hashes"]), max(len(hashes) - 1, 0))
+    found = hashes[positions] == index["hashes"] if len(hashes) else np.zeros(len(index["hashes"]), dtype=bool)
+    matched_references = index["references"][found]
+    matched_counts = counts[positions[found]]
+    references_count = len(index["reference_ids"])
+    matches = np.bincount(matched_references, minlength=references_count)
+    abundance = np.bincount(matched_references, weights=matched_counts, minlength=references_count)
+    return matches, abundance, matched_references, matched_counts
@@ -3,6 +3,7 @@
 import os
 import sys
 import time
+import socket
 import subprocess
 import json
 import multiprocessing
@@ -10,8 +11,10 @@ from multiprocessing.pool import ThreadPool
 import random
 import traceback
 import io
+import hashlib
 from fnmatch import fnmatch
 from functools import wraps
+import numpy as np
 
 # Thread-safe and timestamped prints.
 tslock = multiprocessing.RLock()
@@ -19,6 +22,8 @@ tslock = multiprocessing.RLock()
 num_vcpu = multiprocessing.cpu_count()
 num_physical_cores = (num_vcpu + 1) // 2
 
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
 
 COMPRESSORS = {
     ".lz4": "lz4 -dc",
@@ -599,6 +604,102 @@ def copy_star(srcdst):
     return copy(src, dst)
 
 
+def write_atomically(path, write_func, mode="wb"):
+    """
+    Call write_func(stream) on a temporary file next to path, then rename it over path, so that
+    readers, and concurrent writers on other hosts, never see a partial file.
+    """
+    tmp_path = f"{path}.tmp.{socket.gethostname()}.{os.getpid()}"
+    try:
+        with open(tmp_path, mode) as stream:
+            write_func(stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_fingerprint(path, content_hash=True):
+    st = os.stat(path)
+    fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if content_hash:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as stream:
+            for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b""):
+                sha256.update(block)
+        fingerprint["sha256"] = sha256.hexdigest()
+    return fingerprint
+
+
+# Compiled sidecars are numpy arrays saved next to the files they were compiled from, e.g. in the MIDAS DB,
+# with a json manifest of their format, version, records count, and the size, mtime and sha256 of each source.
+
+
+def is_valid_sidecar(manifest_fp, sidecar_format, sidecar_version, sources):
+    """ Fast check on size and mtime of the sources, falling back to their content hash when any was touched """
+    try:
+        with open(manifest_fp) as stream:
+            manifest = json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return False, None
+    if manifest.get("format") != sidecar_format or manifest.get("version") != sidecar_version or manifest["sources"].keys() != sources.keys():
+        return False, None
+
+    current = {name: file_fingerprint(fp, False) for name, fp in sources.items()}
+    if all(manifest["sources"][name]["size"] == current[name]["size"] and manifest["sources"][name]["mtime_ns"] == current[name]["mtime_ns"] for name in sources):
+        return True, manifest
+    # Same size but touched, e.g. by a fresh download of the same database
+    if any(manifest["sources"][name]["size"] != current[name]["size"] for name in sources):
+        return False, None
+    current = {name: file_fingerprint(fp) for name, fp in sources.items()}
+    if all(manifest["sources"][name]["sha256"] == current[name]["sha256"] for name in sources):
+        # Record the new mtimes, so the next runs take the fast path again
+        manifest["sources"] = current
+        try:
+            write_atomically(manifest_fp, lambda stream: json.dump(manifest, stream, indent=4), "w")
+        except OSError:
+            pass
+        return True, manifest
+    return False, None
+
+
+def compile_sidecar(sidecar_format, sidecar_version, sources, compile_func, extra=None):
+    """ The array returned by compile_func, and its manifest """
+    # Sources are fingerprinted first: a source changed while compiling is then caught by the next run
+    fingerprints = {name: file_fingerprint(fp) for name, fp in sources.items()}
+    array = compile_func()
+    manifest = {"format": sidecar_format, "version": sidecar_version, "records_count": len(array), "sources": fingerprints}
+    manifest.update(extra or {})
+    return array, manifest
+
+
+def write_sidecar(array_fp, manifest_fp, array, manifest):
+    # Concurrent runs may compile the same sidecar: array first, then the manifest that validates it
+    write_atomically(array_fp, lambda stream: np.save(stream, array))
+    write_atomically(manifest_fp, lambda stream: json.dump(manifest, stream, indent=4), "w")
+
+
+def load_sidecar(array_fp, manifest_fp, sidecar_format, sidecar_version, sources, compile_func, extra=None):
+    """ Memory map the compiled sidecar read-only, (re)compiling it when missing or stale """
+    valid, manifest = is_valid_sidecar(manifest_fp, sidecar_format, sidecar_version, sources)
+    if valid and os.path.exists(array_fp):
+        array = np.load(array_fp, mmap_mode="r")
+        if len(array) == manifest["records_count"]:
+            return array
+
+    tsprint(f"  MIDAS2::load_sidecar::compile {array_fp}")
+    array, manifest = compile_sidecar(sidecar_format, sidecar_version, sources, compile_func, extra)
+    try:
+        write_sidecar(array_fp, manifest_fp, array, manifest)
+    except OSError as error:
+        # Read only database: keep the compiled array for this run only
+        tsprint(f"  MIDAS2::load_sidecar::WARNING cannot save {array_fp}: {error}")
+    return array
+
+
 def pythonpath():
     # Path from which this program can be called with "python3 -m midas"
     return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -685,6 +786,182 @@ def cat_files(files_of_chunks, one_file, number_of_chunks=20):
         command("cat " + " ".join(temp_files) + f" >> {one_file}", quiet=True)
 
 
+LZ4_FRAME_MAGIC = 0x184D2204
+LZ4_SKIPPABLE_MAGIC = 0x184D2A50 # 0x184D2A50 to 0x184D2A5F
+LZ4_BLOCK_MAX_SIZE = {4: 64 * 1024, 5: 256 * 1024, 6: 1024 * 1024, 7: 4 * 1024 * 1024}
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def xxh32(data, seed=0):
+    """ Pure python XXH32, only meant for short inputs such as the lz4 frame descriptor """
+    P1, P2, P3, P4, P5 = 2654435761, 2246822519, 3266489917, 668265263, 374761393
+    M = 0xFFFFFFFF
+
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & M
+
+    def read32(i):
+        return int.from_bytes(data[i:i+4], "little")
+
+    n = len(data)
+    i = 0
+    if n >= 16:
+        v = [(seed + P1 + P2) & M, (seed + P2) & M, seed & M, (seed - P1) & M]
+        while i <= n - 16:
+            for lane in range(4):
+                v[lane] = (rotl((v[lane] + read32(i) * P2) & M, 13) * P1) & M
+                i += 4
+        h = (rotl(v[0], 1) + rotl(v[1], 7) + rotl(v[2], 12) + rotl(v[3], 18)) & M
+    else:
+        h = (seed + P5) & M
+    h = (h + n) & M
+    while i + 4 <= n:
+        h = (rotl((h + read32(i) * P3) & M, 17) * P4) & M
+        i += 4
+    while i < n:
+        h = (rotl((h + data[i] * P5) & M, 11) * P1) & M
+        i += 1
+    h ^= h >> 15
+    h = (h * P2) & M
+    h ^= h >> 13
+    h = (h * P3) & M
+    h ^= h >> 16
+    return h
+
+
+def _read_exactly(src, size, path):
+    data = src.read(size)
+    assert len(data) == size, f"Truncated compressed file {path}: expected {size} more bytes, got {len(data)}"
+    return data
+
+
+def _copy_exactly(src, dst, size, path):
+    while size > 0:
+        data = _read_exactly(src, min(size, COPY_BUFFER_SIZE), path)
+        dst.write(data)
+        size -= len(data)
+
+
+def copy_lz4_frames(src, dst, path):
+    """ Copy every lz4 frame from src into dst, walking the frame format (magic number,
+    descriptor checksum, block sizes and end mark) to make sure each frame is complete.
+    Returns the number of frames copied. """
+    frames_count = 0
+    while True:
+        magic_bytes = src.read(4)
+        if not magic_bytes:
+            break
+        assert len(magic_bytes) == 4, f"Truncated lz4 frame header in {path}"
+        magic = int.from_bytes(magic_bytes, "little")
+        dst.write(magic_bytes)
+
+        if magic & 0xFFFFFFF0 == LZ4_SKIPPABLE_MAGIC:
+            size_bytes = _read_exactly(src, 4, path)
+            dst.write(size_bytes)
+            _copy_exactly(src, dst, int.from_bytes(size_bytes, "little"), path)
+            frames_count += 1
+            continue
+
+        assert magic == LZ4_FRAME_MAGIC, f"Invalid lz4 frame magic number {magic:#x} in {path}"
+
+        flg, bd = _read_exactly(src, 2, path)
+        assert flg >> 6 == 1, f"Unsupported lz4 frame version in {path}"
+        assert flg & 0x02 == 0 and bd & 0x8F == 0, f"Invalid lz4 frame descriptor in {path}"
+        block_checksum, content_size, content_checksum, dict_id = flg & 0x10, flg & 0x08, flg & 0x04, flg & 0x01
+        assert (bd >> 4) & 0x07 in LZ4_BLOCK_MAX_SIZE, f"Invalid lz4 block maximum size in {path}"
+        block_max_size = LZ4_BLOCK_MAX_SIZE[(bd >> 4) & 0x07]
+
+        descriptor = bytes([flg, bd]) + _read_exactly(src, (8 if content_size else 0) + (4 if dict_id else 0), path)
+        header_checksum = _read_exactly(src, 1, path)[0]
+        assert header_checksum == (xxh32(descriptor) >> 8) & 0xFF, f"Corrupted lz4 frame descriptor in {path}"
+        dst.write(descriptor)
+        dst.write(bytes([header_checksum]))
+
+        while True:
+            size_bytes = _read_exactly(src, 4, path)
+            dst.write(size_bytes)
+            block_size = int.from_bytes(size_bytes, "little") & 0x7FFFFFFF
+            if block_size == 0: # EndMark
+                break
+            assert block_size <= block_max_size, f"Invalid lz4 block size {block_size} in {path}"
+            _copy_exactly(src, dst, block_size + (4 if block_checksum else 0), path)
+
+        if content_checksum:
+            _copy_exactly(src, dst, 4, path)
+        frames_count += 1
+
+    assert frames_count > 0, f"No lz4 frame in {path}"
+    return frames_count
+
+
+def copy_magic_prefixed(src, dst, path, magic):
+    """ Codecs without framing we can walk cheaply: check the magic bytes and copy the whole file """
+    data = src.read(COPY_BUFFER_SIZE)
+    assert data.startswith(magic), f"Invalid compressed file {path}: missing magic bytes {magic}"
+    while data:
+        dst.write(data)
+        data = src.read(COPY_BUFFER_SIZE)
+    return 1
+
+
+class FrameConcatenator:
+    '''
+    Append compressed chunk files into one output file, without decompressing them.
+
+        with FrameConcatenator("/path/to/species.tsv.lz4", header="col1\tcol2\n") as concat:
+            for chunk_file in list_of_chunk_files:
+                concat.append(chunk_file)
+
+    The header is compressed once into its own frame.  Concatenated lz4 frames, gzip members
+    and bz2 streams are valid files for the respective decompressors, so each chunk file is
+    copied as is: lz4 frames are walked block by block and validated on the way, the other
+    codecs are checked for their magic bytes.  Plain text files are simply appended.
+    '''
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self.stream = None
+        if path.endswith(".lz4"):
+            self.copy_frames = copy_lz4_frames
+        elif path.endswith(".gz"):
+            self.copy_frames = lambda src, dst, p: copy_magic_prefixed(src, dst, p, b"\x1f\x8b")
+        elif path.endswith(".bz2"):
+            self.copy_frames = lambda src, dst, p: copy_magic_prefixed(src, dst, p, b"BZh")
+        else:
+            self.copy_frames = lambda src, dst, p: copy_magic_prefixed(src, dst, p, b"")
+
+    def __enter__(self):
+        if self.header is not None:
+            with OutputStream(self.path) as stream:
+                stream.write(self.header)
+            self.stream = open(self.path, "ab")
+        else:
+            self.stream = open(self.path, "wb")
+        return self
+
+    def __exit__(self, _etype, _evalue, _etraceback):
+        self.stream.close()
+        return False
+
+    def append(self, chunk_file):
+        with open(chunk_file, "rb") as src:
+            return self.copy_frames(src, self.stream, chunk_file)
+
+
+def wait_for_chunks_in_order(semaphore, chunks_status):
+    """ Yield chunk ids in ascending order, as soon as the chunk and all its predecessors finished.
+    Each chunk worker sets chunks_status[chunk_id] to 1 (or -1 on failure) and then releases the semaphore once. """
+    number_of_chunks = len(chunks_status)
+    next_chunk = 0
+    while next_chunk < number_of_chunks:
+        semaphore.acquire()
+        while next_chunk < number_of_chunks and chunks_status[next_chunk] != 0:
+            assert chunks_status[next_chunk] == 1, f"Chunk {next_chunk} failed"
+            yield next_chunk
+            next_chunk += 1
+
+
 def drop_lz4(filename):
     assert filename.endswith(".lz4")
     return filename[:-4]
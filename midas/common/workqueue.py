@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import pickle
+import threading
+import subprocess
+
+from midas.common.utils import tsprint, write_atomically
+
+
+DEFAULT_LEASE_TIMEOUT = 600     # seconds without heartbeat before a lease is considered abandoned
+DEFAULT_POLL_INTERVAL = 5       # seconds between two looks at the queue while waiting
+DEFAULT_MAX_ATTEMPTS = 3        # failed attempts before a task is given up
+
+
+def get_queue_layout(queue_dir):
+    """
+    Layout of the work queue shared by the planner, the workers and the finalizer:
+
+        {queue_dir}/
+            queue.json              ordered task ids and settings, written last by the planner
+            state.pkl               pickled state needed by the workers to run any task
+            tasks/{task_id}.json    task payload
+            leases/{task_id}        exclusively created by the worker running the task, mtime is its heartbeat
+            done/{task_id}          written once the task outputs are complete
+            failed/{task_id}.{n}    error of the n-th failed attempt
+            logs/                   logs of the local workers
+    """
+    def per_task(task_id=""):
+        return {
+            "queue":        os.path.join(queue_dir, "queue.json"),
+            "state":        os.path.join(queue_dir, "state.pkl"),
+            "tasks_dir":    os.path.join(queue_dir, "tasks"),
+            "leases_dir":   os.path.join(queue_dir, "leases"),
+            "done_dir":     os.path.join(queue_dir, "done"),
+            "failed_dir":   os.path.join(queue_dir, "failed"),
+            "logs_dir":     os.path.join(queue_dir, "logs"),
+            "task":         os.path.join(queue_dir, "tasks", f"{task_id}.json"),
+            "lease":        os.path.join(queue_dir, "leases", task_id),
+            "done":         os.path.join(queue_dir, "done", task_id),
+        }
+    return per_task
+
+
+def write_json(path, data):
+    write_atomically(path, lambda stream: json.dump(data, stream), "w")
+
+
+class Lease:
+    """ Claim on one task, kept alive by a heartbeat thread touching the lease file """
+
+    def __init__(self, queue, task_id, payload):
+        self.queue = queue
+        self.task_id = task_id
+        self.payload = payload
+        self.lease_fp = queue.layout(task_id)["lease"]
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+        self.lost = False
+
+    def __enter__(self):
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        if self.lost or self.queue.lease_owner(self.task_id) != self.queue.worker_id:
+            # The task went to another worker, which owns its outputs now
+            tsprint(f"  MIDAS2::WorkQueue::{self.task_id}::WARNING drop the result of {self.queue.worker_id}, the lease was lost")
+        elif etype is None:
+            self.queue.complete(self.task_id)
+        else:
+            self.queue.fail(self.task_id, f"{etype.__name__}: {evalue}")
+        return False
+
+    def heartbeat(self):
+        interval = self.queue.lease_timeout / 4
+        while not self.stop_event.wait(interval):
+            try:
+                if self.queue.lease_owner(self.task_id) != self.queue.worker_id:
+                    raise FileNotFoundError(self.lease_fp)
+                os.utime(self.lease_fp)
+            except FileNotFoundError:
+                # Stolen, possibly renamed away between the owner check and the touch
+                self.lost = True
+                tsprint(f"  MIDAS2::WorkQueue::{self.task_id}::WARNING lease lost by {self.queue.worker_id}")
+                return
+
+
+class WorkQueue:
+    """
+    File based work queue in a directory shared by every host, without any broker.
+
+    The planner writes the tasks, then any number of workers claim them with atomic lease files:
+
+        queue = WorkQueue(queue_dir)
+        queue.plan([(task_id, payload), ...], state)        # planner
+        queue.work(func)                                    # workers, func(payload) on each claimed task
+        for task_index in queue.wait_for_tasks(task_ids):   # finalizer, in the order of task_ids
+            ...
+
+    A lease is created with O_EXCL, so exactly one worker wins a task.  Leases without heartbeat
+    for lease_timeout seconds are stolen, which requeues the tasks of crashed workers.
+    """
+
+    def __init__(self, queue_dir, lease_timeout=DEFAULT_LEASE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.layout = get_queue_layout(self.queue_dir)
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}.{os.getpid()}"
+        self.task_ids = None
+
+
+    def plan(self, tasks, state):
+        """ Write the tasks and the workers state; queue.json comes last and marks the queue as ready """
+        layout = self.layout()
+        assert not os.path.exists(layout["queue"]), f"Work queue {self.queue_dir} was already planned, please use a new directory"
+        for dirname in ("tasks_dir", "leases_dir", "done_dir", "failed_dir", "logs_dir"):
+            os.makedirs(layout[dirname], exist_ok=True)
+
+        task_ids = []
+        for task_id, payload in tasks:
+            write_json(self.layout(task_id)["task"], payload)
+            task_ids.append(task_id)
+        assert len(set(task_ids)) == len(task_ids), f"Duplicated task ids in work queue {self.queue_dir}"
+
+        write_atomically(layout["state"], lambda stream: pickle.dump(state, stream))
+        write_json(layout["queue"], {"task_ids": task_ids, "lease_timeout": self.lease_timeout, "max_attempts": self.max_attempts})
+        self.task_ids = task_ids
+        tsprint(f"  MIDAS2::WorkQueue::plan {len(task_ids)} tasks into {self.queue_dir}")
+
+
+    def wait_for_plan(self):
+        queue_fp = self.layout()["queue"]
+        while not os.path.exists(queue_fp):
+            time.sleep(self.poll_interval)
+        with open(queue_fp) as stream:
+            queue = json.load(stream)
+        self.task_ids = queue["task_ids"]
+        self.lease_timeout = queue["lease_timeout"]
+        self.max_attempts = queue["max_attempts"]
+        return self.task_ids
+
+
+    def load_state(self):
+        self.wait_for_plan()
+        with open(self.layout()["state"], "rb") as stream:
+            return pickle.load(stream)
+
+
+    def is_done(self, task_id):
+        return os.path.exists(self.layout(task_id)["done"])
+
+
+    def failed_attempts(self):
+        """ Number of failed attempts of every task, from a single listing of failed_dir """
+        attempts = {}
+        for filename in os.listdir(self.layout()["failed_dir"]):
+            task_id, _, attempt = filename.rpartition(".")
+            if task_id and attempt.isdigit():
+                attempts[task_id] = attempts.get(task_id, 0) + 1
+        return attempts
+
+
+    def attempts(self, task_id):
+        return self.failed_attempts().get(task_id, 0)
+
+
+    def is_exhausted(self, task_id, failed_attempts=None):
+        if failed_attempts is None:
+            failed_attempts = self.failed_attempts()
+        return failed_attempts.get(task_id, 0) >= self.max_attempts
+
+
+    def lease_owner(self, task_id):
+        try:
+            with open(self.layout(task_id)["lease"]) as stream:
+                return json.load(stream)["worker_id"]
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def _acquire(self, task_id):
+        lease_fp = self.layout(task_id)["lease"]
+        try:
+            fd = os.open(lease_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return self._steal(task_id)
+        with os.fdopen(fd, "w") as stream:
+            json.dump({"worker_id": self.worker_id, "start": time.time()}, stream)
+        return True
+
+
+    def _steal(self, task_id):
+        """ Take over a lease whose heartbeat stopped.  Only one of the competing workers wins the rename. """
+        lease_fp = self.layout(task_id)["lease"]
+        try:
+            if time.time() - os.path.getmtime(lease_fp) < self.lease_timeout:
+                return False
+            stale_fp = f"{lease_fp}.stale.{self.worker_id}"
+            os.rename(lease_fp, stale_fp)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.path.getmtime(stale_fp) < self.lease_timeout:
+            # Lost the race: another worker already renewed the lease, hand it back unless it's been replaced
+            try:
+                os.link(stale_fp, lease_fp)
+            except FileExistsError:
+                pass
+            os.remove(stale_fp)
+            return False
+        with open(stale_fp) as stream:
+            stale_owner = stream.read().strip()
+        os.remove(stale_fp)
+        tsprint(f"  MIDAS2::WorkQueue::{task_id}::steal abandoned lease {stale_owner}")
+        return self._acquire(task_id)
+
+
+    def claim(self):
+        """ Lease the first available task, returning None when no task can be claimed right now """
+        failed_attempts = self.failed_attempts()
+        for task_id in self.task_ids:
+            if self.is_done(task_id) or self.is_exhausted(task_id, failed_attempts):
+                continue
+            if not self._acquire(task_id):
+                continue
+            # The task may have completed between the check and the lease
+            if self.is_done(task_id):
+                self.release(task_id)
+                continue
+            with open(self.layout(task_id)["task"]) as stream:
+                payload = json.load(stream)
+            return Lease(self, task_id, payload)
+        return None
+
+
+    def release(self, task_id):
+        if self.lease_owner(task_id) == self.worker_id:
+            os.remove(self.layout(task_id)["lease"])
+
+
+    def complete(self, task_id):
+        write_json(self.layout(task_id)["done"], {"worker_id": self.worker_id, "finish": time.time()})
+        self.release(task_id)
+
+
+    def fail(self, task_id, error):
+        attempt = self.attempts(task_id)
+        write_json(os.path.join(self.layout()["failed_dir"], f"{task_id}.{attempt}"), {"worker_id": self.worker_id, "error": error})
+        self.release(task_id)
+        tsprint(f"  MIDAS2::WorkQueue::{task_id}::attempt {attempt + 1} failed on {self.worker_id}: {error}")
+
+
+    def is_finished(self):
+        failed_attempts = self.failed_attempts()
+        return all(self.is_done(task_id) or self.is_exhausted(task_id, failed_attempts) for task_id in self.task_ids)
+
+
+    def work(self, func):
+        """ Claim and run tasks until every task is done or given up.  Returns the number of tasks run by this worker. """
+        self.wait_for_plan()
+        tsprint(f"  MIDAS2::WorkQueue::work::{self.worker_id} start")
+        tasks_count = 0
+        failed_count = 0
+        while True:
+            lease = self.claim()
+            if lease is None:
+                if self.is_finished():
+                    break
+                # Remaining tasks are leased by other workers: wait, in case one of them dies
+                time.sleep(self.poll_interval)
+                continue
+            tasks_count += 1
+            try:
+                with lease:
+                    func(lease.payload)
+            except Exception: # pylint: disable=broad-except
+                failed_count += 1
+        tsprint(f"  MIDAS2::WorkQueue::work::{self.worker_id} finish {tasks_count} tasks, {failed_count} failed")
+        return tasks_count
+
+
+    def wait_for_tasks(self, task_ids):
+        """ Yield the index of each task of task_ids, in order, once it is done """
+        for task_index, task_id in enumerate(task_ids):
+            while not self.is_done(task_id):
+                assert not self.is_exhausted(task_id), f"Task {task_id} failed {self.max_attempts} times, see {self.layout()['failed_dir']}"
+                time.sleep(self.poll_interval)
+            yield task_index
+
+
+    def spawn_local_workers(self, num_workers):
+        """ Start num_workers worker processes on this host, running the current command line with --queue_role work """
+        argv = strip_queue_role_args(sys.argv[1:]) + ["--queue_role", "work"]
+        list_of_workers = []
+        for worker_index in range(num_workers):
+            log_fp = os.path.join(self.layout()["logs_dir"], f"worker.{socket.gethostname()}.{worker_index}.log")
+            with open(log_fp, "w") as log_stream:
+                list_of_workers.append(subprocess.Popen([sys.executable, "-m", "midas"] + argv, stdout=log_stream, stderr=subprocess.STDOUT))
+        tsprint(f"  MIDAS2::WorkQueue::spawn {num_workers} local workers, logs under {self.layout()['logs_dir']}")
+        return list_of_workers
+
+
+def strip_queue_role_args(argv):
+    """ Drop --queue_role and --local_workers from a command line """
+    stripped = []
+    skip_next = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+            continue
+        if arg in ("--queue_role", "--local_workers"):
+            skip_next = True
+            continue
+        if arg.startswith(("--queue_role=", "--local_workers=")):
+            continue
+        stripped.append(arg)
+    return stripped
+
+
+def absolute_paths(args, path_args, optional_path_args=()):
+    """
+    Workers run from their own working directory, possibly on another host: make the paths in args absolute
+    before they are pickled into the queue state.  Optional path arguments, e.g. a species_list that may also be
+    a comma separated list of species ids, are only converted when they name an existing file.
+    """
+    for arg_name in path_args:
+        if getattr(args, arg_name, None):
+            setattr(args, arg_name, os.path.abspath(getattr(args, arg_name)))
+    for arg_name in optional_path_args:
+        if getattr(args, arg_name, None) and os.path.exists(getattr(args, arg_name)):
+            setattr(args, arg_name, os.path.abspath(getattr(args, arg_name)))
+
+
+def absolute_samples_paths(pool_of_samples):
+    """ midas_outdir of the samples_list are relative to the working directory of the planner """
+    for sample in pool_of_samples.samples:
+        sample.midas_outdir = os.path.abspath(sample.midas_outdir)
+
+
+def wait_for_local_workers(list_of_workers):
+    return_codes = [worker.wait() for worker in list_of_workers]
+    assert all(rc == 0 for rc in return_codes), f"Local workers exited with {return_codes}"
+    return return_codes
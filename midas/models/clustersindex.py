@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import numpy as np
+import pandas as pd
+
+from midas.common.utils import InputStream, load_sidecar
+
+
+CLUSTERS_INDEX_FORMAT = "midas_clusters_index"
+CLUSTERS_INDEX_VERSION = 2
+CLUSTER_LEVELS = ["99", "95", "90", "85", "80", "75"]
+
+
+def get_clusters_index_layout(info_file):
+    """
+    Precompiled clusters_99_info of one species, next to it in the MIDAS DB:
+
+        clusters_99_info.tsv.index.npy      one record per centroid_99, sorted by centroid_99
+        clusters_99_info.tsv.index.json     format version, species, and size, mtime and sha256 of the tsv it was compiled from
+    """
+    return {
+        "array":        f"{info_file}.index.npy",
+        "manifest":     f"{info_file}.index.json",
+    }
+
+
+def get_clusters_index_dtype(id_width, marker_width):
+    # Membership of the coarser clusters is the row of their centroid, itself a centroid_99, or -1
+    return np.dtype(
+        [("centroid_99", f"S{max(id_width, 1)}")] +
+        [(f"centroid_{xx}", np.int32) for xx in CLUSTER_LEVELS[1:]] +
+        [("gene_length", np.int32), ("genome_prevalence", np.float64), ("marker_id", f"S{max(marker_width, 1)}")]
+    )
+
+
+def compile_clusters_index(info_file):
+    """ Collect the cluster memberships, length, genome prevalence and marker id of each centroid_99 """
+    columns = [f"centroid_{xx}" for xx in CLUSTER_LEVELS] + ["centroid_99_gene_length", "centroid_99_genome_prevalence", "centroid_99_marker_id"]
+    dtypes = {column: str for column in columns}
+    dtypes.update({"centroid_99_gene_length": int, "centroid_99_genome_prevalence": float})
+    with InputStream(info_file) as stream:
+        frame = pd.read_csv(stream, sep="\t", usecols=columns, dtype=dtypes, na_filter=False, float_precision="round_trip")
+
+    # Same as scan_cluster_info: the first row of a centroid_99 wins
+    frame = frame.drop_duplicates(subset="centroid_99", keep="first")
+    c99_ids = frame["centroid_99"].to_numpy().astype(bytes)
+    order = np.argsort(c99_ids, kind="stable")
+    c99_ids = c99_ids[order]
+    marker_ids = frame["centroid_99_marker_id"].to_numpy().astype(bytes)[order]
+
+    index = np.zeros(len(c99_ids), dtype=get_clusters_index_dtype(c99_ids.dtype.itemsize, marker_ids.dtype.itemsize))
+    index["centroid_99"] = c99_ids
+    for xx in CLUSTER_LEVELS[1:]:
+        cxx_ids = frame[f"centroid_{xx}"].to_numpy().astype(bytes)[order]
+        rows = np.minimum(np.searchsorted(c99_ids, cxx_ids), max(len(c99_ids) - 1, 0))
+        found = c99_ids[rows] == cxx_ids if len(c99_ids) else np.zeros(0, dtype=bool)
+        index[f"centroid_{xx}"] = np.where(found, rows, -1)
+    index["gene_length"] = frame["centroid_99_gene_length"].to_numpy()[order]
+    index["genome_prevalence"] = frame["centroid_99_genome_prevalence"].to_numpy()[order]
+    index["marker_id"] = marker_ids
+    return index
+
+
+def load_clusters_index(info_file, species_id):
+    """ Memory map the clusters index of info_file read-only, (re)compiling it when missing or stale """
+    layout = get_clusters_index_layout(info_file)
+    clusters_index = load_sidecar(layout["array"], layout["manifest"], CLUSTERS_INDEX_FORMAT, CLUSTERS_INDEX_VERSION, {"info": info_file},
+                                  lambda: compile_clusters_index(info_file), {"species_id": species_id})
+    return ClustersIndex(clusters_index, species_id, info_file)
+
+
+class ClustersIndex:
+    """
+    Read-only view of the centroids_99 of one species, addressed by their integer row:
+
+        clusters_index = load_clusters_index(clusters_99_info_fp, species_id)
+        row = clusters_index.row(c99_id)
+        clusters_index.centroid_id(row, "95"), clusters_index.gene_length[row]
+
+    Pickles as its clusters_99_info path, and is mapped again on load rather than copied.
+    """
+
+    def __init__(self, array, species_id, info_file):
+        self.array = array
+        self.species_id = species_id
+        self.info_file = info_file
+        self.c99_ids = array["centroid_99"]
+        self.gene_length = array["gene_length"]
+        self.genome_prevalence = array["genome_prevalence"]
+        self.marker_id = array["marker_id"]
+
+
+    def __reduce__(self):
+        return (load_clusters_index, (self.info_file, self.species_id))
+
+
+    def __len__(self):
+        return len(self.array)
+
+
+    def rows(self, c99_ids):
+        """ Rows of a list of centroid_99 ids, -1 for the ids not in the species """
+        keys = np.array(c99_ids, dtype=bytes)
+        if not len(self.c99_ids):
+            return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.c99_ids, keys), len(self.c99_ids) - 1)
+        return np.where(self.c99_ids[rows] == keys, rows, -1)
+
+
+    def row(self, c99_id):
+        row = int(self.rows([c99_id])[0])
+        assert row >= 0, f"Centroid {c99_id} is not in the clusters of species {self.species_id}"
+        return row
+
+
+    def centroid_id(self, row, xx="99"):
+        cxx_row = row if xx == "99" else int(self.array[f"centroid_{xx}"][row])
+        assert cxx_row >= 0, f"The centroid_{xx} of {self.c99_ids[row].decode()} is not a centroid_99 of species {self.species_id}"
+        return self.c99_ids[cxx_row].decode()
+
+
+    def list_of_markers(self):
+        return [marker_id.decode() for marker_id in np.unique(self.marker_id) if marker_id]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from midas.common.utils import InputStream, select_from_tsv, compile_sidecar, write_sidecar, load_sidecar
+from midas.params.schemas import MARKER_INFO_SCHEMA
+
+
+MARKERS_INFO_FORMAT = "midas_markers_info"
+MARKERS_INFO_VERSION = 2
+
+
+def get_markers_info_layout(fasta_file):
+    """
+    Precompiled marker metadata, next to the marker genes fasta and its hs-blastn index:
+
+        phyeco.fa.info.npy      one record per marker gene of phyeco.fa, in phyeco.map order
+        phyeco.fa.info.json     format version, and size, mtime and sha256 of the phyeco.fa and phyeco.map it was compiled from
+    """
+    return {
+        "array":        f"{fasta_file}.info.npy",
+        "manifest":     f"{fasta_file}.info.json",
+    }
+
+
+def get_markers_info_dtype(gene_width, species_width, genome_width, marker_width):
+    return np.dtype([
+        ("gene_id", f"S{max(gene_width, 1)}"),
+        ("species_id", f"S{max(species_width, 1)}"),
+        ("genome_id", f"S{max(genome_width, 1)}"),
+        ("marker_id", f"S{max(marker_width, 1)}"),
+        ("gene_length", np.uint32),
+    ])
+
+
+def compile_markers_info(fasta_file, map_file):
+    """ Collect <gene_id, species_id, genome_id, marker_id, gene_length> of the marker genes present in fasta_file """
+    genes_that_are_marker = set()
+    with InputStream(fasta_file, "grep '^>'") as stream:
+        for line in stream:
+            genes_that_are_marker.add(line[1:].split(None, 1)[0])
+        stream.ignore_errors()
+
+    records = []
+    with InputStream(map_file) as stream:
+        for r in select_from_tsv(stream, schema=MARKER_INFO_SCHEMA, result_structure=dict):
+            if r["gene_id"] in genes_that_are_marker:
+                records.append((r["gene_id"], r["species_id"], r["genome_id"], r["marker_id"], r["gene_length"]))
+
+    widths = [max((len(r[i]) for r in records), default=1) for i in range(4)]
+    return np.array(records, dtype=get_markers_info_dtype(*widths))
+
+
+def get_markers_info_sources(fasta_file, map_file):
+    return {"fa": fasta_file, "map": map_file}
+
+
+def write_markers_info(fasta_file, map_file):
+    """ Compile the marker metadata of fasta_file and save it next to it.  Returns the compiled array. """
+    layout = get_markers_info_layout(fasta_file)
+    markers_info, manifest = compile_sidecar(MARKERS_INFO_FORMAT, MARKERS_INFO_VERSION, get_markers_info_sources(fasta_file, map_file),
+                                             lambda: compile_markers_info(fasta_file, map_file))
+    write_sidecar(layout["array"], layout["manifest"], markers_info, manifest)
+    return markers_info
+
+
+def load_markers_info(fasta_file, map_file):
+    """ Memory map the precompiled marker metadata of fasta_file, (re)compiling it when missing or stale """
+    layout = get_markers_info_layout(fasta_file)
+    return load_sidecar(layout["array"], layout["manifest"], MARKERS_INFO_FORMAT, MARKERS_INFO_VERSION, get_markers_info_sources(fasta_file, map_file),
+                        lambda: compile_markers_info(fasta_file, map_file))
+
+
+class MarkersInfo:
+    """
+    Read-only view of the marker metadata, addressed by the row of each marker gene:
+
+        markers_info = MarkersInfo(load_markers_info(fasta_file, map_file))
+        rows = markers_info.rows(gene_ids)
+        markers_info.species_ids(rows), markers_info.marker_ids(rows)
+        markers_info.species_markers(species_id)
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.gene_id = array["gene_id"]
+        self.species_id = array["species_id"]
+        self.marker_id = array["marker_id"]
+        self.gene_length = array["gene_length"]
+        # Rows are in phyeco.map order: genes are looked up through their sorted order
+        self.gene_order = np.argsort(self.gene_id, kind="stable")
+        self.sorted_gene_ids = self.gene_id[self.gene_order]
+        self.species_order = None
+        self.sorted_species_ids = None
+        self.markers_by_species = {}
+
+
+    def __len__(self):
+        return len(self.array)
+
+
+    def rows(self, gene_ids):
+        """ Rows of a list of gene ids, -1 for the genes that are not markers """
+        keys = np.array(gene_ids, dtype=bytes)
+        if not len(self.gene_id):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_gene_ids, keys), len(self.gene_id) - 1)
+        return np.where(self.sorted_gene_ids[positions] == keys, self.gene_order[positions], -1)
+
+
+    def species_ids(self, rows):
+        return np.char.decode(self.species_id[rows]).tolist()
+
+
+    def marker_ids(self, rows):
+        return np.char.decode(self.marker_id[rows]).tolist()
+
+
+    def species_markers(self, species_id):
+        """ Total length and genes, in phyeco.map order, of each marker of one species """
+        if species_id not in self.markers_by_species:
+            if self.species_order is None:
+                self.species_order = np.argsort(self.species_id, kind="stable")
+                self.sorted_species_ids = self.species_id[self.species_order]
+            key = species_id.encode()
+            rows = self.species_order[np.searchsorted(self.sorted_species_ids, key, "left"):np.searchsorted(self.sorted_species_ids, key, "right")]
+            markers = {}
+            for gene_id, marker_id, gene_length in zip(np.char.decode(self.gene_id[rows]).tolist(), self.marker_ids(rows), self.gene_length[rows].tolist()):
+                if marker_id in markers:
+                    markers[marker_id]["marker_length"] += gene_length
+                    markers[marker_id]["gene_id"].append(gene_id)
+                else:
+                    markers[marker_id] = {"marker_length": gene_length, "gene_id": [gene_id]}
+            self.markers_by_species[species_id] = markers
+        return self.markers_by_species[species_id]
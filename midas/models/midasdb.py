@@ -82,6 +82,9 @@ def get_midasdb_layout(species_id="", genome_id="", component=""):
         "marker_genes_hmmsearch":        f"markers/{marker_set}/temp/{species_id}/{genome_id}/{genome_id}.hmmsearch",
         "marker_genes_log":              f"markers/{marker_set}/temp/{species_id}/{genome_id}/build_marker_genes.log",
 
+        "sketch_species":                f"sketches/{component}/{species_id}.npy",
+        "sketch_index":                  f"sketches/{component}/index.npz",
+
         "chunks_sites_run":              f"chunks/sites/run/chunksize.{component}/{species_id}/{genome_id}.json",
         "chunks_sites_merge":            f"chunks/sites/merge/chunksize.{component}/{species_id}/{genome_id}.json",
         "chunks_contig_lists":           f"temp/chunksize.{component}/{species_id}/cid.{genome_id}_list_of_contigs",
@@ -122,7 +125,25 @@ class UHGG:  # pylint: disable=too-few-public-methods
         else:
             self.toc_tsv = TABLE_OF_CONTENTS(dbname) # Fetch from S3 only
 
-        self.species, self.representatives, self.genomes = _UHGG_load(self.toc_tsv)
+        self.toc = None
+
+    def load_toc(self):
+        # The TOC of every genome is read on first use only: run_genes resolves species from the bowtie2 index
+        if self.toc is None:
+            self.toc = _UHGG_load(self.toc_tsv)
+        return self.toc
+
+    @property
+    def species(self):
+        return self.load_toc()[0]
+
+    @property
+    def representatives(self):
+        return self.load_toc()[1]
+
+    @property
+    def genomes(self):
+        return self.load_toc()[2]
 
     def fetch_repgenome_id(self, species_id):
         return self.representatives[species_id]
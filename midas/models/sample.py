@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
+import json
+import pandas as pd
 from midas.params.schemas import fetch_schema_by_dbtype
-from midas.common.utils import InputStream, select_from_tsv, command, tsprint
+from midas.common.utils import InputStream, command, tsprint
 from midas.models.species import filter_species
 
 
@@ -24,14 +26,15 @@ def get_single_layout(sample_name, dbtype=""):
             "species_summary":         f"{sample_name}/species/species_profile.tsv",
             "species_log":             f"{sample_name}/species/log.txt",
             "markers_summary":         f"{sample_name}/species/markers_profile.tsv",
+            "species_convergence":     f"{sample_name}/species/convergence.tsv",
             "species_alignments_m8":   f"{sample_name}/temp/species/alignments.m8",
-            "species_marker_genes":    f"{sample_name}/temp/species/genes_that_are_marker",
             "species_reads":           f"{sample_name}/temp/species/{species_id}/{chunk_id}.ids",
 
             # snps workflow output
             "snps_summary":            f"{sample_name}/snps/snps_summary.tsv",
             "snps_log":                f"{sample_name}/snps/log.txt",
             "snps_pileup":             f"{sample_name}/snps/{species_id}.snps.tsv.lz4",
+            "snps_coverage":           f"{sample_name}/snps/{species_id}.snps_coverage.json",
             "snps_repgenomes_bam":     f"{sample_name}/snps/{sample_name}.bam",
             "species_bam":             f"{sample_name}/temp/snps/{species_id}/{species_id}.bam",
             "species_sorted_bam":      f"{sample_name}/temp/snps/{species_id}/{species_id}.sorted.bam",
@@ -51,10 +54,23 @@ class Sample: # pylint: disable=too-few-public-methods
     def __init__(self, sample_name, midas_outdir, dbtype=None):
         self.sample_name = sample_name
         self.midas_outdir = midas_outdir
+        self.dbtype = dbtype
         self.layout = get_single_layout(sample_name, dbtype)
         self.profile = None
 
 
+    def __getstate__(self):
+        # The layout closure can't be pickled (merge work queue state), rebuild it instead
+        state = self.__dict__.copy()
+        del state["layout"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.layout = get_single_layout(self.sample_name, self.dbtype)
+
+
     def get_target_layout(self, filename, species_id="", chunk_id=""):
         if isinstance(self.layout(species_id, chunk_id)[filename], list):
             local_file_lists = self.layout(species_id, chunk_id)[filename]
@@ -94,17 +110,27 @@ class Sample: # pylint: disable=too-few-public-methods
         return species_ids
 
 
-    def load_profile_by_dbtype(self, dbtype):
-        """ Load genes/snps summary in memory and used in Pool model """
+    def load_profile_by_dbtype(self, dbtype, cached=None):
+        """ Load genes/snps summary in memory and used in Pool model.  Returns the cache entry of the summary. """
         summary_path = self.get_target_layout(f"{dbtype}_summary")
         assert os.path.exists(summary_path), f"load_profile_by_dbtype:: missing {summary_path} for {self.sample_name}"
 
-        schema = fetch_schema_by_dbtype(dbtype)
-        profile = {}
-        with InputStream(summary_path) as stream:
-            for info in select_from_tsv(stream, selected_columns=schema, result_structure=dict):
-                profile[info["species_id"]] = info
-        self.profile = profile
+        # Reuse the columns parsed by a previous merge while the summary is unchanged
+        st = os.stat(summary_path)
+        if cached is None or cached["size"] != st.st_size or cached["mtime_ns"] != st.st_mtime_ns:
+            columns = read_profile_columns(summary_path, fetch_schema_by_dbtype(dbtype))
+            cached = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "columns": columns}
+        self.profile = profile_from_columns(cached["columns"])
+        return cached
+
+
+    def load_snps_coverage(self, species_id):
+        """ Covered intervals of the species pileup written by run_snps, or None for older outputs """
+        coverage_path = self.get_target_layout("snps_coverage", species_id)
+        if not os.path.exists(coverage_path):
+            return None
+        with open(coverage_path) as stream:
+            return json.load(stream)["contigs"]
 
 
     def remove_dirs(self, list_of_dirnames):
@@ -113,6 +139,20 @@ class Sample: # pylint: disable=too-few-public-methods
             command(f"rm -rf {dirpath}", check=False)
 
 
+def read_profile_columns(summary_path, schema):
+    """ Typed columns of a species/snps/genes summary, in schema order """
+    with InputStream(summary_path) as stream:
+        frame = pd.read_csv(stream, sep="\t", usecols=list(schema), dtype=schema, na_filter=False)
+    return {column: frame[column].to_numpy() for column in schema}
+
+
+def profile_from_columns(columns):
+    """ Per species records of a summary, with the python types of select_from_tsv """
+    names = list(columns)
+    rows = zip(*(columns[name].tolist() for name in names))
+    return {info["species_id"]: info for info in (dict(zip(names, row)) for row in rows)}
+
+
 def create_local_dir(dirname, debug, quiet=False):
     if debug and os.path.exists(dirname):
         tsprint(f"Use existing {dirname} according to --debug flag.")
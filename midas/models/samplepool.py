@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import os
+import pickle
 from midas.params.schemas import fetch_schema_by_dbtype, samples_pool_schema, format_data
-from midas.common.utils import InputStream, OutputStream, select_from_tsv, command, tsprint
+from midas.common.utils import InputStream, OutputStream, select_from_tsv, command, tsprint, multithreading_map, write_atomically
 from midas.models.species import Species, parse_species
 from midas.models.sample import Sample, create_local_dir
 
 
+PROFILES_LOADING_THREADS = 16 # summaries read at once, mostly waiting on (network) storage
+PROFILES_CACHE_VERSION = 1
+
+
 def get_pool_layout(dbtype=""):
     def per_species(species_id="", chunk_id=""):
         return {
@@ -18,6 +23,9 @@ def get_pool_layout(dbtype=""):
             "midasdb_dir":                       f"midasdb",
             "bt2_indexes_dir":                   f"bt2_indexes",
 
+            # Parsed samples summaries, reused by the next merges into the same directory
+            "profiles_cache":                    f"cache/{dbtype}_profiles.pkl",
+
             # Species
             "species_prevalence":                f"species/species_prevalence.tsv",
             "species_marker_read_counts":        f"species/species_marker_read_counts.tsv",
@@ -32,9 +40,11 @@ def get_pool_layout(dbtype=""):
             "snps_info":                        f"snps/{species_id}/{species_id}.snps_info.tsv.lz4",
             "snps_freq":                        f"snps/{species_id}/{species_id}.snps_freqs.tsv.lz4",
             "snps_depth":                       f"snps/{species_id}/{species_id}.snps_depth.tsv.lz4",
+            "snps_matrix":                      f"snps/{species_id}/{species_id}.snps_matrix",
             "snps_log":                         f"snps/snps_log.txt",
 
             "snps_list_of_contigs":             f"temp/{dbtype}/{species_id}/cid.{chunk_id}_list_of_contigs",
+            "snps_regions_by_chunk":            f"temp/{dbtype}/{species_id}/cid.{chunk_id}_regions.tsv",
             "snps_info_by_chunk":               f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_info.tsv.lz4",
             "snps_freq_by_chunk":               f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_freqs.tsv.lz4",
             "snps_depth_by_chunk":              f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_depth.tsv.lz4",
@@ -60,10 +70,23 @@ class SamplePool: # pylint: disable=too-few-public-methods
     def __init__(self, samples_list, midas_outdir, dbtype=None):
         self.toc = samples_list
         self.midas_outdir = midas_outdir
+        self.dbtype = dbtype
         self.layout = get_pool_layout(dbtype)
         self.samples = self.init_samples(dbtype)
 
 
+    def __getstate__(self):
+        # The layout closure can't be pickled (merge work queue state), rebuild it instead
+        state = self.__dict__.copy()
+        del state["layout"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.layout = get_pool_layout(self.dbtype)
+
+
     def get_target_layout(self, filename, species_id="", chunk_id=""):
         return os.path.join(self.midas_outdir, self.layout(species_id, chunk_id)[filename])
 
@@ -87,12 +110,22 @@ class SamplePool: # pylint: disable=too-few-public-methods
 
     def init_samples(self, dbtype):
         """ read in table-of-content: sample_name, midas_outdir """
-        samples = []
         with InputStream(self.toc) as stream:
-            for row in select_from_tsv(stream, selected_columns=samples_pool_schema, result_structure=dict):
-                sample = Sample(row["sample_name"], row["midas_outdir"], dbtype)
-                sample.load_profile_by_dbtype(dbtype) # load profile_summary into memory for easy access
-                samples.append(sample)
+            samples = [Sample(row["sample_name"], row["midas_outdir"], dbtype) for row in select_from_tsv(stream, selected_columns=samples_pool_schema, result_structure=dict)]
+
+        # load profile_summary into memory for easy access
+        cache_fp = self.get_target_layout("profiles_cache")
+        cache = load_profiles_cache(cache_fp)
+        def load_profile(sample):
+            summary_path = os.path.abspath(sample.get_target_layout(f"{dbtype}_summary"))
+            return summary_path, sample.load_profile_by_dbtype(dbtype, cache.get(summary_path))
+        entries = multithreading_map(load_profile, samples, min(PROFILES_LOADING_THREADS, max(1, len(samples))))
+
+        reused_count = sum(1 for summary_path, entry in entries if cache.get(summary_path) is entry)
+        new_cache = dict(entries)
+        if reused_count < len(new_cache) or len(cache) != len(new_cache):
+            save_profiles_cache(cache_fp, new_cache)
+        tsprint(f"  MIDAS2::init_samples::{dbtype} {len(samples)} samples, {reused_count} summaries from {cache_fp}")
         return samples
 
 
@@ -158,6 +191,27 @@ class SamplePool: # pylint: disable=too-few-public-methods
             command(f"rm -rf {dirpath}", check=False)
 
 
+def load_profiles_cache(cache_fp):
+    """ Cached summaries columns by summary path, empty when missing or unreadable """
+    try:
+        with open(cache_fp, "rb") as stream:
+            cache = pickle.load(stream)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != PROFILES_CACHE_VERSION:
+        return {}
+    return cache["profiles"]
+
+
+def save_profiles_cache(cache_fp, profiles):
+    try:
+        os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+        write_atomically(cache_fp, lambda stream: pickle.dump({"version": PROFILES_CACHE_VERSION, "profiles": profiles}, stream))
+    except OSError as error:
+        # The merge itself doesn't need the cache
+        tsprint(f"  MIDAS2::save_profiles_cache::WARNING cannot save {cache_fp}: {error}")
+
+
 def sort_species(list_of_species, rev=True):
     """ Sort list_of_species by samples_count in descending order """
     species_sorted = sorted(((sp, sp.samples_count) for sp in list_of_species), key=lambda x: x[1], reverse=rev)
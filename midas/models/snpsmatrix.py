@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import json
+import numpy as np
+
+from midas.common.utils import command
+
+
+SNPS_MATRIX_FORMAT = "midas_snps_matrix"
+SNPS_MATRIX_VERSION = 2
+
+
+def get_sites_dtype(contig_width):
+    """ Shared site index: one record per called site, row aligned with the freqs and depth matrices """
+    return np.dtype([
+        ("contig", f"S{max(contig_width, 1)}"),
+        ("position", np.uint32),
+        ("ref_allele", "S1"),
+        ("major_allele", "S1"),
+        ("minor_allele", "S1"),
+    ])
+
+
+def get_snps_matrix_layout(matrix_dir):
+    """
+    Layout of the binary population SNV matrices for one species:
+
+        {species_id}.snps_matrix/
+            manifest.json                   samples and the ordered list of row groups
+            {row_group}.npz                 compressed arrays of the row group:
+                sites                       site index (contig, position, ref/major/minor alleles)
+                freqs                       float64 (sites x samples) minor allele frequency, as computed by merge_snps
+                depth                       uint32 (sites x samples) major + minor allele read counts
+
+    Row groups are named {prefix}.{group_index}, where prefix identifies the chunk of sites
+    that produced them.
+    """
+    def per_row_group(row_group=""):
+        return {
+            "manifest":         os.path.join(matrix_dir, "manifest.json"),
+            "chunk_manifest":   os.path.join(matrix_dir, f"{row_group}.json"),
+            "row_group":        os.path.join(matrix_dir, f"{row_group}.npz"),
+        }
+    return per_row_group
+
+
+class SnpsMatrixWriter:
+    """ Append row groups of called sites for one chunk of sites into the species snps_matrix directory """
+
+    def __init__(self, matrix_dir, prefix):
+        self.layout = get_snps_matrix_layout(matrix_dir)
+        self.prefix = prefix
+        self.row_groups = []
+
+
+    def write_row_group(self, site_ids, major_alleles, minor_alleles, sample_mafs, sample_depths):
+        rows = len(site_ids)
+        if rows == 0:
+            return
+        row_group = f"{self.prefix}.{len(self.row_groups)}"
+        layout = self.layout(row_group)
+
+        contigs, positions, ref_alleles = zip(*(site_id.rsplit("|", 2) for site_id in site_ids))
+        sites = np.empty(rows, dtype=get_sites_dtype(max(len(c) for c in contigs)))
+        sites["contig"] = contigs
+        sites["position"] = np.array(positions, dtype=np.uint32)
+        sites["ref_allele"] = ref_alleles
+        sites["major_allele"] = major_alleles
+        sites["minor_allele"] = minor_alleles
+
+        # Frequencies stay float64, so that export_snps writes the same values as the TSV output
+        np.savez_compressed(layout["row_group"], sites=sites, freqs=np.array(sample_mafs, dtype=np.float64), depth=np.array(sample_depths, dtype=np.uint32))
+        self.row_groups.append({"name": row_group, "rows": rows})
+
+
+    def close(self):
+        """ Record the row groups of this chunk, to be picked up by finalize_snps_matrix """
+        with open(self.layout(self.prefix)["chunk_manifest"], "w") as stream:
+            json.dump(self.row_groups, stream)
+
+
+def finalize_snps_matrix(matrix_dir, species_id, samples_names, prefixes, debug=False):
+    """ Concatenate the per-chunk row group lists, in chunk order, into the species manifest """
+    layout = get_snps_matrix_layout(matrix_dir)
+    row_groups = []
+    for prefix in prefixes:
+        chunk_manifest = layout(prefix)["chunk_manifest"]
+        with open(chunk_manifest) as stream:
+            row_groups.extend(json.load(stream))
+        if not debug:
+            command(f"rm -f {chunk_manifest}", quiet=True)
+
+    manifest = {
+        "format": SNPS_MATRIX_FORMAT,
+        "version": SNPS_MATRIX_VERSION,
+        "species_id": species_id,
+        "samples": list(samples_names),
+        "sites_count": sum(rg["rows"] for rg in row_groups),
+        "row_groups": row_groups,
+    }
+    with open(layout()["manifest"], "w") as stream:
+        json.dump(manifest, stream, indent=4)
+    return manifest
+
+
+class SnpsMatrix:
+    """
+    Read only access to the binary population SNV matrices of one species.
+
+        matrix = SnpsMatrix("snps/100001/100001.snps_matrix")
+        for sites, freqs, depth in matrix.iter_row_groups():
+            ...
+
+    Row groups are compressed, and decompressed into memory one at a time.
+    """
+
+    def __init__(self, matrix_dir):
+        self.matrix_dir = matrix_dir
+        self.layout = get_snps_matrix_layout(matrix_dir)
+        with open(self.layout()["manifest"]) as stream:
+            manifest = json.load(stream)
+        assert manifest["format"] == SNPS_MATRIX_FORMAT, f"{matrix_dir} is not a MIDAS snps_matrix directory"
+        assert manifest["version"] == SNPS_MATRIX_VERSION, f"Unsupported snps_matrix version {manifest['version']} in {matrix_dir}, rerun merge_snps"
+        self.species_id = manifest["species_id"]
+        self.samples = manifest["samples"]
+        self.sites_count = manifest["sites_count"]
+        self.row_groups = manifest["row_groups"]
+
+
+    def read_row_group(self, row_group):
+        with np.load(self.layout(row_group)["row_group"]) as arrays:
+            sites, freqs, depth = arrays["sites"], arrays["freqs"], arrays["depth"]
+        assert freqs.shape == depth.shape == (len(sites), len(self.samples)), f"Corrupted row group {row_group} in {self.matrix_dir}"
+        return sites, freqs, depth
+
+
+    def iter_row_groups(self):
+        for rg in self.row_groups:
+            yield self.read_row_group(rg["name"])
+
+
+    def load(self):
+        """ Load the whole species into memory as (sites, freqs, depth) """
+        if not self.row_groups:
+            return np.empty(0, dtype=get_sites_dtype(1)), \
+                np.empty((0, len(self.samples)), dtype=np.float64), \
+                np.empty((0, len(self.samples)), dtype=np.uint32)
+        list_of_sites, list_of_freqs, list_of_depth = zip(*self.iter_row_groups())
+        contig_width = max(s.dtype["contig"].itemsize for s in list_of_sites)
+        sites = np.concatenate([s.astype(get_sites_dtype(contig_width)) for s in list_of_sites])
+        return sites, np.concatenate(list_of_freqs), np.concatenate(list_of_depth)
+
+
+def format_site_ids(sites):
+    """ Rebuild the TSV site_id (contig|position|ref_allele) from the site index """
+    return [f"{c.decode()}|{p}|{r.decode()}" for c, p, r in zip(sites["contig"], sites["position"], sites["ref_allele"])]
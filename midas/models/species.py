@@ -2,12 +2,15 @@
 import os
 import json
 from math import floor
+from bisect import bisect_left
 from collections import defaultdict
 from operator import itemgetter
+import numpy as np
 
 from midas.common.utils import InputStream, OutputStream, command, select_from_tsv
-from midas.common.utilities import scan_fasta, scan_cluster_info
+from midas.common.utilities import scan_fasta, scan_cluster_info, scan_gene_feature
 from midas.params.schemas import fetch_cluster_xx_info_schema
+from midas.models.clustersindex import load_clusters_index
 
 
 class Species:
@@ -21,11 +24,14 @@ class Species:
         self.chunks_of_sites_fp = None
         self.num_of_snps_chunks = None
         self.max_contig_length = None
+        self.genome_length = None
+        self.chunk_size = None
 
         # Genes
         self.clusters_info_fp = {} # Initialize an empty dictionary for cluster_xx_info
         self.pangenome_size = {}
         self.clusters_info = {} # Initialize an empty dictionary for cluster_xx_info
+        self.clusters_index = None # memory mapped clusters_99_info
         self.list_of_markers = {}
         self.clusters_map = {}
 
@@ -33,6 +39,11 @@ class Species:
         self.list_of_samples = [] # relevant samples for given species
         self.samples_count = 0
         self.list_of_samples_depth = [] # mean genome coverage
+        self.list_of_samples_coverage = [] # covered intervals per contig from run_snps
+        self.covered_fraction = 1.0
+        self.chunks_samples = None # <chunk, sample> pairs with covered sites
+        self.regions = None # merged regions of interest {contig_id: [(start, end)]}, 0-based half-open
+        self.chunks_regions = {}
 
         # Merge SNPs
         self.gene_feature_fp = None
@@ -65,6 +76,14 @@ class Species:
         self.list_of_markers[xx] = list_of_markers
 
 
+    def get_clusters_index(self):
+        # Memory mapped instead of parsed, so the worker processes share one copy
+        clusters_index = load_clusters_index(self.get_clusters_info_fp("99"), self.id)
+        self.clusters_index = clusters_index
+        self.pangenome_size["99"] = len(clusters_index)
+        self.list_of_markers["99"] = clusters_index.list_of_markers()
+
+
     def get_cluster_map(self, xx_in, xx_out):
         c99_info = self.clusters_info['99']
         cid_map = {}
@@ -127,6 +146,57 @@ class Species:
         return chunks_of_sites
 
 
+    def compute_regions(self, midas_db, bed_regions, gene_ids):
+        """ Resolve the regions of interest on the representative genome, either BED intervals
+        of its contigs or gene ids of its gene features, into merged 0-based half-open intervals """
+        species_id = self.id
+        regions = defaultdict(list)
+        if bed_regions:
+            genome_id = midas_db.uhgg.fetch_repgenome_id(species_id)
+            self.contigs_fp = midas_db.get_target_layout("representative_genome", False, species_id, genome_id)
+            for contig_id in self.fetch_contigs_ids():
+                if contig_id in bed_regions:
+                    regions[contig_id].extend(bed_regions[contig_id])
+        resolved_genes = set()
+        if gene_ids:
+            features = scan_gene_feature(midas_db.fetch_file("annotation_genes", species_id))
+            for contig_id, genes in features.items():
+                for gene_id, feature in genes.items():
+                    if gene_id in gene_ids:
+                        # gene features are 1-based, closed
+                        regions[contig_id].append((feature["start"] - 1, feature["end"]))
+                        resolved_genes.add(gene_id)
+        self.regions = {contig_id: merge_intervals(intervals) for contig_id, intervals in regions.items()}
+        return resolved_genes
+
+
+    def compute_regions_chunks(self, midas_db, chunk_size):
+        """ Chunks of at most chunk_size sites, made of the regions of interest """
+        species_id = self.id
+        assert self.regions, f"No regions of interest for species {species_id}"
+
+        chunks_of_sites = design_regions_chunks(species_id, self.regions, chunk_size)
+        _, _, number_of_chunks, max_contig_length = chunks_of_sites[-1]
+
+        self.chunks_of_sites_fp = None # kept in memory
+        self.num_of_snps_chunks = number_of_chunks
+        self.max_contig_length = max_contig_length
+
+        self.gene_feature_fp = midas_db.fetch_file("annotation_genes", species_id)
+        self.gene_seq_fp = midas_db.fetch_file("annotation_ffn", species_id)
+        return chunks_of_sites
+
+
+    def get_genome_length(self, midas_db):
+        """ Total number of bases of the representative genome """
+        species_id = self.id
+        genome_id = midas_db.uhgg.fetch_repgenome_id(species_id)
+        contigs_fp = midas_db.get_target_layout("representative_genome", False, species_id, genome_id)
+        with InputStream(contigs_fp, "grep -v '>' | tr -d '\\n' | wc -c") as stream:
+            self.genome_length = int(stream.readline().strip())
+        return self.genome_length
+
+
     def get_repgenome(self, midas_db):
         species_id = self.id
         genome_id = midas_db.get_repgenome_id(species_id)
@@ -150,6 +220,63 @@ class Species:
         self.list_of_samples_depth = [sample.profile[self.id]["mean_depth"] for sample in self.list_of_samples]
 
 
+    def fetch_samples_coverage(self):
+        """ Covered intervals per sample, as {contig_id: (starts, ends)}, or None when run_snps didn't write them """
+        list_of_samples_coverage = []
+        for sample in self.list_of_samples:
+            coverage = sample.load_snps_coverage(self.id)
+            if coverage is not None:
+                coverage = {cid: ([iv[0] for iv in intervals], [iv[1] for iv in intervals]) for cid, intervals in coverage.items()}
+            list_of_samples_coverage.append(coverage)
+        self.list_of_samples_coverage = list_of_samples_coverage
+        return list_of_samples_coverage
+
+
+    def compute_covered_fraction(self):
+        """ Mean fraction of the genome with reported sites per sample, 1.0 for samples without coverage """
+        assert self.genome_length, f"Need the genome_length of {self.id} to compute the covered fraction"
+        fractions = []
+        for coverage in self.list_of_samples_coverage:
+            if coverage is None:
+                fractions.append(1.0)
+            else:
+                covered_bases = sum(e - s for starts, ends in coverage.values() for s, e in zip(starts, ends))
+                fractions.append(min(1.0, covered_bases / self.genome_length))
+        self.covered_fraction = sum(fractions) / len(fractions) if fractions else 1.0
+        return self.covered_fraction
+
+
+    def compute_chunks_samples(self, chunks_of_sites):
+        """ Boolean matrix of <chunk, sample> pairs where the sample has covered sites in the chunk """
+        chunks_samples = np.ones((self.num_of_snps_chunks, self.samples_count), dtype=bool)
+        for sample_index, coverage in enumerate(self.list_of_samples_coverage):
+            if coverage is None:
+                continue
+            for chunk_id in range(self.num_of_snps_chunks):
+                chunks_samples[chunk_id, sample_index] = chunk_has_coverage(chunks_of_sites[chunk_id][0], coverage)
+        self.chunks_samples = chunks_samples
+        return chunks_samples
+
+
+def chunk_has_coverage(chunk, coverage):
+    """ Whether any covered interval overlaps the merge chunk: [contig_start, contig_end) of one contig, a list of contigs (-1) or a list of regions (-2) """
+    contig_id = chunk[2]
+    if contig_id == -1:
+        return any(cid in coverage for cid in chunk[3])
+    if contig_id == -2:
+        return any(interval_has_coverage(cid, start, end, coverage) for cid, start, end in chunk[3])
+    return interval_has_coverage(contig_id, chunk[3], chunk[4], coverage)
+
+
+def interval_has_coverage(contig_id, contig_start, contig_end, coverage):
+    if contig_id not in coverage:
+        return False
+    starts, ends = coverage[contig_id]
+    # Last interval starting before contig_end, intervals are sorted and disjoint
+    idx = bisect_left(starts, contig_end)
+    return idx > 0 and ends[idx-1] > contig_start
+
+
 def parse_species(args):
     species_list = []
     if args.species_list:
@@ -186,6 +313,67 @@ def filter_species(profile_fp, select_by, select_threshold, species_list=None):
     return species_ids
 
 
+def parse_regions(regions_fp):
+    """ Read the regions of interest: BED lines (contig_id, start, end, 0-based half-open) and/or one gene_id per line """
+    bed_regions = defaultdict(list)
+    gene_ids = set()
+    with InputStream(regions_fp) as stream:
+        for line in stream:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0] or fields[0].startswith(("#", "track", "browser")):
+                continue
+            if len(fields) >= 3:
+                contig_id, start, end = fields[0], int(fields[1]), int(fields[2])
+                assert 0 <= start < end, f"Invalid BED interval {line.strip()} in {regions_fp}"
+                bed_regions[contig_id].append((start, end))
+            else:
+                gene_ids.add(fields[0].strip())
+    return bed_regions, gene_ids
+
+
+def merge_intervals(intervals):
+    """ Sort and merge overlapping or adjacent half-open intervals """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def design_regions_chunks(species_id, regions, chunk_size):
+    """ Pack the regions of interest, in contig order, into chunks of at most chunk_size sites.
+    Each chunk is (species_id, chunk_id, -2, list of [contig_id, start, end]) """
+    chunks_of_sites = defaultdict(list)
+    chunk_id = 0
+    list_of_regions = []
+    chunk_length = 0
+    max_contig_length = 0
+
+    for contig_id, intervals in regions.items():
+        for start, end in intervals:
+            max_contig_length = max(max_contig_length, end)
+            while start < end:
+                stop = min(end, start + chunk_size - chunk_length)
+                list_of_regions.append((contig_id, start, stop))
+                chunk_length += stop - start
+                start = stop
+                if chunk_length >= chunk_size:
+                    chunks_of_sites[chunk_id] = [(species_id, chunk_id, -2, list_of_regions)]
+                    chunk_id += 1
+                    list_of_regions = []
+                    chunk_length = 0
+
+    if list_of_regions:
+        chunks_of_sites[chunk_id] = [(species_id, chunk_id, -2, list_of_regions)]
+        chunk_id += 1
+
+    number_of_chunks = chunk_id
+    chunks_of_sites[-1] = (species_id, -1, number_of_chunks, max_contig_length)
+    return chunks_of_sites
+
+
 def load_chunks_cache(chunk_cache_fp):
     assert os.path.exists(chunk_cache_fp), f"{chunk_cache_fp} doesn't exit"
     with InputStream(chunk_cache_fp) as stream:
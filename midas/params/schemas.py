@@ -128,6 +128,14 @@ species_profile_schema = {
 }
 
 
+species_convergence_schema = {
+    "batch": int,
+    "reads_consumed": int,
+    "species_count": int,
+    "l1_distance": float,
+}
+
+
 species_prevalence_schema = {
     "species_id": str,
     "median_abundance": float,
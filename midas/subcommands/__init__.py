@@ -2,9 +2,9 @@
 __all__ = ["aws_batch_init", "aws_batch_submit", "init", "database", \
             "import_genome", "annotate_genome", "infer_markers", \
             "build_pangenome", "build_midasdb", \
-            "build_bowtie2db", "compute_chunks", \
+            "build_bowtie2db", "build_sketches", "compute_chunks", \
             "run_species", "run_genes", "run_snps", \
-            "merge_species", "merge_snps", "merge_genes", \
+            "merge_species", "merge_snps", "merge_genes", "export_snps", \
             "recluster_centroids", "annotate_pangenome", \
             "augment_pangenome", "enhance_pangenome", \
             "example_subcommand"]
@@ -6,6 +6,7 @@ from midas.common.argparser import add_subcommand
 from midas.common.utils import tsprint, retry, command, multithreading_map, find_files, upload, num_physical_cores, pythonpath, split, upload_star
 from midas.common.utilities import decode_genomes_arg, parse_gff_to_tsv
 from midas.models.midasdb import MIDAS_DB
+from midas.models.markersinfo import write_markers_info
 from midas.params.inputs import MARKER_FILE_EXTS, MIDASDB_NAMES
 
 
@@ -147,6 +148,9 @@ def build_markerdb(args):
         slog.write(cmd_index + "\n")
     command(cmd_index)
 
+    # Precompile the marker metadata loaded by run_species
+    write_markers_info(phyeco_seqs, phyeco_maps)
+
     # Upload generated fasta and index files
     if args.upload:
         upload_tasks = list(zip(midas_db.get_target_layout("marker_db", False), midas_db.get_target_layout("marker_db", True)))
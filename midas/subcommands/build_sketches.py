@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import json
+import os
+import numpy as np
+
+from midas.common.argparser import add_subcommand
+from midas.common.kmers import FracMinHash, DEFAULT_KMER_SIZE, DEFAULT_SCALED, sketch_component, write_sketch_index
+from midas.common.utils import tsprint, num_physical_cores, multiprocessing_map, write_atomically
+from midas.models.midasdb import MIDAS_DB
+from midas.models.species import parse_species
+from midas.params.inputs import MIDASDB_NAMES
+
+
+def register_args(main_func):
+    subparser = add_subcommand('build_sketches', main_func, help='Build the FracMinHash sketches of the rep-genomes for run_species --screen sketch')
+
+    subparser.add_argument('--midasdb_name',
+                           dest='midasdb_name',
+                           type=str,
+                           default="uhgg",
+                           choices=MIDASDB_NAMES,
+                           help="MIDAS Database name.")
+    subparser.add_argument('--midasdb_dir',
+                           dest='midasdb_dir',
+                           type=str,
+                           default=".",
+                           help="Path to local MIDAS Database.")
+    subparser.add_argument('--species_list',
+                           dest='species_list',
+                           type=str,
+                           metavar="CHAR",
+                           help="Comma separated list of species ids OR path to species list txt file.  (All species)")
+
+    subparser.add_argument('--sketch_kmer_size',
+                           dest='sketch_kmer_size',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_KMER_SIZE,
+                           help=f"k-mer size of the sketches ({DEFAULT_KMER_SIZE})")
+    subparser.add_argument('--sketch_scaled',
+                           dest='sketch_scaled',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_SCALED,
+                           help=f"Keep one k-mer out of SKETCH_SCALED in the sketches ({DEFAULT_SCALED})")
+    subparser.add_argument('--num_cores',
+                           dest='num_cores',
+                           type=int,
+                           metavar="INT",
+                           default=num_physical_cores,
+                           help=f"Number of physical cores to use ({num_physical_cores})")
+    return main_func
+
+
+def sketch_species(packed_args):
+    species_id, genome_fp, sketch_fp, kmer_size, scaled = packed_args
+    tsprint(f"  MIDAS2::sketch_species::{species_id}::start")
+    sketch = FracMinHash(kmer_size, scaled)
+    sketch.add_file(genome_fp)
+    hashes, _ = sketch.finalize()
+    write_atomically(sketch_fp, lambda stream: np.save(stream, hashes))
+    tsprint(f"  MIDAS2::sketch_species::{species_id}::finish {len(hashes)} hashes from {sketch.bases_count} bases")
+    return "worked"
+
+
+def build_sketches(args):
+    midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name, args.num_cores)
+    component = sketch_component(args.sketch_kmer_size, args.sketch_scaled)
+
+    all_species = sorted(midas_db.uhgg.species.keys())
+    species_ids = parse_species(args) or all_species
+    missing = set(species_ids) - set(all_species)
+    assert not missing, f"Species {sorted(missing)} are not in the MIDAS DB"
+
+    sketches_dir = os.path.dirname(midas_db.get_target_layout("sketch_index", False, component=component))
+    os.makedirs(sketches_dir, exist_ok=True)
+
+    tsprint(f"MIDAS2::build_sketches::start {len(species_ids)} species with k={args.sketch_kmer_size} and scaled={args.sketch_scaled}")
+    midas_db.fetch_files("repgenome", species_ids)
+    genomes_files = midas_db.fetch_files("representative_genome", species_ids)
+    args_list = [(spid, genomes_files[spid], midas_db.get_target_layout("sketch_species", False, spid, component=component), args.sketch_kmer_size, args.sketch_scaled) for spid in species_ids]
+    proc_flags = multiprocessing_map(sketch_species, args_list, args.num_cores)
+    assert all(s == "worked" for s in proc_flags), f"Error: some species failed"
+    tsprint("MIDAS2::build_sketches::finish")
+
+    # Collate every sketch built so far, so species built by separate runs end up in the same index
+    dict_of_sketches = {}
+    for spid in all_species:
+        sketch_fp = midas_db.get_target_layout("sketch_species", False, spid, component=component)
+        if os.path.exists(sketch_fp):
+            dict_of_sketches[spid] = np.load(sketch_fp)
+    index_fp = midas_db.get_target_layout("sketch_index", False, component=component)
+    write_sketch_index(index_fp, dict_of_sketches, args.sketch_kmer_size, args.sketch_scaled)
+    tsprint(f"MIDAS2::build_sketches::index {len(dict_of_sketches)} species into {index_fp}")
+
+
+@register_args
+def main(args):
+    tsprint(f"Build species sketches in subcommand {args.subcommand} with args\n{json.dumps(vars(args), indent=4)}")
+    build_sketches(args)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import json
+from midas.common.argparser import add_subcommand
+from midas.common.utils import tsprint, OutputStream, multiprocessing_map, num_physical_cores
+from midas.models.samplepool import get_pool_layout
+from midas.models.snpsmatrix import SnpsMatrix, format_site_ids
+from midas.models.species import parse_species
+from midas.params.schemas import format_data
+
+
+def register_args(main_func):
+    subparser = add_subcommand('export_snps', main_func, help='export binary merge_snps matrices back to snps_freqs and snps_depth TSV files')
+    subparser.add_argument('midas_outdir',
+                           type=str,
+                           help="""Path to the merge_snps output directory, produced with --binary_matrices.""")
+    subparser.add_argument('--species_list',
+                           dest='species_list',
+                           type=str,
+                           metavar="CHAR",
+                           help=f"Comma separated list of species ids OR path to list of species TXT.")
+    subparser.add_argument('--num_cores',
+                           dest='num_cores',
+                           type=int,
+                           metavar="INT",
+                           default=num_physical_cores,
+                           help=f"Number of physical cores to use ({num_physical_cores})")
+    return main_func
+
+
+def export_species(packed_args):
+    species_id, midas_outdir = packed_args
+    layout = get_pool_layout("snps")(species_id)
+
+    matrix = SnpsMatrix(os.path.join(midas_outdir, layout["snps_matrix"]))
+    header = "site_id\t" + "\t".join(matrix.samples) + "\n"
+
+    tsprint(f"  MIDAS2::export_species::{species_id}::start")
+    with OutputStream(os.path.join(midas_outdir, layout["snps_freq"])) as freq_stream, \
+        OutputStream(os.path.join(midas_outdir, layout["snps_depth"])) as depth_stream:
+        freq_stream.write(header)
+        depth_stream.write(header)
+        for sites, freqs, depth in matrix.iter_row_groups():
+            site_ids = format_site_ids(sites)
+            freq_stream.write("".join(site_id + "\t" + "\t".join(map(format_data, row.tolist())) + "\n" for site_id, row in zip(site_ids, freqs)))
+            depth_stream.write("".join(site_id + "\t" + "\t".join(map(str, row.tolist())) + "\n" for site_id, row in zip(site_ids, depth)))
+    tsprint(f"  MIDAS2::export_species::{species_id}::finish {matrix.sites_count} sites")
+    return "worked"
+
+
+def list_exported_species(midas_outdir):
+    snps_dir = os.path.join(midas_outdir, get_pool_layout("snps")()["outdir"])
+    species_ids = []
+    for species_id in sorted(os.listdir(snps_dir)):
+        matrix_dir = os.path.join(midas_outdir, get_pool_layout("snps")(species_id)["snps_matrix"])
+        if os.path.exists(os.path.join(matrix_dir, "manifest.json")):
+            species_ids.append(species_id)
+    return species_ids
+
+
+def export_snps(args):
+    species_ids = list_exported_species(args.midas_outdir)
+    species_list = parse_species(args)
+    if species_list:
+        missing = set(species_list) - set(species_ids)
+        assert not missing, f"No binary SNPs matrices for species {sorted(missing)} under {args.midas_outdir}"
+        species_ids = [spid for spid in species_ids if spid in species_list]
+    assert species_ids, f"No binary SNPs matrices found under {args.midas_outdir}, was merge_snps run with --binary_matrices?"
+
+    tsprint(f"MIDAS2::export_snps::start {len(species_ids)} species")
+    proc_flags = multiprocessing_map(export_species, [(spid, args.midas_outdir) for spid in species_ids], min(args.num_cores, len(species_ids)))
+    assert all(s == "worked" for s in proc_flags), f"Error: some species failed"
+    tsprint(f"MIDAS2::export_snps::finish")
+
+
+@register_args
+def main(args):
+    tsprint(f"Export binary population SNV matrices in subcommand {args.subcommand} with args\n{json.dumps(vars(args), indent=4)}")
+    export_snps(args)
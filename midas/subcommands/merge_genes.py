@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 import os
 import json
-from collections import defaultdict
 from itertools import repeat
 from math import ceil
+import numpy as np
+import pandas as pd
 
 from midas.models.samplepool import SamplePool
 from midas.common.argparser import add_subcommand
-from midas.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, multiprocessing_map, args_string, multithreading_map
+from midas.common.utils import tsprint, InputStream, OutputStream, multiprocessing_map, args_string, multithreading_map
 from midas.models.midasdb import MIDAS_DB
 from midas.params.schemas import genes_info_schema, fetch_genes_depth_schema, format_data, DECIMALS6
 from midas.params.inputs import MIDASDB_NAMES
+from midas.common.workqueue import WorkQueue, wait_for_local_workers, absolute_paths, absolute_samples_paths
 
 
 DEFAULT_GENOME_DEPTH = 1.0
@@ -20,6 +22,16 @@ DEFAULT_CLUSTER_IN_ID = '99'
 DEFAULT_MIN_COPY = 0.35
 DEFAULT_NUM_CORES = 4
 
+# Dense cluster x sample matrices: dtype, and python type the values are written as.
+# Read counts used to be summed into floats, and are still written as such.
+GENES_MATRICES_TYPES = {
+    "presabs": (np.uint8, int),
+    "copynum": (np.float64, float),
+    "depth": (np.float64, float),
+    "reads": (np.uint32, float),
+}
+GENES_MATRIX_ROWS = 1024 # initial clusters capacity of the matrices, doubled as needed
+
 
 def register_args(main_func):
     subparser = add_subcommand('merge_genes', main_func, help='metagenomic pan-genome profiling')
@@ -90,22 +102,38 @@ def register_args(main_func):
                            metavar="INT",
                            default=DEFAULT_NUM_CORES,
                            help=f"Number of physical cores to use ({DEFAULT_NUM_CORES})")
+
+    subparser.add_argument('--work_queue',
+                           dest='work_queue',
+                           type=str,
+                           metavar="PATH",
+                           help=f"Shared directory of a file based work queue, to spread the species over several hosts instead of the local processes pool.")
+    subparser.add_argument('--queue_role',
+                           dest='queue_role',
+                           type=str,
+                           default="plan",
+                           choices=['plan', 'work', 'finalize'],
+                           help=f"With --work_queue, plan: select species and write one task per species; work: run the tasks; finalize: wait for all the tasks. Run with the same arguments on every host. (plan)")
+    subparser.add_argument('--local_workers',
+                           dest='local_workers',
+                           type=int,
+                           metavar="INT",
+                           default=0,
+                           help=f"With --queue_role plan, start this many local workers and finalize once all the tasks are done (0)")
     return main_func
 
 
-def _fetch_cxx_map(pargs):
-    sp, midas_db, xx_in, xx_out = pargs
+def _fetch_clusters_index(pargs):
+    sp, midas_db = pargs
     sp.set_clusters_info_fp(midas_db, '99')
-    sp.get_clusters_info('99')
-    sp.get_cluster_map(xx_in, xx_out)
+    sp.get_clusters_index()
     return True
 
 
 def prepare_species(midas_db):
     global dict_of_species
-    global global_args
     num_cores = min(midas_db.num_cores, 8)
-    multithreading_map(_fetch_cxx_map, [(sp, midas_db, global_args.cluster_level_in, global_args.cluster_level_out) for sp in dict_of_species.values()], num_cores)
+    multithreading_map(_fetch_clusters_index, [(sp, midas_db) for sp in dict_of_species.values()], num_cores)
     return True
 
 
@@ -123,20 +151,41 @@ def build_gene_matrices(species_id):
     min_copy = global_args.min_copy
     sp = dict_of_species[species_id]
 
+    # Dense row of each cluster, from its row in the clusters index, and the other way around
+    accumulator = {
+        "dense_rows": np.full(len(sp.clusters_index), -1, dtype=np.int64),
+        "cxx_rows": [],
+    }
+    for file_type in ("copynum", "depth", "reads"):
+        accumulator[file_type] = np.zeros((min(GENES_MATRIX_ROWS, len(sp.clusters_index)), sp.samples_count), dtype=GENES_MATRICES_TYPES[file_type][0])
+
     # First pass: accumulate the gene matrix sample by sample
-    accumulator = defaultdict(dict)
     for sample_index, sample in enumerate(sp.list_of_samples):
         genes_depth_fp = sample.get_target_layout("genes_depth", species_id)
         my_args = (species_id, sample_index, genes_depth_fp)
         collect(accumulator, my_args)
 
     # Second pass: infer presence absence based on copy number
-    for cxx_id, copynum in accumulator["copynum"].items():
-        accumulator["presabs"][cxx_id] = [1 if cn >= min_copy else 0 for cn in copynum]
+    genes_count = len(accumulator["cxx_rows"])
+    for file_type in ("copynum", "depth", "reads"):
+        accumulator[file_type] = accumulator[file_type][:genes_count]
+    accumulator["presabs"] = (accumulator["copynum"] >= min_copy).astype(GENES_MATRICES_TYPES["presabs"][0])
 
     return accumulator
 
 
+def grow_gene_matrices(accumulator, genes_count):
+    capacity = len(accumulator["depth"])
+    if genes_count <= capacity:
+        return
+    capacity = max(genes_count, 2 * capacity)
+    for file_type in ("copynum", "depth", "reads"):
+        matrix = accumulator[file_type]
+        grown = np.zeros((capacity, matrix.shape[1]), dtype=matrix.dtype)
+        grown[:len(matrix)] = matrix
+        accumulator[file_type] = grown
+
+
 def collect(accumulator, my_args):
     # Merge copy_numbers, coverage and read counts across ALl the samples
 
@@ -147,32 +196,37 @@ def collect(accumulator, my_args):
     species_id, sample_index, genes_depth_fp = my_args
 
     xx_in = global_args.cluster_level_in
+    xx_out = global_args.cluster_level_out
 
-    sp = dict_of_species[species_id]
-    total_samples_count = sp.samples_count
-    cxx_map = sp.clusters_map[xx_in]
-
+    clusters_index = dict_of_species[species_id].clusters_index
+    schema = fetch_genes_depth_schema(xx_in)
+    columns = [f"cluster_{xx_in}_id", "mapped_reads", "mean_depth", "copy_number"]
     with InputStream(genes_depth_fp) as stream:
-        for r in select_from_tsv(stream, selected_columns=fetch_genes_depth_schema(xx_in), result_structure=dict):
-            cxx_id = cxx_map[r[f"cluster_{xx_in}_id"]]
-
-            acc_copynum = accumulator["copynum"].get(cxx_id)
-            if not acc_copynum:
-                acc_copynum = [0.0] * total_samples_count
-                accumulator["copynum"][cxx_id] = acc_copynum
-            acc_copynum[sample_index] += r["copy_number"]
-
-            acc_depth = accumulator["depth"].get(cxx_id)
-            if not acc_depth:
-                acc_depth = [0.0] * total_samples_count
-                accumulator["depth"][cxx_id] = acc_depth
-            acc_depth[sample_index] += r["mean_depth"]
-
-            acc_reads = accumulator["reads"].get(cxx_id)
-            if not acc_reads:
-                acc_reads = [0.0] * total_samples_count
-                accumulator["reads"][cxx_id] = acc_reads
-            acc_reads[sample_index] += r["mapped_reads"]
+        frame = pd.read_csv(stream, sep="\t", usecols=columns, dtype={column: schema[column] for column in columns}, na_filter=False, float_precision="round_trip")
+
+    # Integer cluster remapping: centroid_99 row, then the row of its centroid_xx
+    cxx_in_ids = frame[f"cluster_{xx_in}_id"].tolist()
+    c99_rows = clusters_index.rows(cxx_in_ids)
+    assert np.all(c99_rows >= 0), f"{genes_depth_fp}: {cxx_in_ids[int(np.argmin(c99_rows))]} is not a centroid_99 of species {species_id}"
+    cxx_rows = clusters_index.array[f"centroid_{xx_out}"][c99_rows].astype(np.int64)
+    assert np.all(cxx_rows >= 0), f"{genes_depth_fp}: some centroid_{xx_out} of species {species_id} are not centroids_99"
+
+    # Clusters seen for the first time get the next dense rows, in the order of the file
+    dense_rows = accumulator["dense_rows"]
+    new_rows = cxx_rows[dense_rows[cxx_rows] < 0]
+    if len(new_rows):
+        unique_rows, first_seen = np.unique(new_rows, return_index=True)
+        new_rows = unique_rows[np.argsort(first_seen)]
+        genes_count = len(accumulator["cxx_rows"])
+        grow_gene_matrices(accumulator, genes_count + len(new_rows))
+        dense_rows[new_rows] = np.arange(genes_count, genes_count + len(new_rows))
+        accumulator["cxx_rows"].extend(new_rows.tolist())
+
+    # Several centroids_99 of a cluster add up, in the order of the file
+    genes_count = len(accumulator["cxx_rows"])
+    genes = dense_rows[cxx_rows]
+    for file_type, column in (("copynum", "copy_number"), ("depth", "mean_depth"), ("reads", "mapped_reads")):
+        accumulator[file_type][:genes_count, sample_index] = np.bincount(genes, weights=frame[column].to_numpy(), minlength=genes_count)
 
 
 def write_gene_matrices(accumulator, species_id):
@@ -182,18 +236,54 @@ def write_gene_matrices(accumulator, species_id):
 
     samples_names = dict_of_species[species_id].fetch_samples_names()
     xx_out = global_args.cluster_level_out
+    clusters_index = dict_of_species[species_id].clusters_index
+    cxx_ids = [cxx_id.decode() for cxx_id in clusters_index.c99_ids[accumulator["cxx_rows"]]]
 
     for file_type in list(genes_info_schema.keys()):
         outfile = pool_of_samples.get_target_layout(f"genes_{file_type}", species_id)
+        write_type = GENES_MATRICES_TYPES[file_type][1]
         with OutputStream(outfile) as stream:
             stream.write(f"cluster_{xx_out}_id\t" + "\t".join(samples_names) + "\n")
-            for cxx_id, gene_vals in accumulator[file_type].items():
+            for cxx_id, gene_row in zip(cxx_ids, accumulator[file_type]):
+                gene_vals = gene_row.astype(write_type).tolist()
                 stream.write(f"{cxx_id}\t" + "\t".join(map(format_data, gene_vals, repeat(DECIMALS6, len(gene_vals)))) + "\n")
     return True
 
 
+def process_task(payload):
+    species_id = payload
+    assert process([species_id]) == "worked"
+
+
+def finalize_work_queue(queue):
+    tsprint(f"MIDAS2::finalize_work_queue::start")
+    list(queue.wait_for_tasks(queue.task_ids))
+    tsprint(f"MIDAS2::finalize_work_queue::finish")
+
+
+def join_work_queue(args):
+    """ Workers and finalizer restore the planner state from the work queue """
+    global global_args
+    global pool_of_samples
+    global dict_of_species
+
+    queue = WorkQueue(args.work_queue)
+    tsprint(f"MIDAS2::join_work_queue::{args.queue_role} wait for the plan in {args.work_queue}")
+    global_args, pool_of_samples, dict_of_species = queue.load_state()
+    global_args.queue_role = args.queue_role
+
+    if args.queue_role == "work":
+        queue.work(process_task)
+    if args.queue_role == "finalize":
+        finalize_work_queue(queue)
+
+
 def merge_genes(args):
 
+    if args.work_queue and args.queue_role != "plan":
+        join_work_queue(args)
+        return
+
     try:
         global global_args
         global_args = args
@@ -201,7 +291,12 @@ def merge_genes(args):
         global pool_of_samples
         global dict_of_species
 
+        if args.work_queue:
+            absolute_paths(args, ["samples_list", "midas_outdir", "midasdb_dir", "work_queue"], ["species_list"])
+
         pool_of_samples = SamplePool(args.samples_list, args.midas_outdir, "genes")
+        if args.work_queue:
+            absolute_samples_paths(pool_of_samples)
         dict_of_species = pool_of_samples.select_species("genes", args)
 
         species_ids_of_interest = list(dict_of_species.keys())
@@ -226,6 +321,17 @@ def merge_genes(args):
 
         pool_of_samples.write_summary_files(dict_of_species, "genes")
 
+        if args.work_queue:
+            queue = WorkQueue(args.work_queue)
+            queue.plan([(species_id, species_id) for species_id in species_ids_of_interest], (global_args, pool_of_samples, dict_of_species))
+            if args.local_workers > 0:
+                list_of_workers = queue.spawn_local_workers(args.local_workers)
+                finalize_work_queue(queue)
+                wait_for_local_workers(list_of_workers)
+            else:
+                tsprint(f"MIDAS2::plan_work_queue::start workers and the finalizer with --work_queue {args.work_queue} --queue_role work|finalize")
+            return
+
         # Download genes_info for every species in the restricted species profile.
         def chunkify(L, n):
             return [L[x: x+n] for x in range(0, len(L), n)]
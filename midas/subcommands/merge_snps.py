@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 import os
+import io
 import json
 import multiprocessing
-from collections import defaultdict
+from math import floor, log10
+from collections import defaultdict, deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 
 from midas.models.samplepool import SamplePool
-from midas.common.utils import tsprint, command, InputStream, OutputStream, multiprocessing_map, select_from_tsv, cat_files, multithreading_map, args_string
+from midas.common.utils import tsprint, command, InputStream, OutputStream, multiprocessing_map, select_from_tsv, multithreading_map, args_string, FrameConcatenator, wait_for_chunks_in_order
 from midas.common.utilities import annotate_site, acgt_string, scan_gene_feature, scan_fasta, compute_gene_boundary
 from midas.common.snvs import call_alleles
 from midas.models.midasdb import MIDAS_DB
 from midas.params.schemas import snps_pileup_schema, snps_pileup_basic_schema, snps_info_schema, format_data
 from midas.common.argparser import add_subcommand
 from midas.params.inputs import MIDASDB_NAMES
-from midas.models.species import load_chunks_cache
+from midas.models.species import load_chunks_cache, parse_regions
+from midas.models.snpsmatrix import SnpsMatrixWriter, finalize_snps_matrix
+from midas.common.workqueue import WorkQueue, wait_for_local_workers, absolute_paths, absolute_samples_paths
 
 
 DEFAULT_SAMPLE_COUNTS = 2
@@ -20,6 +28,18 @@ DEFAULT_GENOME_DEPTH = 5.0
 DEFAULT_GENOME_COVERAGE = 0.4
 DEFAULT_CHUNK_SIZE = 100000
 DEFAULT_NUM_CORES = 16
+DEFAULT_ROW_GROUP_SIZE = 5000
+DEFAULT_MIN_CHUNK_SIZE = 10000
+DEFAULT_PREFETCH_SAMPLES = 2
+DEFAULT_PREFETCH_MEMORY = 0.25
+
+# Approximate CPython footprints used by the --max_memory chunk planner, in bytes
+PLAN_WORKER_BASE_BYTES = 200 * 1024 ** 2   # interpreter, imported modules and the sample pool
+PLAN_GENOME_BYTES_PER_BASE = 4             # gene features and gene sequences loaded for site annotation
+PLAN_SITE_BYTES = 300                      # accumulator entry, site_id and list header of one site
+PLAN_SAMPLE_SLOT_BYTES = 8                 # list slot of one <site, sample>
+PLAN_COVERED_SAMPLE_BYTES = 60             # A,C,G,T counts string of one covered <site, sample>
+PLAN_OUTPUT_SAMPLE_BYTES = 16              # formatted freq and depth cells buffered by the row group writer
 
 DEFAULT_SITE_DEPTH = 5
 DEFAULT_SITE_RATIO = 3.0
@@ -157,7 +177,17 @@ def register_args(main_func):
                            metavar="INT",
                            default=DEFAULT_CHUNK_SIZE,
                            help=f"Number of genomic sites for the temporary chunk file  ({DEFAULT_CHUNK_SIZE})")
+    subparser.add_argument('--row_group_size',
+                           dest='row_group_size',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_ROW_GROUP_SIZE,
+                           help=f"Number of called sites buffered before flushing to the output files ({DEFAULT_ROW_GROUP_SIZE})")
 
+    subparser.add_argument('--binary_matrices',
+                           action='store_true',
+                           default=False,
+                           help=f"Write snps_freqs and snps_depth as memory-mappable binary matrices instead of TSV (see export_snps).")
     subparser.add_argument('--advanced',
                            action='store_true',
                            default=False,
@@ -166,6 +196,46 @@ def register_args(main_func):
                            action='store_true',
                            default=False,
                            help=f"Adjust chunk_size based on species's prevalence.")
+    subparser.add_argument('--regions',
+                           dest='regions',
+                           type=str,
+                           metavar="PATH",
+                           help=f"Only merge the SNPs within these regions of interest: a BED file of 0-based half-open intervals (contig_id, start, end) and/or a list of gene_id, one per line. Species without any region are skipped.")
+    subparser.add_argument('--prefetch_samples',
+                           dest='prefetch_samples',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_PREFETCH_SAMPLES,
+                           help=f"Number of upcoming samples whose pileup slices are read and parsed on background threads while the current sample is accumulated, 0 to stream each slice instead ({DEFAULT_PREFETCH_SAMPLES})")
+    subparser.add_argument('--prefetch_memory',
+                           dest='prefetch_memory',
+                           type=float,
+                           metavar="FLOAT",
+                           default=DEFAULT_PREFETCH_MEMORY,
+                           help=f"Memory cap in GB of the prefetched, not yet accumulated, sample slices per worker, including the slices still being read ({DEFAULT_PREFETCH_MEMORY})")
+    subparser.add_argument('--max_memory',
+                           dest='max_memory',
+                           type=float,
+                           metavar="FLOAT",
+                           help=f"Memory budget in GB for all the concurrently running workers. When given, chunk sizes (and if needed the number of workers) are derived from the samples count and genome length of each species, overriding --chunk_size and --robust_chunk.")
+
+    subparser.add_argument('--work_queue',
+                           dest='work_queue',
+                           type=str,
+                           metavar="PATH",
+                           help=f"Shared directory of a file based work queue, to spread the chunks over several hosts instead of the local processes pool.")
+    subparser.add_argument('--queue_role',
+                           dest='queue_role',
+                           type=str,
+                           default="plan",
+                           choices=['plan', 'work', 'finalize'],
+                           help=f"With --work_queue, plan: select species and write the chunk tasks; work: run the chunk tasks; finalize: collect the chunks into the species outputs. Run with the same arguments on every host. (plan)")
+    subparser.add_argument('--local_workers',
+                           dest='local_workers',
+                           type=int,
+                           metavar="INT",
+                           default=0,
+                           help=f"With --queue_role plan, start this many local workers and finalize once all the tasks are done (0)")
 
     return main_func
 
@@ -184,6 +254,64 @@ def calculate_chunk_size(samples_count, chunk_size):
     return chunk_size
 
 
+def estimate_site_bytes(samples_count, covered_fraction=1.0):
+    """ Accumulator bytes of one site, where only the covered <site, sample> pairs carry a counts string """
+    return PLAN_SITE_BYTES + samples_count * (PLAN_SAMPLE_SLOT_BYTES + PLAN_COVERED_SAMPLE_BYTES * covered_fraction)
+
+
+def estimate_worker_bytes(chunk_size, samples_count, genome_length, row_group_size, covered_fraction=1.0):
+    """ Estimated peak memory of one worker accumulating and calling chunk_size sites across samples_count samples """
+    fixed_bytes = PLAN_WORKER_BASE_BYTES + PLAN_GENOME_BYTES_PER_BASE * genome_length
+    output_bytes = PLAN_OUTPUT_SAMPLE_BYTES * row_group_size * samples_count
+    accumulator_bytes = chunk_size * estimate_site_bytes(samples_count, covered_fraction)
+    return fixed_bytes + output_bytes + accumulator_bytes
+
+
+def round_chunk_size(chunk_size):
+    """ Round down to 1, 2 or 5 x 10^k, so that the chunks cache in the MIDAS DB is reused across runs """
+    magnitude = 10 ** floor(log10(chunk_size))
+    for step in (5, 2, 1):
+        if chunk_size >= step * magnitude:
+            return step * magnitude
+    return magnitude
+
+
+def plan_chunks(list_of_species, midas_db, max_memory, num_cores, row_group_size, prefetch_memory=0):
+    """ Derive per-species chunk size and the number of workers such that the
+    concurrently running workers stay within max_memory (GB), with prefetch_memory (GB) reserved per worker """
+
+    budget = max_memory * 1024 ** 3
+    for sp in list_of_species:
+        if not sp.genome_length:
+            sp.get_genome_length(midas_db)
+
+    # Smallest footprint of one worker for the most demanding species
+    prefetch_bytes = prefetch_memory * 1024 ** 3
+    min_footprint = prefetch_bytes + max(estimate_worker_bytes(min(DEFAULT_MIN_CHUNK_SIZE, sp.genome_length), sp.samples_count, sp.genome_length, row_group_size, sp.covered_fraction) for sp in list_of_species)
+    num_workers = max(1, min(num_cores, floor(budget / min_footprint)))
+    if num_workers < num_cores:
+        tsprint(f"  MIDAS2::plan_chunks::reduce number of workers from {num_cores} to {num_workers} to fit {max_memory}GB")
+    if min_footprint > budget:
+        tsprint(f"  MIDAS2::plan_chunks::WARNING one worker needs at least {min_footprint / 1024 ** 3:.2f}GB, more than the {max_memory}GB budget")
+
+    worker_budget = budget / num_workers - prefetch_bytes
+    plan = []
+    for sp in list_of_species:
+        bytes_per_site = estimate_site_bytes(sp.samples_count, sp.covered_fraction)
+        max_sites = floor((worker_budget - estimate_worker_bytes(0, sp.samples_count, sp.genome_length, row_group_size)) / bytes_per_site)
+        if max_sites >= sp.genome_length:
+            sp.chunk_size = 0 # whole species
+        else:
+            sp.chunk_size = round_chunk_size(max(DEFAULT_MIN_CHUNK_SIZE, max_sites))
+        chunk_sites = sp.chunk_size if sp.chunk_size else sp.genome_length
+        peak_bytes = estimate_worker_bytes(chunk_sites, sp.samples_count, sp.genome_length, row_group_size, sp.covered_fraction)
+        plan.append(f"{sp.id}\t{sp.samples_count}\t{sp.genome_length}\t{sp.covered_fraction:.3f}\t{sp.chunk_size}\t{peak_bytes / 1024 ** 3:.3f}")
+
+    plan_str = "\n".join(["species_id\tsamples_count\tgenome_length\tcovered_fraction\tchunk_size\test_worker_gb"] + plan)
+    tsprint(f"  MIDAS2::plan_chunks::{num_workers} workers within {max_memory}GB, {worker_budget / 1024 ** 3:.3f}GB per worker plus {prefetch_memory}GB prefetch, chunk_size 0 for whole species\n{plan_str}")
+    return num_workers, plan_str
+
+
 def in_place(species_counts):
     return species_counts < 50
 
@@ -193,16 +321,78 @@ def design_chunks_per_species(args):
     sp, midas_db = args
     samples_count = sp.samples_count
 
-    if global_args.robust_chunk:
+    if global_args.max_memory:
+        chunk_size = sp.chunk_size # computed by plan_chunks
+    elif global_args.robust_chunk:
         chunk_size = calculate_chunk_size(samples_count, global_args.chunk_size)
     else:
         chunk_size = global_args.chunk_size
 
-    if chunk_size == 0:
+    if global_args.regions:
+        if chunk_size == 0:
+            chunk_size = sum(end - start for intervals in sp.regions.values() for start, end in intervals)
+        sp.chunk_size = chunk_size
+        chunks_of_sites = sp.compute_regions_chunks(midas_db, chunk_size)
+        write_regions_by_chunk(sp, chunks_of_sites)
+    elif chunk_size == 0:
         return None # whole species, no need to design chunks
+    else:
+        sp.chunk_size = chunk_size
+        chunks_of_sites = sp.compute_snps_chunks(midas_db, chunk_size, "merge")
+
+    # Only visit the samples with covered sites in the chunk
+    chunks_samples = sp.compute_chunks_samples(chunks_of_sites)
+    skipped_visits = chunks_samples.size - int(chunks_samples.sum())
+    if skipped_visits:
+        tsprint(f"  MIDAS2::design_chunks_per_species::{sp.id} skip {skipped_visits} out of {chunks_samples.size} <chunk, sample> visits without coverage")
+    return chunks_of_sites
+
+
+def write_regions_by_chunk(sp, chunks_of_sites):
+    """ One sorted list of regions per chunk (contig_id, 1-based start, end) for the pileup reader """
+    global pool_of_samples
+    for chunk_id in range(sp.num_of_snps_chunks):
+        regions_fp = pool_of_samples.get_target_layout("snps_regions_by_chunk", sp.id, chunk_id)
+        list_of_regions = sorted(chunks_of_sites[chunk_id][0][3])
+        with OutputStream(regions_fp) as stream:
+            stream.write("".join(f"{contig_id}\t{start+1}\t{end}\n" for contig_id, start, end in list_of_regions))
+        sp.chunks_regions[chunk_id] = regions_fp
+
+
+def compute_regions_per_species(packed_args):
+    sp, midas_db, bed_regions, gene_ids = packed_args
+    return sp.compute_regions(midas_db, bed_regions, gene_ids)
+
+
+def select_species_by_regions(dict_of_species, midas_db, regions_fp):
+    """ Resolve the regions of interest per species and drop the species without any """
+    bed_regions, gene_ids = parse_regions(regions_fp)
+    assert bed_regions or gene_ids, f"No regions in {regions_fp}"
+    if bed_regions:
+        midas_db.fetch_files("repgenome", list(dict_of_species.keys()))
+    if gene_ids:
+        midas_db.fetch_files("annotation_genes", list(dict_of_species.keys()))
+
+    args_list = [(sp, midas_db, bed_regions, gene_ids) for sp in dict_of_species.values()]
+    list_of_resolved = multithreading_map(compute_regions_per_species, args_list, min(midas_db.num_cores, 16))
+    unresolved_genes = gene_ids - set().union(*list_of_resolved)
+    if unresolved_genes:
+        tsprint(f"  MIDAS2::select_species_by_regions::WARNING {len(unresolved_genes)} out of {len(gene_ids)} genes not found in the selected species")
+
+    for species_id, sp in list(dict_of_species.items()):
+        if not sp.regions:
+            del dict_of_species[species_id]
+            continue
+        regions_length = sum(end - start for intervals in sp.regions.values() for start, end in intervals)
+        tsprint(f"  MIDAS2::select_species_by_regions::{species_id} {sum(map(len, sp.regions.values()))} regions, {regions_length} sites on {len(sp.regions)} contigs")
+    return dict_of_species
 
-    sp.chunk_size = chunk_size
-    return sp.compute_snps_chunks(midas_db, chunk_size, "merge")
+
+def fetch_samples_coverage(sp):
+    sp.fetch_samples_coverage()
+    if sp.genome_length:
+        sp.compute_covered_fraction()
+    return True
 
 
 def design_chunks(species_ids_of_interest, midas_db):
@@ -211,16 +401,18 @@ def design_chunks(species_ids_of_interest, midas_db):
     global global_args
 
     global semaphore_for_species
+    global status_of_chunks
     semaphore_for_species = dict()
+    status_of_chunks = dict()
 
     global dict_of_site_chunks
+    dict_of_site_chunks = defaultdict(dict)
 
     # Design chunks structure per species
     num_cores = min(midas_db.num_cores, 16)
     all_site_chunks = multithreading_map(design_chunks_per_species, [(sp, midas_db) for sp in dict_of_species.values()], num_cores) #<---
 
-    if in_place(len(species_ids_of_interest)):
-        dict_of_site_chunks = defaultdict(dict)
+    if in_place(len(species_ids_of_interest)) or global_args.regions:
         for spidx, species_id in enumerate(species_ids_of_interest):
             if all_site_chunks[spidx] is not None:
                 dict_of_site_chunks[species_id] = all_site_chunks[spidx]
@@ -237,6 +429,8 @@ def design_chunks(species_ids_of_interest, midas_db):
             semaphore_for_species[species_id] = multiprocessing.Semaphore(num_of_chunks)
             for _ in range(num_of_chunks):
                 semaphore_for_species[species_id].acquire()
+            # Shared per-chunk status (0: pending, 1: done, -1: failed) for collecting chunks in order
+            status_of_chunks[species_id] = multiprocessing.RawArray('b', num_of_chunks)
         else:
             arguments_list.append((species_id, -2)) # species_worker
 
@@ -253,14 +447,7 @@ def process(packed_args):
     species_id, chunk_id = packed_args
 
     if chunk_id == -1:
-
-        global semaphore_for_species
-        global dict_of_species
-        sp = dict_of_species[species_id]
-
-        tsprint(f"  MIDAS2::process::{species_id}-{chunk_id}::wait collect_chunks")
-        for _ in range(sp.num_of_snps_chunks):
-            semaphore_for_species[species_id].acquire()
+        # Chunks are appended to the species files as soon as they (and their predecessors) finish
         tsprint(f"  MIDAS2::process::{species_id}-{chunk_id}::start collect_chunks")
         collect_chunks(species_id)
         tsprint(f"  MIDAS2::process::{species_id}-{chunk_id}::finish collect_chunks")
@@ -276,23 +463,27 @@ def snps_worker(species_id, chunk_id):
     """ For genome sites from one chunk, scan across all the sample, compute pooled SNPs and write to file """
 
     global semaphore_for_species
+    global status_of_chunks
     global dict_of_species
     global dict_of_site_chunks
     global global_args
 
+    status = -1
     try:
         sp = dict_of_species[species_id]
 
         if chunk_id == -2:
             species_worker(species_id)
         else:
-            if in_place(len(dict_of_species)):
+            if in_place(len(dict_of_species)) or global_args.regions:
                 chunks_of_sites = dict_of_site_chunks[species_id]
             else:
                 chunks_of_sites = load_chunks_cache(sp.chunks_of_sites_fp)
             chunk_worker(chunks_of_sites[chunk_id][0])
+        status = 1
     finally:
         if species_id in semaphore_for_species:
+            status_of_chunks[species_id][chunk_id] = status
             semaphore_for_species[species_id].release() # no deadlock
 
 
@@ -306,16 +497,16 @@ def species_worker(species_id):
     list_of_samples = sp.list_of_samples
 
     tsprint(f"    MIDAS2::species_worker::{species_id}--2::start accumulate_samples")
-    accumulator = dict()
+    list_of_proc_args = []
     for sample_index, sample in enumerate(list_of_samples):
         snps_pileup_path = sample.get_target_layout("snps_pileup", species_id)
-        proc_args = ("species", sample_index, snps_pileup_path, total_samples_count, list_of_samples_depth[sample_index])
-        accumulate(accumulator, proc_args)
+        list_of_proc_args.append(("species", sample_index, snps_pileup_path, total_samples_count, list_of_samples_depth[sample_index]))
+    accumulator = accumulate_samples(list_of_proc_args)
     tsprint(f"    MIDAS2::species_worker::{species_id}--2::finish accumulate_samples")
 
     tsprint(f"    MIDAS2::species_worker::{species_id}--2::start call_and_write_population_snps")
-    pooled_snps_dict = call_population_snps(accumulator, species_id)
-    write_population_snps(pooled_snps_dict, species_id, -2)
+    called_sites = call_population_snps(accumulator, species_id)
+    write_population_snps(called_sites, species_id, -2)
     tsprint(f"    MIDAS2::species_worker::{species_id}--2::finish call_and_write_population_snps")
 
 
@@ -331,50 +522,71 @@ def chunk_worker(packed_args):
     list_of_samples_depth = sp.list_of_samples_depth
 
     tsprint(f"    MIDAS2::chunk_worker::{species_id}-{chunk_id}::start accumulate_samples")
-    accumulator = dict()
+    list_of_proc_args = []
     for sample_index, sample in enumerate(sp.list_of_samples):
+        if not sp.chunks_samples[chunk_id, sample_index]:
+            continue # no covered sites of this sample in the chunk
+
         snps_pileup_path = sample.get_target_layout("snps_pileup", species_id)
 
         if contig_id == -1:
             loc_fp = sp.chunks_contigs[chunk_id]
             proc_args = ("file", sample_index, snps_pileup_path, total_samples_count, list_of_samples_depth[sample_index], loc_fp)
+        elif contig_id == -2:
+            regions_fp = sp.chunks_regions[chunk_id]
+            proc_args = ("regions", sample_index, snps_pileup_path, total_samples_count, list_of_samples_depth[sample_index], regions_fp)
         else:
             # Pileup is 1-based index, close left close right
             contig_start, contig_end = packed_args[3:5]
             proc_args = ("range", sample_index, snps_pileup_path, total_samples_count, list_of_samples_depth[sample_index], contig_id, contig_start+1, contig_end)
-        accumulate(accumulator, proc_args)
+        list_of_proc_args.append(proc_args)
+    accumulator = accumulate_samples(list_of_proc_args)
     tsprint(f"    MIDAS2::chunk_worker::{species_id}-{chunk_id}::finish accumulate_samples")
 
     # Compute across-samples SNPs and write to chunk file
     tsprint(f"    MIDAS2::chunk_worker::{species_id}-{chunk_id}::start call_and_write_population_snps")
-    pooled_snps_dict = call_population_snps(accumulator, species_id)
-    write_population_snps(pooled_snps_dict, species_id, chunk_id)
+    called_sites = call_population_snps(accumulator, species_id)
+    write_population_snps(called_sites, species_id, chunk_id)
     tsprint(f"    MIDAS2::chunk_worker::{species_id}-{chunk_id}::finish call_and_write_population_snps")
 
 
-def accumulate(accumulator, proc_args):
-    """ Accumulate read_counts and sample_counts for a chunk of sites for one sample,
-    at the same time remember <site, sample>'s A, C, G, T read counts."""
-
-    global global_args
+# Keep the pileup rows within the sorted regions of one chunk (file of contig_id, 1-based start, end),
+# walking a per-contig pointer since rows of one contig are in increasing position, and stop reading
+# as soon as the last position of every contig has been passed.
+REGIONS_FILTER_AWK = 'BEGIN { FS = "\\t"; while ((getline line < regions) > 0) { split(line, r, "\\t"); c = r[1]; n[c]++; s[c, n[c]] = r[2] + 0; e[c, n[c]] = r[3] + 0; p[c] = 1 } for (c in n) contigs++ } ' \
+    '!($1 in n) || p[$1] > n[$1] { next } ' \
+    '{ c = $1; pos = $2 + 0; while (p[c] <= n[c] && pos > e[c, p[c]]) p[c]++ } ' \
+    'p[c] > n[c] { if (++done == contigs) exit; next } ' \
+    'pos >= s[c, p[c]] { print; if (p[c] == n[c] && pos == e[c, p[c]]) { p[c]++; if (++done == contigs) exit } }'
 
-    flag, sample_index, snps_pileup_path, total_samples_count, genome_coverage = proc_args[:5]
 
+def sample_sites_filter(proc_args):
+    """ Shell filter selecting one sample's slice of pileup """
+    flag = proc_args[0]
     if flag == "file":
         loc_fp = proc_args[5]
-        filter_cmd = f"grep -Fwf {loc_fp}"
+        return f"grep -Fwf {loc_fp}"
     if flag == "range":
         contig_id, contig_start, contig_end = proc_args[5:]
-        filter_cmd = f"awk \'$1 == \"{contig_id}\" && $2 >= {contig_start} && $2 <= {contig_end}\'"
+        return f"awk \'$1 == \"{contig_id}\" && $2 >= {contig_start} && $2 <= {contig_end}\'"
     if flag == "species":
-        filter_cmd = f"tail -n +2"
+        return f"tail -n +2"
+    if flag == "regions":
+        regions_fp = proc_args[5]
+        return f"awk -v regions={regions_fp} \'{REGIONS_FILTER_AWK}\'"
+    assert False, f"Unknown sample slice {flag}"
 
-    # Output column indices
-    c_A, c_C, c_G, c_T, c_count_samples, c_scA, c_scC, c_scG, c_scT = range(9)
 
+def iter_sample_sites(proc_args):
+    """ Stream one sample's slice of pileup, apply the per-sample site filters,
+    and yield the (site_id, A, C, G, T) of the sites passing them """
+
+    global global_args
+
+    snps_pileup_path, genome_coverage = proc_args[2], proc_args[4]
     curr_schema = snps_pileup_schema if global_args.advanced else snps_pileup_basic_schema
 
-    with InputStream(snps_pileup_path, filter_cmd) as stream:
+    with InputStream(snps_pileup_path, sample_sites_filter(proc_args)) as stream:
         for row in select_from_tsv(stream, schema=curr_schema, selected_columns=snps_pileup_basic_schema, result_structure=dict):
             # Unpack frequently accessed columns
             ref_id, ref_pos, ref_allele = row["ref_id"], row["ref_pos"], row["ref_allele"]
@@ -396,44 +608,135 @@ def accumulate(accumulator, proc_args):
             if site_ratio > global_args.site_ratio:
                 continue
 
-            # Compute derived columns
-            site_id = f"{ref_id}|{ref_pos}|{ref_allele}"
-
-            # Sample counts for A, C, G, T
-            sc_ACGT = [0, 0, 0, 0]
-            for i, nt_count in enumerate((A, C, G, T)):
-                if nt_count > 0: # presence or absence
-                    sc_ACGT[i] = 1
-
-            # Aggragate
-            acc = accumulator.get(site_id)
-            if acc:
-                acc[c_A] += A
-                acc[c_C] += C
-                acc[c_G] += G
-                acc[c_T] += T
-                acc[c_count_samples] += 1
-                acc[c_scA] += sc_ACGT[0]
-                acc[c_scC] += sc_ACGT[1]
-                acc[c_scG] += sc_ACGT[2]
-                acc[c_scT] += sc_ACGT[3]
-            else:
-                # Initialize each sample_index column with 0,0,0,0, particularly
-                # for <site, sample> pair either absent or fail the site filters
-                acc = [A, C, G, T, 1, sc_ACGT[0], sc_ACGT[1], sc_ACGT[2], sc_ACGT[3]] + ([acgt_string(0, 0, 0, 0)] * total_samples_count)
-                accumulator[site_id] = acc
+            yield f"{ref_id}|{ref_pos}|{ref_allele}", A, C, G, T
+
+        stream.ignore_errors()
+
 
-            # This just remember the value from each sample.
-            # Under sparse mode, site with zero read counts are not kept.
-            acgt_str = acgt_string(A, C, G, T)
-            assert acc[9 + sample_index] == '0,0,0,0' and acgt_str != '0,0,0,0', f"accumulate error::{site_id}:{acc}:{sample_index}:{acgt_str}"
-            acc[9 + sample_index] = acgt_str
+def read_sample_sites(proc_args):
+    """ Read one sample's slice of pileup at once with the pandas parser, and apply the same per-sample
+    site filters as iter_sample_sites on the columns.  Returns the frame of the sites passing them,
+    with their (ref_id, ref_pos, ref_allele) and filtered count_a, count_c, count_g, count_t. """
 
+    global global_args
+
+    snps_pileup_path, genome_coverage = proc_args[2], proc_args[4]
+    curr_schema = snps_pileup_schema if global_args.advanced else snps_pileup_basic_schema
+    dtype = {"ref_id": object, "ref_pos": np.int64, "ref_allele": object, "count_a": np.int64, "count_c": np.int64, "count_g": np.int64, "count_t": np.int64}
+
+    with InputStream(snps_pileup_path, sample_sites_filter(proc_args), binary=True) as stream:
+        data = stream.read()
         stream.ignore_errors()
+    if not data:
+        return pd.DataFrame({col: pd.Series(dtype=col_type) for col, col_type in dtype.items()})
+    sites = pd.read_csv(io.BytesIO(data), sep="\t", header=None, names=list(curr_schema.keys()), usecols=list(dtype.keys()), dtype=dtype, na_filter=False, engine="c")
+    del data
+
+    # Only consider allele with more than 2 reads
+    counts = sites[["count_a", "count_c", "count_g", "count_t"]].to_numpy()
+    counts[counts <= 2] = 0
+    depth = counts.sum(axis=1)
+    keep = (depth >= global_args.site_depth) & (depth / genome_coverage <= global_args.site_ratio)
+
+    sites = sites[["ref_id", "ref_pos", "ref_allele"]][keep]
+    for ci, col in enumerate(("count_a", "count_c", "count_g", "count_t")):
+        sites[col] = counts[keep, ci]
+    return sites.reset_index(drop=True)
+
+
+def iter_read_sites(sites):
+    """ Yield the (site_id, A, C, G, T) of a frame from read_sample_sites """
+    columns = [sites[col].tolist() for col in ("ref_id", "ref_pos", "ref_allele", "count_a", "count_c", "count_g", "count_t")]
+    for ref_id, ref_pos, ref_allele, A, C, G, T in zip(*columns):
+        yield f"{ref_id}|{ref_pos}|{ref_allele}", A, C, G, T
+
+
+def prefetch_samples(list_of_proc_args, prefetch, max_bytes):
+    """ Yield (proc_args, sites) in order.  Without prefetch, each sample's slice is streamed.
+
+    Otherwise the slices of up to `prefetch` upcoming samples are read and parsed on background threads,
+    where the decompression and filter commands and the pandas parser run outside of the GIL.  Every
+    slice not yet accumulated counts against max_bytes, including those still being read, which are
+    charged the size of the largest slice parsed so far.  Until a first slice is parsed, only the
+    next one is read ahead. """
+
+    if prefetch <= 0:
+        for proc_args in list_of_proc_args:
+            yield proc_args, iter_sample_sites(proc_args)
+        return
+
+    largest_bytes = 0
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque()
+        next_index = 0
+        while next_index < len(list_of_proc_args) or pending:
+            while next_index < len(list_of_proc_args) and len(pending) < prefetch + 1:
+                if pending:
+                    parsed_bytes = [int(future.result().memory_usage(index=False).sum()) for _, future in pending if future.done()]
+                    largest_bytes = max([largest_bytes] + parsed_bytes)
+                    pending_bytes = sum(parsed_bytes) + (len(pending) - len(parsed_bytes)) * largest_bytes
+                    if not largest_bytes or pending_bytes + largest_bytes > max_bytes:
+                        break
+                proc_args = list_of_proc_args[next_index]
+                pending.append((proc_args, executor.submit(read_sample_sites, proc_args)))
+                next_index += 1
+            proc_args, future = pending.popleft()
+            yield proc_args, iter_read_sites(future.result())
+
+
+def accumulate_samples(list_of_proc_args):
+    global global_args
+    accumulator = dict()
+    max_bytes = global_args.prefetch_memory * 1024 ** 3
+    for proc_args, sites in prefetch_samples(list_of_proc_args, global_args.prefetch_samples, max_bytes):
+        accumulate(accumulator, proc_args, sites)
+    return accumulator
+
+
+def accumulate(accumulator, proc_args, sites):
+    """ Accumulate read_counts and sample_counts for a chunk of sites for one sample,
+    at the same time remember <site, sample>'s A, C, G, T read counts."""
+
+    sample_index, total_samples_count = proc_args[1], proc_args[3]
+
+    # Output column indices
+    c_A, c_C, c_G, c_T, c_count_samples, c_scA, c_scC, c_scG, c_scT = range(9)
+
+    for site_id, A, C, G, T in sites:
+        # Sample counts for A, C, G, T
+        sc_ACGT = [0, 0, 0, 0]
+        for i, nt_count in enumerate((A, C, G, T)):
+            if nt_count > 0: # presence or absence
+                sc_ACGT[i] = 1
+
+        # Aggragate
+        acc = accumulator.get(site_id)
+        if acc:
+            acc[c_A] += A
+            acc[c_C] += C
+            acc[c_G] += G
+            acc[c_T] += T
+            acc[c_count_samples] += 1
+            acc[c_scA] += sc_ACGT[0]
+            acc[c_scC] += sc_ACGT[1]
+            acc[c_scG] += sc_ACGT[2]
+            acc[c_scT] += sc_ACGT[3]
+        else:
+            # Initialize each sample_index column with 0,0,0,0, particularly
+            # for <site, sample> pair either absent or fail the site filters
+            acc = [A, C, G, T, 1, sc_ACGT[0], sc_ACGT[1], sc_ACGT[2], sc_ACGT[3]] + ([acgt_string(0, 0, 0, 0)] * total_samples_count)
+            accumulator[site_id] = acc
+
+        # This just remember the value from each sample.
+        # Under sparse mode, site with zero read counts are not kept.
+        acgt_str = acgt_string(A, C, G, T)
+        assert acc[9 + sample_index] == '0,0,0,0' and acgt_str != '0,0,0,0', f"accumulate error::{site_id}:{acc}:{sample_index}:{acgt_str}"
+        acc[9 + sample_index] = acgt_str
 
 
 def call_population_snps(accumulator, species_id):
-    """ For each site, compute the pooled-major-alleles, site_depth, and vector of sample_depths and sample_minor_allele_freq"""
+    """ For each site, compute the pooled-major-alleles, site_depth, and vector of sample_depths and sample_minor_allele_freq.
+    Called sites are yielded one at a time, so that the writer decides how many rows are held in memory. """
 
     global global_args
     global dict_of_species
@@ -445,12 +748,6 @@ def call_population_snps(accumulator, species_id):
     genes_sequence = scan_fasta(sp.gene_seq_fp)
     genes_boundary = compute_gene_boundary(genes_feature)
 
-    pooled_snps_dict = {
-        "info": {},
-        "freq": {},
-        "depth": {},
-    }
-
     for site_id, site_info in accumulator.items():
         # Compute across-all-samples major allele for one genomic site
         rcA, rcC, rcG, rcT, count_samples, scA, scC, scG, scT = site_info[:9]
@@ -511,7 +808,7 @@ def call_population_snps(accumulator, species_id):
         site_type = annots[2] if len(annots) > 2 else None
         amino_acids = annots[3] if len(annots) > 2 else None
 
-        pooled_snps_dict["info"][site_id] = {
+        site_record = {
             "site_id": site_id,
             "major_allele": major_allele,
             "minor_allele": minor_allele,
@@ -524,84 +821,243 @@ def call_population_snps(accumulator, species_id):
             "site_type": site_type,
             "amino_acids": amino_acids
         }
-        pooled_snps_dict["freq"][site_id] = [site_id] + sample_mafs
-        pooled_snps_dict["depth"][site_id] = [site_id] + sample_depths
-
-    return pooled_snps_dict
+        yield site_record, sample_mafs, sample_depths
 
 
-def write_population_snps(pooled_snps_dict, species_id, chunk_id):
+class PopulationSnpsWriter:
+    """
+    Write called sites into the snps_info, snps_freq and snps_depth files of one <species, chunk>.
 
-    global pool_of_samples
+    Formatted rows are buffered and flushed to the three OutputStreams in fixed-size row groups,
+    so the memory footprint is bounded by row_group_size x samples_count instead of the chunk size.
+    Header lines are only written for species level (chunk_id == -2) files.
+    """
 
-    if chunk_id == -2:
-        # species
+    def __init__(self, species_id, chunk_id, row_group_size, binary_matrices=False):
+        global pool_of_samples
         global dict_of_species
-        samples_names = dict_of_species[species_id].fetch_samples_names()
-        snps_info_fp = pool_of_samples.get_target_layout("snps_info", species_id)
-        snps_freq_fp = pool_of_samples.get_target_layout("snps_freq", species_id)
-        snps_depth_fp = pool_of_samples.get_target_layout("snps_depth", species_id)
-    else:
-        # chunk
-        snps_info_fp = pool_of_samples.get_target_layout("snps_info_by_chunk", species_id, chunk_id)
-        snps_freq_fp = pool_of_samples.get_target_layout("snps_freq_by_chunk", species_id, chunk_id)
-        snps_depth_fp = pool_of_samples.get_target_layout("snps_depth_by_chunk", species_id, chunk_id)
 
-    with OutputStream(snps_info_fp) as stream:
-        if chunk_id == -2:
-            stream.write("\t".join(list(snps_info_schema.keys())) + "\n")
-        for line in pooled_snps_dict["info"].values():
-            stream.write("\t".join(map(format_data, line.values())) + "\n")
+        assert row_group_size > 0, f"row_group_size must be positive: {row_group_size}"
 
-    with OutputStream(snps_freq_fp) as stream:
-        if chunk_id == -2:
-            stream.write("site_id\t" + "\t".join(samples_names) + "\n")
-        for line in pooled_snps_dict["freq"].values():
-            stream.write("\t".join(map(format_data, line)) + "\n")
+        self.species_id = species_id
+        self.chunk_id = chunk_id
+        self.row_group_size = row_group_size
+        self.rows_count = 0
 
-    with OutputStream(snps_depth_fp) as stream:
         if chunk_id == -2:
-            stream.write("site_id\t" + "\t".join(samples_names) + "\n")
-        for line in pooled_snps_dict["depth"].values():
-            stream.write("\t".join(map(str, line)) + "\n")
+            self.paths = {
+                "info": pool_of_samples.get_target_layout("snps_info", species_id),
+                "freq": pool_of_samples.get_target_layout("snps_freq", species_id),
+                "depth": pool_of_samples.get_target_layout("snps_depth", species_id),
+            }
+            samples_names = dict_of_species[species_id].fetch_samples_names()
+            self.headers = {
+                "info": "\t".join(list(snps_info_schema.keys())) + "\n",
+                "freq": "site_id\t" + "\t".join(samples_names) + "\n",
+                "depth": "site_id\t" + "\t".join(samples_names) + "\n",
+            }
+        else:
+            self.paths = {
+                "info": pool_of_samples.get_target_layout("snps_info_by_chunk", species_id, chunk_id),
+                "freq": pool_of_samples.get_target_layout("snps_freq_by_chunk", species_id, chunk_id),
+                "depth": pool_of_samples.get_target_layout("snps_depth_by_chunk", species_id, chunk_id),
+            }
+            self.headers = dict()
+
+        # Under binary_matrices, freq and depth rows go to the snps_matrix row groups instead of TSV
+        self.matrix_writer = None
+        if binary_matrices:
+            del self.paths["freq"]
+            del self.paths["depth"]
+            matrix_dir = pool_of_samples.get_target_layout("snps_matrix", species_id)
+            self.matrix_writer = SnpsMatrixWriter(matrix_dir, snps_matrix_prefix(chunk_id))
+
+        self.row_group = {"info": [], "freq": [], "depth": [], "sites": []}
+        self.streams = dict()
+        self.exit_stack = None
+
+    def __enter__(self):
+        self.exit_stack = ExitStack()
+        for key, path in self.paths.items():
+            self.streams[key] = self.exit_stack.enter_context(OutputStream(path))
+            if key in self.headers:
+                self.streams[key].write(self.headers[key])
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        if etype is None:
+            self.flush()
+            if self.matrix_writer:
+                self.matrix_writer.close()
+        return self.exit_stack.__exit__(etype, evalue, etraceback)
+
+    def write(self, site_record, sample_mafs, sample_depths):
+        site_id = site_record["site_id"]
+        self.row_group["info"].append("\t".join(map(format_data, site_record.values())) + "\n")
+        if self.matrix_writer:
+            self.row_group["sites"].append(site_record)
+            self.row_group["freq"].append(sample_mafs)
+            self.row_group["depth"].append(sample_depths)
+        else:
+            self.row_group["freq"].append(site_id + "\t" + "\t".join(map(format_data, sample_mafs)) + "\n")
+            self.row_group["depth"].append(site_id + "\t" + "\t".join(map(str, sample_depths)) + "\n")
+        if len(self.row_group["info"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        for key, stream in self.streams.items():
+            if self.row_group[key]:
+                stream.write("".join(self.row_group[key]))
+        if self.matrix_writer:
+            sites = self.row_group["sites"]
+            self.matrix_writer.write_row_group([r["site_id"] for r in sites], [r["major_allele"] for r in sites], [r["minor_allele"] for r in sites], \
+                                               self.row_group["freq"], self.row_group["depth"])
+        self.rows_count += len(self.row_group["info"])
+        self.row_group = {"info": [], "freq": [], "depth": [], "sites": []}
+
+
+def snps_matrix_prefix(chunk_id):
+    return "species" if chunk_id == -2 else f"cid.{chunk_id}"
+
+
+def write_population_snps(called_sites, species_id, chunk_id):
+    global global_args
+    with PopulationSnpsWriter(species_id, chunk_id, global_args.row_group_size, global_args.binary_matrices) as writer:
+        for site_record, sample_mafs, sample_depths in called_sites:
+            writer.write(site_record, sample_mafs, sample_depths)
+
+    if global_args.binary_matrices and chunk_id == -2:
+        collect_snps_matrix(species_id, [snps_matrix_prefix(chunk_id)])
+    return writer.rows_count
+
+
+def collect_snps_matrix(species_id, prefixes):
+    global global_args
+    global dict_of_species
+    global pool_of_samples
+    matrix_dir = pool_of_samples.get_target_layout("snps_matrix", species_id)
+    samples_names = dict_of_species[species_id].fetch_samples_names()
+    finalize_snps_matrix(matrix_dir, species_id, samples_names, prefixes, global_args.debug)
 
 
-def collect_chunks(species_id):
+def collect_chunks(species_id, chunks_in_order=None):
+    """ Append the chunks outputs to the species files, in chunk order, as they complete """
 
     global global_args
     global dict_of_species
     global pool_of_samples
+    global semaphore_for_species
+    global status_of_chunks
 
     sp = dict_of_species[species_id]
     number_of_chunks = sp.num_of_snps_chunks
     samples_names = dict_of_species[species_id].fetch_samples_names()
 
-    loc_snps_info = [pool_of_samples.get_target_layout("snps_info_by_chunk", species_id, chunk_id) for chunk_id in range(0, number_of_chunks)]
-    species_snps_info_fp = pool_of_samples.get_target_layout("snps_info", species_id)
-    with OutputStream(species_snps_info_fp) as stream:
-        stream.write("\t".join(list(snps_info_schema.keys())) + "\n")
-    cat_files(loc_snps_info, species_snps_info_fp, 10)
+    list_of_outputs = [("snps_info", "\t".join(list(snps_info_schema.keys())) + "\n")]
+    if not global_args.binary_matrices:
+        list_of_outputs.append(("snps_freq", "site_id\t" + "\t".join(samples_names) + "\n"))
+        list_of_outputs.append(("snps_depth", "site_id\t" + "\t".join(samples_names) + "\n"))
+
+    with ExitStack() as exit_stack:
+        list_of_concats = []
+        for filename, header in list_of_outputs:
+            species_fp = pool_of_samples.get_target_layout(filename, species_id)
+            list_of_concats.append((f"{filename}_by_chunk", exit_stack.enter_context(FrameConcatenator(species_fp, header))))
+
+        if chunks_in_order is None:
+            chunks_in_order = wait_for_chunks_in_order(semaphore_for_species[species_id], status_of_chunks[species_id])
+        for chunk_id in chunks_in_order:
+            for chunk_filename, concat in list_of_concats:
+                chunk_fp = pool_of_samples.get_target_layout(chunk_filename, species_id, chunk_id)
+                concat.append(chunk_fp)
+                if not global_args.debug:
+                    command(f"rm -rf {chunk_fp}", quiet=True)
+
+    if global_args.binary_matrices:
+        collect_snps_matrix(species_id, [snps_matrix_prefix(chunk_id) for chunk_id in range(0, number_of_chunks)])
+    return True
+
+
+def queue_task_id(species_id, chunk_id):
+    return f"{species_id}-{chunk_id}"
 
-    loc_snps_freq = [pool_of_samples.get_target_layout("snps_freq_by_chunk", species_id, chunk_id) for chunk_id in range(0, number_of_chunks)]
-    species_snps_freq_fp = pool_of_samples.get_target_layout("snps_freq", species_id)
-    with OutputStream(species_snps_freq_fp) as stream:
-        stream.write("site_id\t" + "\t".join(samples_names) + "\n")
-    cat_files(loc_snps_freq, species_snps_freq_fp, 10)
 
-    loc_snps_depth = [pool_of_samples.get_target_layout("snps_depth_by_chunk", species_id, chunk_id) for chunk_id in range(0, number_of_chunks)]
-    species_snps_depth = pool_of_samples.get_target_layout("snps_depth", species_id)
-    with OutputStream(species_snps_depth) as stream:
-        stream.write("site_id\t" + "\t".join(samples_names) + "\n")
-    cat_files(loc_snps_depth, species_snps_depth, 10)
+def plan_work_queue(arguments_list):
+    """ Write every chunk (and whole species) task into the work queue, the collectors are left to the finalizer """
+    global global_args
+    global pool_of_samples
+    global dict_of_species
+    global dict_of_site_chunks
+
+    queue = WorkQueue(global_args.work_queue)
+    tasks = [(queue_task_id(species_id, chunk_id), (species_id, chunk_id)) for species_id, chunk_id in arguments_list if chunk_id != -1]
+    queue.plan(tasks, (global_args, pool_of_samples, dict_of_species, dict(dict_of_site_chunks)))
+    return queue
+
+
+def process_task(payload):
+    species_id, chunk_id = payload
+    assert process((species_id, chunk_id)) == "worked"
+
+
+def finalize_species(packed_args):
+    global dict_of_species
+    species_id, queue = packed_args
+    sp = dict_of_species[species_id]
+    if sp.num_of_snps_chunks is None:
+        # whole species task writes the species outputs directly
+        list(queue.wait_for_tasks([queue_task_id(species_id, -2)]))
+    else:
+        tsprint(f"  MIDAS2::finalize_species::{species_id}::start collect_chunks")
+        task_ids = [queue_task_id(species_id, chunk_id) for chunk_id in range(sp.num_of_snps_chunks)]
+        collect_chunks(species_id, queue.wait_for_tasks(task_ids))
+        tsprint(f"  MIDAS2::finalize_species::{species_id}::finish collect_chunks")
+    return "worked"
+
+
+def finalize_work_queue(queue):
+    global global_args
+    global dict_of_species
+    global pool_of_samples
+
+    tsprint(f"MIDAS2::finalize_work_queue::start")
+    proc_flags = multithreading_map(finalize_species, [(species_id, queue) for species_id in dict_of_species.keys()], min(global_args.num_cores, 16))
+    assert all(s == "worked" for s in proc_flags), f"Error: some species failed"
+    tsprint(f"MIDAS2::finalize_work_queue::finish")
 
     if not global_args.debug:
-        for s_file in loc_snps_info + loc_snps_freq + loc_snps_depth:
-            command(f"rm -rf {s_file}", quiet=True)
-    return True
+        pool_of_samples.remove_dirs(["tempdir"])
+
+
+def join_work_queue(args):
+    """ Workers and finalizer restore the planner state from the work queue """
+    global global_args
+    global pool_of_samples
+    global dict_of_species
+    global dict_of_site_chunks
+    global semaphore_for_species
+    global status_of_chunks
+
+    queue = WorkQueue(args.work_queue)
+    tsprint(f"MIDAS2::join_work_queue::{args.queue_role} wait for the plan in {args.work_queue}")
+    global_args, pool_of_samples, dict_of_species, dict_of_site_chunks = queue.load_state()
+    global_args.queue_role = args.queue_role
+    # chunks are tracked by the queue instead of the semaphores
+    semaphore_for_species = dict()
+    status_of_chunks = dict()
+
+    if args.queue_role == "work":
+        queue.work(process_task)
+    if args.queue_role == "finalize":
+        finalize_work_queue(queue)
 
 
 def merge_snps(args):
 
+    if args.work_queue and args.queue_role != "plan":
+        join_work_queue(args)
+        return
+
     try:
         global global_args
         global_args = args
@@ -609,18 +1065,29 @@ def merge_snps(args):
         global pool_of_samples
         global dict_of_species
 
+        if args.work_queue:
+            absolute_paths(args, ["samples_list", "midas_outdir", "midasdb_dir", "work_queue"], ["species_list", "regions"])
+
         pool_of_samples = SamplePool(args.samples_list, args.midas_outdir, "snps")
         assert pool_of_samples.samples, f"No samples in the provided samples_list"
+        if args.work_queue:
+            absolute_samples_paths(pool_of_samples)
 
         dict_of_species = pool_of_samples.select_species("snps", args)
+        midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name, min(args.num_cores, max(len(dict_of_species), 1)))
+        if args.regions:
+            dict_of_species = select_species_by_regions(dict_of_species, midas_db, args.regions)
         species_ids_of_interest = [sp.id for sp in dict_of_species.values()]
-        assert species_ids_of_interest, f"No (specified) species pass the genome_coverage filter across samples, please adjust the genome_coverage or species_list"
+        assert species_ids_of_interest, f"No (specified) species pass the genome_coverage filter across samples{' with regions of interest' if args.regions else ''}, please adjust the genome_coverage, species_list or regions"
         species_count = len(species_ids_of_interest)
         tsprint(f"{species_count} species pass the filter")
 
         pool_of_samples.create_dirs(["outdir", "tempdir"], args.debug)
         pool_of_samples.create_species_subdirs(species_ids_of_interest, "outdir", args.debug, quiet=True)
         pool_of_samples.create_species_subdirs(species_ids_of_interest, "tempdir", args.debug, quiet=True)
+        if args.binary_matrices:
+            for species_id in species_ids_of_interest:
+                command(f"mkdir -p {pool_of_samples.get_target_layout('snps_matrix', species_id)}", quiet=True)
 
         with OutputStream(pool_of_samples.get_target_layout("snps_log")) as stream:
             stream.write(f"Across samples population SNV calling in subcommand {args.subcommand} with args\n{json.dumps(args_string(args), indent=4)}\n")
@@ -630,17 +1097,36 @@ def merge_snps(args):
         tsprint(f"MIDAS2::write_species_summary::finish")
 
         # Download representative genomes for every species into midas_db
-        num_cores_download = min(args.num_cores, len(species_ids_of_interest))
-        midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name, num_cores_download)
-
         # The unit of compute across-samples pop SNPs is: chunk_of_sites.
         tsprint(f"MIDAS2::design_chunks::start")
         midas_db.fetch_files("repgenome", species_ids_of_interest)
+        # Covered intervals of each <species, sample> from run_snps, used to skip empty chunk visits
+        if args.max_memory:
+            for sp in dict_of_species.values():
+                sp.get_genome_length(midas_db)
+        multithreading_map(fetch_samples_coverage, list(dict_of_species.values()), min(args.num_cores, 16))
+
+        num_workers = args.num_cores
+        if args.max_memory:
+            prefetch_memory = args.prefetch_memory if args.prefetch_samples > 0 else 0
+            num_workers, plan_str = plan_chunks(list(dict_of_species.values()), midas_db, args.max_memory, args.num_cores, args.row_group_size, prefetch_memory)
+            with open(pool_of_samples.get_target_layout("snps_log"), "a") as stream:
+                stream.write(f"Chunk plan for {num_workers} workers within {args.max_memory}GB\n{plan_str}\n")
         arguments_list = design_chunks(species_ids_of_interest, midas_db)
         tsprint(f"MIDAS2::design_chunks::finish")
 
+        if args.work_queue:
+            queue = plan_work_queue(arguments_list)
+            if args.local_workers > 0:
+                list_of_workers = queue.spawn_local_workers(args.local_workers)
+                finalize_work_queue(queue)
+                wait_for_local_workers(list_of_workers)
+            else:
+                tsprint(f"MIDAS2::plan_work_queue::start workers and the finalizer with --work_queue {args.work_queue} --queue_role work|finalize")
+            return
+
         tsprint(f"MIDAS2::multiprocessing_map::start")
-        proc_flags = multiprocessing_map(process, arguments_list, args.num_cores)
+        proc_flags = multiprocessing_map(process, arguments_list, num_workers)
         assert all(s == "worked" for s in proc_flags), f"Error: some chunks failed"
         tsprint(f"MIDAS2::multiprocessing_map::finish")
 
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 import json
-from collections import defaultdict
 import numpy as np
 
 from midas.models.samplepool import SamplePool
 from midas.common.argparser import add_subcommand
 from midas.common.utils import tsprint, OutputStream, args_string
-from midas.params.schemas import species_profile_schema, species_prevalence_schema, format_data
+from midas.params.schemas import species_profile_schema, species_prevalence_schema, format_data, DECIMALS3
 
 
 DEFAULT_MARKER_COVERAGE = 1.0
@@ -31,40 +30,48 @@ def register_args(main_func):
     return main_func
 
 
-def compute_prevalence(rowvector, threshold):
-    return sum(1 if val >= threshold else 0 for val in rowvector) #<----
+def compute_prevalence(matrix, threshold):
+    """ Number of samples with value >= threshold, for each row of matrix """
+    return np.count_nonzero(matrix >= threshold, axis=1)
 
 
-def transpose(pool_of_samples, columns):
-    """ Collect given columns across samples and transpose the matrix by species_id """
-    transposed = defaultdict(dict)
-    total_samples_count = len(pool_of_samples.samples)
+def build_species_matrices(pool_of_samples, columns):
+    """
+    Collect given columns across samples into dense species x samples matrices.
+    Species are indexed in order of first appearance across samples, missing <species, sample> are 0.
+    Returns the species ids, the presence mask and the matrix of each column.
+    """
+    species_index = {}
+    list_of_rows = []
+    for sample in pool_of_samples.samples:
+        list_of_rows.append([species_index.setdefault(species_id, len(species_index)) for species_id in sample.profile])
 
-    for sample_index, sample in enumerate(pool_of_samples.samples):
-        for species_id, species_record in sample.profile.items():
-            for col in columns:
-                acc = transposed[col].get(species_id)
-                if not acc:
-                    acc = [species_id] + [0.0] * total_samples_count
-                    transposed[col][species_id] = acc
-                acc[1 + sample_index] = species_record[col]
-    return transposed
+    species_count = len(species_index)
+    samples_count = len(pool_of_samples.samples)
+    rows = np.fromiter((ri for sample_rows in list_of_rows for ri in sample_rows), dtype=np.int64)
+    cols = np.repeat(np.arange(samples_count), [len(sample_rows) for sample_rows in list_of_rows])
 
+    present = np.zeros((species_count, samples_count), dtype=bool)
+    present[rows, cols] = True
+    matrices = {}
+    for col in columns:
+        dtype = np.int64 if species_profile_schema[col] == int else np.float64
+        values = np.fromiter((record[col] for sample in pool_of_samples.samples for record in sample.profile.values()), dtype=dtype, count=len(rows))
+        matrices[col] = np.zeros((species_count, samples_count), dtype=dtype)
+        matrices[col][rows, cols] = values
+    return list(species_index.keys()), present, matrices
 
-def compute_stats(tabundance, tcoverage):
+
+def compute_stats(species_ids, abundance, coverage):
     global global_args
     args = global_args
 
-    assert tabundance.keys() == tcoverage.keys(), f"compute_and_write_stats::merged abun and cov matrices have different species_id orders"
-    species_ids = tabundance.keys()
-    stats = defaultdict()
-    for species_id in species_ids:
-        species_abun = tabundance[species_id][1:]
-        species_cov = tcoverage[species_id][1:]
-        values = [species_id, np.median(species_abun), np.mean(species_abun), \
-              np.median(species_cov), np.mean(species_cov), compute_prevalence(species_cov, args.min_cov)]
-        stats[species_id] = values
-    return stats
+    assert abundance.shape == coverage.shape == (len(species_ids), abundance.shape[1]), f"compute_and_write_stats::merged abun and cov matrices have different shapes"
+    columns = [species_ids,
+               np.median(abundance, axis=1).tolist(), np.mean(abundance, axis=1).tolist(),
+               np.median(coverage, axis=1).tolist(), np.mean(coverage, axis=1).tolist(),
+               compute_prevalence(coverage, args.min_cov).tolist()]
+    return {row[0]: list(row) for row in zip(*columns)}
 
 
 def write_stats(stats, species_prevalence_filepath, sort_by="median_coverage"):
@@ -81,17 +88,26 @@ def write_stats(stats, species_prevalence_filepath, sort_by="median_coverage"):
             ostream.write("\t".join(map(format_data, stats[species_id])) + "\n")
 
 
-def write_species_results(pool_of_samples, transposed):
-    """ Write the transposed tables into separate files """
+def format_matrix(matrix, present):
+    """ Format the cells of a species x samples matrix as format_data would: missing cells were 0.0 """
+    formatted = np.char.mod(f"%{DECIMALS3}", matrix.astype(np.float64))
+    if matrix.dtype.kind == "i":
+        formatted = np.where(present, matrix.astype(str), formatted)
+    return formatted
+
+
+def write_species_results(pool_of_samples, species_ids, present, matrices):
+    """ Write the species x samples matrices into separate files """
     sample_names = pool_of_samples.fetch_samples_names()
     col_names = list(species_profile_schema.keys())[1:]
 
     for col in col_names:
         outpath = pool_of_samples.get_target_layout(f"species_{col}")
+        formatted = format_matrix(matrices[col], present)
         with OutputStream(outpath) as outfile:
             outfile.write("\t".join(["species_id"] + sample_names) + "\n")
-            for values in transposed[col].values():
-                outfile.write("\t".join(map(format_data, values)) + "\n")
+            for species_id, values in zip(species_ids, formatted.tolist()):
+                outfile.write(species_id + "\t" + "\t".join(values) + "\n")
 
 
 def merge_species(args):
@@ -108,16 +124,16 @@ def merge_species(args):
         with OutputStream(pool_of_samples.get_target_layout("species_log")) as stream:
             stream.write(f"Across samples abundant species merging in subcommand {args.subcommand} with args\n{json.dumps(args_string(args), indent=4)}\n")
 
-        # Slice the across-samples species profile matrix by species_id
+        # Collect the across-samples species profile into species x samples matrices
         tsprint(f"MIDAS2::write_species_results::start")
         cols = list(species_profile_schema.keys())[1:]
-        transposed = transpose(pool_of_samples, cols)
-        write_species_results(pool_of_samples, transposed)
+        species_ids, present, matrices = build_species_matrices(pool_of_samples, cols)
+        write_species_results(pool_of_samples, species_ids, present, matrices)
         tsprint(f"MIDAS2::write_species_results::finish")
 
         # Calculate summary statistics for coverage and relative abundance
         tsprint(f"MIDAS2::write_stats::start")
-        stats = compute_stats(transposed["marker_relative_abundance"], transposed["median_marker_coverage"]) #<--
+        stats = compute_stats(species_ids, matrices["marker_relative_abundance"], matrices["median_marker_coverage"])
         write_stats(stats, pool_of_samples.get_target_layout("species_prevalence"), "median_coverage")
         tsprint(f"MIDAS2::write_stats::finish")
 
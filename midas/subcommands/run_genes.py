@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import json
 import os
-from math import ceil
+import heapq
 from collections import defaultdict
 from itertools import repeat
 import numpy as np
@@ -10,11 +10,12 @@ from pysam import AlignmentFile  # pylint: disable=no-name-in-module
 from midas.common.argparser import add_subcommand
 from midas.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, multiprocessing_map, args_string, command, multithreading_map
 from midas.common.utilities import extract_genomeid
+from midas.common.kmers import reference_kmers, assign_reads, iter_sequence_blocks, max_hash_for
 from midas.models.midasdb import MIDAS_DB
 from midas.models.sample import Sample
 from midas.models.species import Species, parse_species
 from midas.params.schemas import genes_summary_schema, fetch_genes_depth_schema, format_data, DECIMALS6, fetch_genes_chunk_schema
-from midas.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, samtools_idxstats, bowtie2_index_exists, _keep_read
+from midas.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, samtools_idxstats, bowtie2_index_exists, load_bowtie2_refs, _keep_read
 from midas.params.inputs import MIDASDB_NAMES
 
 
@@ -31,6 +32,17 @@ DEFAULT_NUM_CORES = 8
 DEFAULT_PRUNE_CUTOFF = 0.4
 DEFAULT_CLUSTER_ID = '99'
 DEFAULT_MARKER_CUTOFF = 0.01
+DEFAULT_CHUNKS_PER_CORE = 4
+GENE_FETCH_COST = 8 # fixed cost of piling up one centroid, in mapped reads
+
+DEFAULT_KMER_SIZE = 31
+DEFAULT_KMER_SCALED = 10
+DEFAULT_KMER_MIN_HITS = 2
+
+# Same base counting as pysam count_coverage: only A/C/G/T read bases of quality >= 15 add to the depth
+MIN_BASE_QUALITY = 15
+ACGT_BASES = np.zeros(256, dtype=bool)
+ACGT_BASES[list(b"ACGT")] = True
 
 
 def register_args(main_func):
@@ -91,6 +103,31 @@ def register_args(main_func):
                            default=str(DEFAULT_MARKER_MEDIAN_DEPTH),
                            help=f"Comman separated correponsding cutoff to select_by (>XX) ({DEFAULT_MARKER_MEDIAN_DEPTH}, )")
 
+    subparser.add_argument('--quantifier',
+                           dest='quantifier',
+                           type=str,
+                           default='bowtie2',
+                           choices=['bowtie2', 'kmer'],
+                           help="Quantify the genes from bowtie2 alignments, or from the k-mers the reads share with the centroids, without alignment (bowtie2)")
+    subparser.add_argument('--kmer_size',
+                           dest='kmer_size',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_KMER_SIZE,
+                           help=f"--quantifier kmer: k-mer size ({DEFAULT_KMER_SIZE})")
+    subparser.add_argument('--kmer_scaled',
+                           dest='kmer_scaled',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_KMER_SCALED,
+                           help=f"--quantifier kmer: match one k-mer out of KMER_SCALED ({DEFAULT_KMER_SCALED})")
+    subparser.add_argument('--kmer_min_hits',
+                           dest='kmer_min_hits',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_KMER_MIN_HITS,
+                           help=f"--quantifier kmer: discard reads sharing < KMER_MIN_HITS sampled k-mers with their best centroid ({DEFAULT_KMER_MIN_HITS})")
+
     #  Alignment flags (Bowtie2, or postprocessing)
     subparser.add_argument('--aln_speed',
                            type=str,
@@ -266,12 +303,26 @@ def fetch_pruned_centroids(midas_db, species_id, prune_method, prune_cutoff, rem
 
 def _fetch_cxx_info(pargs):
     sp, midas_db, xx = pargs
-    for xx in set(["99", xx]):
+    sp.set_clusters_info_fp(midas_db, "99")
+    sp.get_clusters_index()
+    if xx != "99":
         sp.set_clusters_info_fp(midas_db, xx)
         sp.get_clusters_info(xx)
     return True
 
 
+def fetch_cxx_record(sp, c99_id, xx):
+    """ centroid_99 length, then centroid_xx id, length, genome prevalence and marker id of the cluster of c99_id """
+    clusters_index = sp.clusters_index
+    c99_row = clusters_index.row(c99_id)
+    c99_length = int(clusters_index.gene_length[c99_row])
+    cxx_id = clusters_index.centroid_id(c99_row, xx)
+    if xx == "99":
+        return c99_length, cxx_id, c99_length, float(clusters_index.genome_prevalence[c99_row]), clusters_index.marker_id[c99_row].decode()
+    cxx_info = sp.clusters_info[xx][cxx_id]
+    return c99_length, cxx_id, cxx_info[f"centroid_{xx}_gene_length"], cxx_info[f"centroid_{xx}_genome_prevalence"], cxx_info[f"centroid_{xx}_marker_id"]
+
+
 def prepare_species(species_to_analyze, midas_db):
     global dict_of_species
     global global_args
@@ -281,18 +332,116 @@ def prepare_species(species_to_analyze, midas_db):
     return True
 
 
-def fetch_genes_from_bam(idxstats_fp, midas_db, species_to_analyze):
-    """ Compute the genes present in the BAM file """
-    species_for_genome = midas_db.uhgg.genomes
+def fetch_genes_from_bam(idxstats_fp, pangenome_bamfile, bt2_db_prefix, midas_db, species_to_analyze):
+    """ Compute the genes present in the BAM file, and their number of mapped reads """
+    with InputStream(idxstats_fp) as stream:
+        list_of_genes = list(select_from_tsv(stream, schema={"gene_id": str, "mapped_reads": int, "ref_index": int}))
+
+    # Species of the genes by BAM reference id, from the index sidecar; else from the genome ids and the genomes TOC
+    with AlignmentFile(pangenome_bamfile) as bamfile:
+        refs = load_bowtie2_refs(bt2_db_prefix, bamfile.nreferences)
+    if refs is not None:
+        ref_indexes = np.array([ref_index for _, _, ref_index in list_of_genes], dtype=np.int64)
+        refs = refs[ref_indexes]
+        if not np.array_equal(refs["ref_id"], np.array([geneid for geneid, _, _ in list_of_genes], dtype=bytes)):
+            tsprint(f"{bt2_db_prefix}.refs.npy doesn't match the references of {pangenome_bamfile}, ignored")
+            refs = None
+    if refs is not None:
+        species_of_refs, species_codes = np.unique(refs["species_id"], return_inverse=True)
+        species_of_refs = [species_id.decode() for species_id in species_of_refs]
+        list_of_species = [species_of_refs[code] for code in species_codes.tolist()]
+    else:
+        species_for_genome = midas_db.uhgg.genomes
+        list_of_species = [species_for_genome[extract_genomeid(geneid)] for geneid, _, _ in list_of_genes]
+
     global readonly_bamgenes
     readonly_bamgenes = {}
-    with InputStream(idxstats_fp) as stream:
-        for _ in select_from_tsv(stream, schema={"gene_id": str}):
-            geneid = _[0]
-            speciesid = species_for_genome[extract_genomeid(geneid)]
-            if speciesid in species_to_analyze:
-                readonly_bamgenes[geneid] = speciesid
-    return True
+    genes_mapped_reads = {}
+    for (geneid, mapped_reads, _), speciesid in zip(list_of_genes, list_of_species):
+        if speciesid in species_to_analyze:
+            readonly_bamgenes[geneid] = speciesid
+            genes_mapped_reads[geneid] = mapped_reads
+    return genes_mapped_reads
+
+
+def design_chunks(genes_mapped_reads, number_of_chunks):
+    """
+    Pack the centroids into chunks of equal estimated work, in mapped reads: each centroid, heaviest first,
+    goes to the lightest chunk so far.  Returns [(estimated work, gene ids in BAM order)], heaviest chunk first.
+    """
+    gene_ids = list(genes_mapped_reads.keys())
+    weights = np.fromiter(genes_mapped_reads.values(), dtype=np.int64, count=len(gene_ids)) + GENE_FETCH_COST
+    number_of_chunks = min(number_of_chunks, len(gene_ids))
+
+    chunks_load = [0] * number_of_chunks
+    chunks_genes = [[] for _ in range(number_of_chunks)]
+    heap = [(0, chunk_index) for chunk_index in range(number_of_chunks)]
+    for gene_index in np.argsort(-weights, kind="stable").tolist():
+        load, chunk_index = heapq.heappop(heap)
+        load += int(weights[gene_index])
+        chunks_load[chunk_index] = load
+        chunks_genes[chunk_index].append(gene_index)
+        heapq.heappush(heap, (load, chunk_index))
+
+    chunks = [(load, [gene_ids[gene_index] for gene_index in sorted(genes)]) for load, genes in zip(chunks_load, chunks_genes)]
+    return sorted(chunks, key=lambda chunk: chunk[0], reverse=True)
+
+
+def pileup_gene(bamfile, c99_id, c99_length):
+    """ Aligned reads, mapped reads, covered bases and total depth of one centroid_99, in one pass over its alignments """
+    aligned_reads = 0
+    mapped_reads = 0
+    list_of_positions = []
+    for aln in bamfile.fetch(c99_id):
+        aligned_reads += 1
+        if not keep_read(aln):
+            continue
+        mapped_reads += 1
+        sequence = aln.query_sequence
+        qualities = aln.query_qualities
+        if sequence is None or qualities is None:
+            continue
+        pairs = np.array(aln.get_aligned_pairs(matches_only=True), dtype=np.int64).reshape(-1, 2)
+        qpos, refpos = pairs[:, 0], pairs[:, 1]
+        counted = (np.asarray(qualities, dtype=np.uint8)[qpos] >= MIN_BASE_QUALITY) & ACGT_BASES[np.frombuffer(sequence.encode(), dtype=np.uint8)[qpos]]
+        counted &= refpos < c99_length
+        list_of_positions.append(refpos[counted])
+
+    if not list_of_positions:
+        return aligned_reads, mapped_reads, 0, 0
+    positions = np.concatenate(list_of_positions)
+    covered_bases = int(np.count_nonzero(np.bincount(positions, minlength=c99_length)))
+    return aligned_reads, mapped_reads, covered_bases, len(positions)
+
+
+def add_gene_depth(cxx_values, species_id, cxx_record, c99_aligned_reads, c99_mapped_reads, c99_total_depth, xx):
+    """ Add the reads and depth of one centroid_99 to its centroid_xx, unless filtered out """
+    global global_args
+    c99_length, cxx_id, cxx_length, cxx_prevalence, cxx_marker_id = cxx_record
+    if c99_aligned_reads < global_args.total_depth or c99_mapped_reads < global_args.total_depth:
+        return
+    if c99_total_depth == 0: # Sparse by default.
+        return
+    c99_mean_depth = float(c99_total_depth / c99_length)
+
+    if cxx_id not in cxx_values:
+        cxx_values[cxx_id] = {
+            "species_id": species_id,
+            f"c{xx}_id": cxx_id,
+            f"c{xx}_length": cxx_length,
+            "aligned_reads": c99_aligned_reads,
+            "mapped_reads": c99_mapped_reads,
+            "total_depth": c99_total_depth,
+            "mean_depth": c99_mean_depth,
+            "copy_number": 0.0,
+            "genome_prevalence": cxx_prevalence,
+            "marker_id": cxx_marker_id,
+        }
+    else:
+        cxx_values[cxx_id]["aligned_reads"] += c99_aligned_reads
+        cxx_values[cxx_id]["mapped_reads"] += c99_mapped_reads
+        cxx_values[cxx_id]["total_depth"] += c99_total_depth
+        cxx_values[cxx_id]["mean_depth"] += c99_mean_depth
 
 
 def compute_pileup_per_chunk(pargs):
@@ -301,94 +450,159 @@ def compute_pileup_per_chunk(pargs):
     global dict_of_species
     global readonly_bamgenes
 
-    chunk_id, chunk_start, chunk_end, pangenome_bamfile, headerless_sliced_path, xx = pargs
+    chunk_id, chunk_geneids_list, pangenome_bamfile, headerless_sliced_path, xx = pargs
 
     if global_args.debug and os.path.exists(headerless_sliced_path):
         tsprint(f"Skipping compute pileup for chunk {chunk_id} in debug mode as temporary data exists: {headerless_sliced_path}")
-        return headerless_sliced_path
-
-    chunk_geneids_list = list(readonly_bamgenes.keys())[chunk_start:chunk_end]
+        depth_schema = fetch_genes_chunk_schema(xx)
+        with InputStream(headerless_sliced_path) as stream:
+            list_of_records = [dict(zip(depth_schema, r)) for r in select_from_tsv(stream, schema=depth_schema)]
+        return records_to_array(list_of_records, xx)
 
     cxx_values = defaultdict(dict)
     with AlignmentFile(pangenome_bamfile) as bamfile:
         # Competitive alignment is done on centroid_99 level.
         for c99_id in chunk_geneids_list:
-            c99_aligned_reads = bamfile.count(c99_id)
-            if c99_aligned_reads < global_args.total_depth:
-                continue
+            species_id = readonly_bamgenes[c99_id]
+            cxx_record = fetch_cxx_record(dict_of_species[species_id], c99_id, xx)
+            c99_aligned_reads, c99_mapped_reads, _, c99_total_depth = pileup_gene(bamfile, c99_id, cxx_record[0])
+            add_gene_depth(cxx_values, species_id, cxx_record, c99_aligned_reads, c99_mapped_reads, c99_total_depth, xx)
+
+    # Results go back to the parent in memory, the chunk files are only kept for debugging
+    if global_args.debug:
+        with OutputStream(headerless_sliced_path) as stream:
+            for rec in cxx_values.values():
+                stream.write("\t".join(map(format_data, rec.values(), repeat(DECIMALS6, len(rec)))) + "\n")
 
-            c99_mapped_reads = bamfile.count(c99_id, read_callback=keep_read)
-            if c99_mapped_reads < global_args.total_depth:
-                continue
+    return records_to_array(list(cxx_values.values()), xx)
 
-            species_id = readonly_bamgenes[c99_id]
-            sp = dict_of_species[species_id]
-
-            c99_info = sp.clusters_info['99']
-            cxx_info = sp.clusters_info[xx]
-
-            cxx_id = c99_info[c99_id][f"centroid_{xx}"]
-            c99_length = c99_info[c99_id]["centroid_99_gene_length"]
-            cxx_length = cxx_info[cxx_id][f"centroid_{xx}_gene_length"]
-
-            # Compute total per-position depth for aligned gene region
-            c99_covered_bases = 0
-            c99_total_depth = 0
-            counts = bamfile.count_coverage(c99_id, read_callback=keep_read)
-            for within_chunk_index in range(0, c99_length):
-                # Per-position depth: total number of bases mappped
-                gene_depth = sum([counts[nt][within_chunk_index] for nt in range(4)])
-                c99_total_depth += gene_depth
-                if gene_depth > 0:
-                    c99_covered_bases += 1
-            if c99_total_depth == 0: # Sparse by default.
-                continue
-            c99_mean_depth = float(c99_total_depth / c99_length)
-
-            if cxx_id not in cxx_values:
-                cxx_values[cxx_id] = {
-                    "species_id": species_id,
-                    f"c{xx}_id": cxx_id,
-                    f"c{xx}_length": cxx_length,
-                    "aligned_reads": c99_aligned_reads,
-                    "mapped_reads": c99_mapped_reads,
-                    "total_depth": c99_total_depth,
-                    "mean_depth": c99_mean_depth,
-                    "copy_number": 0.0,
-                    "genome_prevalence": cxx_info[cxx_id][f"centroid_{xx}_genome_prevalence"],
-                    "marker_id": cxx_info[cxx_id][f"centroid_{xx}_marker_id"],
-                }
-            else:
-                cxx_values[cxx_id]["aligned_reads"] += c99_aligned_reads
-                cxx_values[cxx_id]["mapped_reads"] += c99_mapped_reads
-                cxx_values[cxx_id]["total_depth"] += c99_total_depth
-                cxx_values[cxx_id]["mean_depth"] += c99_mean_depth
-
-    with OutputStream(headerless_sliced_path) as stream:
-        for rec in cxx_values.values():
-            stream.write("\t".join(map(format_data, rec.values(), repeat(DECIMALS6, len(rec)))) + "\n")
-
-    return headerless_sliced_path
-
-
-def merge_depth_across_chunks(list_of_chunks_pileup, xx):
+
+def records_to_array(list_of_records, xx):
+    """ Typed array of the genes of one chunk, with floats rounded as they are written to the chunk files """
     depth_schema = fetch_genes_chunk_schema(xx)
-    depth_cols = list(depth_schema.keys())[1:]
+    dtype = []
+    for column, ctype in depth_schema.items():
+        if ctype == str:
+            width = max((len(rec[column]) for rec in list_of_records), default=1)
+            dtype.append((column, f"S{max(width, 1)}"))
+        else:
+            dtype.append((column, np.int64 if ctype == int else np.float64))
+    rows = [tuple(float(format(rec[column], DECIMALS6)) if ctype == float else rec[column] for column, ctype in depth_schema.items()) for rec in list_of_records]
+    return np.array(rows, dtype=dtype)
+
+
+def _species_kmers(pargs):
+    species_id, centroids_fp, kmer_size, kmer_scaled = pargs
+    tsprint(f"  MIDAS2::species_kmers::{species_id}::start")
+    return reference_kmers(centroids_fp, kmer_size, kmer_scaled)
+
+
+def build_kmer_index(centroids_files, args):
+    """ Sampled k-mers of the centroids of all the species, sorted by hash, with the index of their centroid in list_of_refs """
+    species_ids = list(centroids_files.keys())
+    args_list = [(species_id, centroids_files[species_id], args.kmer_size, args.kmer_scaled) for species_id in species_ids]
+    list_of_kmers = multiprocessing_map(_species_kmers, args_list, args.num_cores)
+
+    list_of_refs = []
+    list_of_hashes = []
+    list_of_references = []
+    for species_id, (record_ids, hashes, records) in zip(species_ids, list_of_kmers):
+        list_of_hashes.append(hashes)
+        list_of_references.append(records + len(list_of_refs))
+        list_of_refs.extend((species_id, record_id) for record_id in record_ids)
+    hashes = np.concatenate(list_of_hashes)
+    references = np.concatenate(list_of_references)
+    order = np.argsort(hashes, kind="stable")
+    index = {"hashes": hashes[order], "references": references[order], "references_count": len(list_of_refs)}
+    return index, list_of_refs
+
+
+def quantify_reads_kmer(reads_fp):
+    """ Reads with a sampled k-mer in common with each centroid, reads kept, and their A/C/G/T bases up to the centroid length """
+    global global_args
+    global kmer_index
+    references_count = kmer_index["references_count"]
+    max_hash = max_hash_for(global_args.kmer_scaled)
+    aligned_reads = np.zeros(references_count, dtype=np.int64)
+    mapped_reads = np.zeros(references_count, dtype=np.int64)
+    total_depth = np.zeros(references_count, dtype=np.int64)
+    for seqs, _ in iter_sequence_blocks(reads_fp, global_args.max_reads):
+        bases, best_refs, best_hits = assign_reads(kmer_index, seqs, global_args.kmer_size, max_hash)
+        aligned_reads += np.bincount(best_refs[best_refs >= 0], minlength=references_count)
+        kept = (best_refs >= 0) & (best_hits >= global_args.kmer_min_hits)
+        mapped_refs = best_refs[kept]
+        mapped_bases = np.minimum(bases[kept], kmer_index["lengths"][mapped_refs])
+        mapped_reads += np.bincount(mapped_refs, minlength=references_count)
+        total_depth += np.bincount(mapped_refs, weights=mapped_bases, minlength=references_count).astype(np.int64)
+    return aligned_reads, mapped_reads, total_depth
+
+
+def quantify_genes_kmer(centroids_files, args):
+    """ Alignment free alternative to the bowtie2 alignment and pileup: each read goes to the centroid it shares the most sampled k-mers with """
+    global dict_of_species
+    global kmer_index
+    kmer_index, list_of_refs = build_kmer_index(centroids_files, args)
+    lengths = np.zeros(len(list_of_refs), dtype=np.int64)
+    for ref_index, (species_id, c99_id) in enumerate(list_of_refs):
+        clusters_index = dict_of_species[species_id].clusters_index
+        lengths[ref_index] = clusters_index.gene_length[clusters_index.row(c99_id)]
+    kmer_index["lengths"] = lengths
+    tsprint(f"  MIDAS2::build_kmer_index::{len(kmer_index['hashes'])} k-mers of {len(list_of_refs)} centroids")
+
+    reads_files = [args.r1] + ([args.r2] if args.r2 else [])
+    list_of_counts = multiprocessing_map(quantify_reads_kmer, reads_files, len(reads_files))
+    aligned_reads, mapped_reads, total_depth = (sum(counts) for counts in zip(*list_of_counts))
+
+    xx = args.cluster_level
+    cxx_values = defaultdict(dict)
+    for ref_index in np.flatnonzero(aligned_reads).tolist():
+        species_id, c99_id = list_of_refs[ref_index]
+        cxx_record = fetch_cxx_record(dict_of_species[species_id], c99_id, xx)
+        add_gene_depth(cxx_values, species_id, cxx_record, int(aligned_reads[ref_index]), int(mapped_reads[ref_index]), int(total_depth[ref_index]), xx)
+    return merge_depth_across_chunks([records_to_array(list(cxx_values.values()), xx)], xx, [c99_id for _, c99_id in list_of_refs])
 
-    # operational gene cluster level other than 99 could end up in different batches of c99s
+
+def merge_depth_across_chunks(list_of_chunks_depth, xx, ordered_genes):
+    """ Sum the reads and depth of each centroid_xx over the chunks, and list the centroids of each species in ordered_genes order """
+    depth_schema = fetch_genes_chunk_schema(xx)
+    cxx_column = f"c{xx}_id"
     cxx_values = defaultdict(lambda: defaultdict(dict))
-    for chunk_file in list_of_chunks_pileup:
-        with InputStream(chunk_file) as stream:
-            for r in select_from_tsv(stream, schema=depth_schema):
-                species_id, cxx_id = r[:2]
-                cxx_val = dict(zip(depth_cols, r[1:]))
-                if cxx_id not in cxx_values[species_id]:
-                    cxx_values[species_id][cxx_id] = cxx_val
-                else:
-                    cxx_values[species_id][cxx_id]["aligned_reads"] += cxx_val["aligned_reads"]
-                    cxx_values[species_id][cxx_id]["mapped_reads"] += cxx_val["mapped_reads"]
-                    cxx_values[species_id][cxx_id]["total_depth"] += cxx_val["total_depth"]
-                    cxx_values[species_id][cxx_id]["mean_depth"] += cxx_val["mean_depth"]
+    list_of_chunks_depth = [chunk_depth for chunk_depth in list_of_chunks_depth if len(chunk_depth)]
+    if not list_of_chunks_depth:
+        return cxx_values
+
+    # Each chunk sizes its string columns on its own genes
+    dtype = np.dtype([(column, max((chunk_depth.dtype[column] for chunk_depth in list_of_chunks_depth), key=lambda dt: dt.itemsize)) for column in depth_schema])
+    depth = np.concatenate([chunk_depth.astype(dtype) for chunk_depth in list_of_chunks_depth])
+
+    # operational gene cluster level other than 99 could end up in different batches of c99s
+    keys = np.empty(len(depth), dtype=[("species_id", dtype["species_id"]), (cxx_column, dtype[cxx_column])])
+    keys["species_id"] = depth["species_id"]
+    keys[cxx_column] = depth[cxx_column]
+    _, first_rows, group_of_row = np.unique(keys, return_index=True, return_inverse=True)
+    merged = depth[first_rows]
+    for column in ("aligned_reads", "mapped_reads", "total_depth", "mean_depth"):
+        # Unbuffered, in chunks order: same sums as adding the chunks one after the other
+        merged[column] = 0
+        np.add.at(merged[column], group_of_row, depth[column])
+
+    # Chunks are not contiguous slices of the BAM genes: restore the order of the genes, within species in order of appearance
+    genes = np.array(ordered_genes, dtype=bytes)
+    gene_order = np.argsort(genes, kind="stable")
+    sorted_genes = genes[gene_order]
+    if len(genes):
+        positions = np.minimum(np.searchsorted(sorted_genes, merged[cxx_column]), len(genes) - 1)
+        gene_rank = np.where(sorted_genes[positions] == merged[cxx_column], gene_order[positions], len(genes))
+    else:
+        gene_rank = np.zeros(len(merged), dtype=np.int64)
+    _, species_first_rows, species_of_row = np.unique(depth["species_id"], return_index=True, return_inverse=True)
+    species_rank = species_first_rows[species_of_row[first_rows]]
+    merged = merged[np.lexsort((first_rows, gene_rank, species_rank))]
+
+    columns = [np.char.decode(merged[column]).tolist() if ctype == str else merged[column].tolist() for column, ctype in depth_schema.items()]
+    depth_columns = list(depth_schema.keys())[1:]
+    for species_id, *values in zip(*columns):
+        cxx_values[species_id][values[0]] = dict(zip(depth_columns, values))
     return cxx_values
 
 
@@ -415,14 +629,13 @@ def compute_species_summary(dict_of_gene_depth):
         sp = dict_of_species[species_id]
         cxx_values = dict_of_gene_depth[species_id]
 
-        cxx_info = sp.clusters_info[xx]
         list_of_markers = sp.list_of_markers[xx]
         median_marker_depth = compute_median_marker_depth(cxx_values, list_of_markers)
         tsprint(f"median marker depth for {species_id} is {median_marker_depth}")
 
         cxx_summary = {
             "species_id": species_id,
-            "pangenome_size": len(cxx_info),
+            "pangenome_size": sp.pangenome_size[xx],
             "covered_genes": 0,
             "fraction_covered": 0,
             "aligned_reads": 0,
@@ -460,6 +673,25 @@ def write_species_summary(species_covs, genes_depth_path):
             stream.write("\t".join(map(format_data, rec.values())) + "\n")
 
 
+def quantify_genes_bowtie2(pangenome_bamfile, bt2_db_prefix, midas_db, species_to_analyze, args):
+    """ Pile up the centroids the reads aligned to, in chunks balanced on mapped reads """
+    # It's important to maintain the order of the bam genes
+    genes_mapped_reads = fetch_genes_from_bam(f'{pangenome_bamfile}.idxstats', pangenome_bamfile, bt2_db_prefix, midas_db, species_to_analyze)
+
+    # Balance the chunks on mapped reads, and start the heaviest first
+    list_of_chunks = design_chunks(genes_mapped_reads, args.num_cores * DEFAULT_CHUNKS_PER_CORE)
+    args_list = []
+    for chunk_id, (_, chunk_geneids_list) in enumerate(list_of_chunks):
+        headerless_sliced_path = sample.get_target_layout("chunk_depth", "", chunk_id)
+        args_list.append((chunk_id, chunk_geneids_list, pangenome_bamfile, headerless_sliced_path, args.cluster_level))
+    if list_of_chunks:
+        mean_load = sum(load for load, _ in list_of_chunks) / len(list_of_chunks)
+        tsprint(f"  MIDAS2::design_chunks::{len(readonly_bamgenes)} genes into {len(list_of_chunks)} chunks, largest chunk {list_of_chunks[0][0] / mean_load:.2f}x the mean")
+
+    list_of_chunks_depth = multiprocessing_map(compute_pileup_per_chunk, args_list, args.num_cores)
+    return merge_depth_across_chunks(list_of_chunks_depth, args.cluster_level, list(readonly_bamgenes))
+
+
 def run_genes(args):
 
     try:
@@ -476,7 +708,8 @@ def run_genes(args):
 
         # Read in list of species
         species_list = parse_species(args)
-        bt2_db_dir, bt2_db_name, species_list = get_bowtie2_indexes(args, species_list)
+        if args.quantifier == "bowtie2":
+            bt2_db_dir, bt2_db_name, species_list = get_bowtie2_indexes(args, species_list)
 
         # Restricted species profile: only abundant species based on species SGC profiling results
         species_to_analyze = filter_species_list(args, species_list)
@@ -493,43 +726,37 @@ def run_genes(args):
         else:
             centroids_files = midas_db.fetch_files("pangenome_centroids", species_to_analyze)
 
-        build_bowtie2_db(bt2_db_dir, bt2_db_name, centroids_files, args.num_cores)
-        tsprint("MIDAS2::build_bowtie2db::finish")
+        if args.quantifier == "kmer":
+            tsprint("MIDAS2::prepare_species::start")
+            prepare_species(species_to_analyze, midas_db)
+            tsprint("MIDAS2::prepare_species::finish")
 
-        # Align reads to pangenome database
-        tsprint("MIDAS2::bowtie2_align::start")
-        pangenome_bamfile = sample.get_target_layout("pangenome_bam")
-        bowtie2_align(bt2_db_dir, bt2_db_name, pangenome_bamfile, args)
-        samtools_index(pangenome_bamfile, args.debug, args.num_cores)
-        samtools_idxstats(pangenome_bamfile, args.debug, args.num_cores)
-        tsprint("MIDAS2::bowtie2_align::finish")
-
-        if args.alignment_only:
-            return
-
-        tsprint("MIDAS2::prepare_species::start")
-        prepare_species(species_to_analyze, midas_db)
-        tsprint("MIDAS2::prepare_species::finish")
+            tsprint("MIDAS2::quantify_genes_kmer::start")
+            dict_of_gene_depth = quantify_genes_kmer(centroids_files, args)
+            tsprint("MIDAS2::quantify_genes_kmer::finish")
+        else:
+            build_bowtie2_db(bt2_db_dir, bt2_db_name, centroids_files, args.num_cores)
+            tsprint("MIDAS2::build_bowtie2db::finish")
 
-        tsprint("MIDAS2::multiprocessing_map::start")
-        # It's important to maintain the order of the bam genes
-        fetch_genes_from_bam(f'{pangenome_bamfile}.idxstats', midas_db, species_to_analyze)
+            # Align reads to pangenome database
+            tsprint("MIDAS2::bowtie2_align::start")
+            pangenome_bamfile = sample.get_target_layout("pangenome_bam")
+            bowtie2_align(bt2_db_dir, bt2_db_name, pangenome_bamfile, args)
+            samtools_index(pangenome_bamfile, args.debug, args.num_cores)
+            samtools_idxstats(pangenome_bamfile, args.debug, args.num_cores)
+            tsprint("MIDAS2::bowtie2_align::finish")
 
+            if args.alignment_only:
+                return
 
-        total_c99_counts = len(readonly_bamgenes)
-        args_list = []
-        number_of_chunks = args.num_cores
+            tsprint("MIDAS2::prepare_species::start")
+            prepare_species(species_to_analyze, midas_db)
+            tsprint("MIDAS2::prepare_species::finish")
 
-        if total_c99_counts:
-            chunk_size = ceil(total_c99_counts / number_of_chunks)
-            for chunk_id, chunk_start in enumerate(range(0, total_c99_counts, chunk_size)):
-                chunk_end = chunk_start + chunk_size
-                headerless_sliced_path = sample.get_target_layout("chunk_depth", "", chunk_id)
-                args_list.append((chunk_id, chunk_start, chunk_end, pangenome_bamfile, headerless_sliced_path, args.cluster_level))
+            tsprint("MIDAS2::multiprocessing_map::start")
+            dict_of_gene_depth = quantify_genes_bowtie2(pangenome_bamfile, f"{bt2_db_dir}/{bt2_db_name}", midas_db, species_to_analyze, args)
+            tsprint("MIDAS2::multiprocessing_map::finish")
 
-        list_of_chunks_depth = multiprocessing_map(compute_pileup_per_chunk, args_list, number_of_chunks)
-        dict_of_gene_depth = merge_depth_across_chunks(list_of_chunks_depth, args.cluster_level)
-        tsprint("MIDAS2::multiprocessing_map::finish")
         species_depth_summary = compute_species_summary(dict_of_gene_depth)
 
         if not args.skip_species_summary:
@@ -537,12 +764,12 @@ def run_genes(args):
             write_species_summary(species_depth_summary, sample.get_target_layout("genes_summary"))
             tsprint("MIDAS2::write_species_summary::finish")
 
-        if args.remove_bam:
+        if args.remove_bam and args.quantifier == "bowtie2":
             command(f"rm -f {pangenome_bamfile}", check=False)
             command(f"rm -f {pangenome_bamfile}.bai", check=False)
             command(f"rm -f {pangenome_bamfile}.idxstats", check=False)
 
-        if args.remove_bt2_index:
+        if args.remove_bt2_index and args.quantifier == "bowtie2":
             sample.remove_dirs(["bt2_indexes_dir"])
 
         if not args.debug:
@@ -560,4 +787,7 @@ def run_genes(args):
 @register_args
 def main(args):
     tsprint(f"Single sample pan-gene copy number variant calling in subcommand {args.subcommand} with args\n{json.dumps(vars(args), indent=4)}")
+    if args.quantifier == "kmer":
+        assert not args.prebuilt_bowtie2_indexes and not args.alignment_only, "--quantifier kmer does not align the reads: drop --prebuilt_bowtie2_indexes and --alignment_only"
+        assert 0 < args.kmer_size <= 31, f"k-mer size {args.kmer_size} does not fit 64 bits"
     run_genes(args)
@@ -10,7 +10,7 @@ import numpy as np
 from pysam import AlignmentFile  # pylint: disable=no-name-in-module
 
 from midas.common.argparser import add_subcommand
-from midas.common.utils import tsprint, InputStream, OutputStream, multiprocessing_map, command, cat_files, select_from_tsv, multithreading_map, args_string
+from midas.common.utils import tsprint, InputStream, OutputStream, multiprocessing_map, command, select_from_tsv, multithreading_map, args_string, FrameConcatenator, wait_for_chunks_in_order
 from midas.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_sort, samtools_index, bowtie2_index_exists, _keep_read
 from midas.params.schemas import snps_profile_schema, snps_pileup_schema, format_data, snps_pileup_basic_schema
 from midas.common.snvs import call_alleles, reference_overlap, update_overlap, mismatches_within_overlaps, query_overlap_qualities
@@ -36,6 +36,7 @@ DEFAULT_MAX_FRAGRATIO = 3
 DEFAULT_NUM_CORES = 8
 
 DEFAULT_SITE_DEPTH = 2
+COVERAGE_BIN_SIZE = 1000
 DEFAULT_SNP_MAF = 0.1
 
 
@@ -260,11 +261,13 @@ def design_chunks(species_ids_of_interest, midas_db, chunk_size):
     """ Chunks of continuous genomics sites, indexed by species_id, chunk_id """
 
     global semaphore_for_species
+    global status_of_chunks
     global dict_of_species
     global dict_of_site_chunks
 
     # Read-only global variables
     semaphore_for_species = dict()
+    status_of_chunks = dict()
     dict_of_species = {species_id: Species(species_id) for species_id in species_ids_of_interest}
 
     # Design chunks structure per species
@@ -291,6 +294,8 @@ def design_chunks(species_ids_of_interest, midas_db, chunk_size):
         semaphore_for_species[species_id] = multiprocessing.Semaphore(num_of_snps_chunks)
         for _ in range(num_of_snps_chunks):
             semaphore_for_species[species_id].acquire()
+        # Shared per-chunk status (0: pending, 1: done, -1: failed) for streaming merge in chunk order
+        status_of_chunks[species_id] = multiprocessing.RawArray('b', num_of_snps_chunks)
 
     tsprint("================= Total number of compute chunks: " + str(len(arguments_list)))
 
@@ -515,13 +520,7 @@ def process_chunk_of_sites(packed_args):
     species_id, chunk_id = packed_args
 
     if chunk_id == -1:
-        global semaphore_for_species
-        global dict_of_species
-        sp = dict_of_species[species_id]
-
-        tsprint(f"  MIDAS2::process_chunk_of_sites::{species_id}-{chunk_id}::wait merge_chunks_per_species")
-        for _ in range(sp.num_of_snps_chunks):
-            semaphore_for_species[species_id].acquire()
+        # Chunks are appended to the species pileup as soon as they (and their predecessors) finish
         tsprint(f"  MIDAS2::process_chunk_of_sites::{species_id}-{chunk_id}::start merge_chunks_per_species")
         ret = merge_chunks_per_species(species_id)
         tsprint(f"  MIDAS2::process_chunk_of_sites::{species_id}-{chunk_id}::finish merge_chunks_per_species")
@@ -538,13 +537,15 @@ def compute_pileup_per_chunk(packed_args):
     """ Pileup for one chunk, potentially contain multiple contigs """
 
     global semaphore_for_species
+    global status_of_chunks
     global dict_of_species
     global sample
     global global_args
     global dict_of_site_chunks
 
+    species_id, chunk_id = packed_args
+    status = -1
     try:
-        species_id, chunk_id = packed_args
         sp = dict_of_species[species_id]
 
         chunks_of_sites = dict_of_site_chunks[species_id]
@@ -568,8 +569,10 @@ def compute_pileup_per_chunk(packed_args):
             for sliced_pileup in dict_of_chunk_pileup.values():
                 for row in sliced_pileup:
                     stream.write("\t".join(map(format_data, row)) + "\n")
+        status = 1
         return ret
     finally:
+        status_of_chunks[species_id][chunk_id] = status
         semaphore_for_species[species_id].release() # no deadlock
 
 
@@ -652,6 +655,9 @@ def midas_pileup(packed_args):
 
     assert within_chunk_index+contig_start == contig_end-1, f"compute_pileup_per_chunk::index mismatch error for {contig_id}."
 
+    # Bins of COVERAGE_BIN_SIZE with at least one reported site, consumed by merge_snps to skip empty samples
+    aln_stats["covered_bins"] = sorted(set((row[1] - 1) // COVERAGE_BIN_SIZE for row in sliced_pileup))
+
     return aln_stats, sliced_pileup
 
 
@@ -660,26 +666,21 @@ def merge_chunks_per_species(species_id):
 
     global global_args
     global sample
-    global dict_of_species
-
-    sp = dict_of_species[species_id]
-    number_of_chunks = sp.num_of_snps_chunks
+    global semaphore_for_species
+    global status_of_chunks
 
-    list_of_chunks_pileup = [sample.get_target_layout("chunk_pileup", species_id, chunk_id) for chunk_id in range(0, number_of_chunks)]
     species_snps_pileup_file = sample.get_target_layout("snps_pileup", species_id)
+    header = "\t".join((snps_pileup_schema if global_args.advanced else snps_pileup_basic_schema).keys()) + "\n"
+    remove_chunks = global_args.analysis_ready or not global_args.debug
 
-    with OutputStream(species_snps_pileup_file) as stream:
-        if global_args.advanced:
-            stream.write("\t".join(snps_pileup_schema.keys()) + "\n")
-        else:
-            stream.write("\t".join(snps_pileup_basic_schema.keys()) + "\n")
-    cat_files(list_of_chunks_pileup, species_snps_pileup_file, 20)
-
-    if global_args.analysis_ready or not global_args.debug:
-        tsprint(f"Deleting temporary sliced pileup files for {species_id}.")
-        for s_file in list_of_chunks_pileup:
-            command(f"rm -rf {s_file}", quiet=True)
+    with FrameConcatenator(species_snps_pileup_file, header) as concat:
+        for chunk_id in wait_for_chunks_in_order(semaphore_for_species[species_id], status_of_chunks[species_id]):
+            chunk_pileup_file = sample.get_target_layout("chunk_pileup", species_id, chunk_id)
+            concat.append(chunk_pileup_file)
+            if remove_chunks:
+                command(f"rm -rf {chunk_pileup_file}", quiet=True)
 
+    if remove_chunks:
         repgenome_bamfile = sample.get_target_layout("species_sorted_bam", species_id)
         if not global_args.analysis_ready:
             command(f"rm -rf {repgenome_bamfile}", quiet=True)
@@ -773,6 +774,34 @@ def write_species_pileup_summary(chunks_pileup_summary, snps_summary_outfile, di
             stream.write("\t".join(map(format_data, record.values())) + "\n")
 
 
+def bins_to_intervals(sorted_bins, bin_size):
+    """ Merge consecutive bin indices into [start, end) intervals in genomic coordinates """
+    intervals = []
+    for b in sorted_bins:
+        if intervals and intervals[-1][1] == b * bin_size:
+            intervals[-1][1] = (b + 1) * bin_size
+        else:
+            intervals.append([b * bin_size, (b + 1) * bin_size])
+    return intervals
+
+
+def write_species_coverage(chunks_pileup_summary, species_ids_of_interest):
+    """ Per species, write the intervals (0-based, right open) of the contigs with reported pileup sites """
+    global sample
+
+    covered_bins = defaultdict(lambda: defaultdict(set))
+    for records in chunks_pileup_summary:
+        if records is True:
+            continue
+        for record in records:
+            covered_bins[record["species_id"]][record["contig_id"]].update(record["covered_bins"])
+
+    for species_id in species_ids_of_interest:
+        contigs = {contig_id: bins_to_intervals(sorted(bins), COVERAGE_BIN_SIZE) for contig_id, bins in covered_bins[species_id].items() if bins}
+        with open(sample.get_target_layout("snps_coverage", species_id), "w") as stream:
+            json.dump({"bin_size": COVERAGE_BIN_SIZE, "contigs": contigs}, stream)
+
+
 def run_snps(args):
 
     try:
@@ -861,6 +890,7 @@ def run_snps(args):
 
         dict_of_chunk_aln_stats = compute_chunk_aln_summary(list_of_contig_aln_stats, species_ids_of_interest)
         write_species_pileup_summary(chunks_pileup_summary, snps_summary_fp, dict_of_chunk_aln_stats)
+        write_species_coverage(chunks_pileup_summary, species_ids_of_interest)
         tsprint(f"MIDAS2::write_species_pileup_summary::finish")
 
         if args.remove_bam:
@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
+import io
 import json
 import os
-import random
+import time
+import subprocess
+import threading
 from collections import defaultdict
-from itertools import chain, repeat
+from itertools import repeat, chain
 import numpy as np
-import Bio.SeqIO
+import pandas as pd
 
 from midas.common.argparser import add_subcommand
-from midas.common.utils import tsprint, num_physical_cores, InputStream, OutputStream, select_from_tsv, args_string
+from midas.common.kmers import FracMinHash, DEFAULT_KMER_SIZE, DEFAULT_SCALED, sketch_component, load_sketch_index, contain
+from midas.common.utils import tsprint, num_physical_cores, InputStream, OutputStream, select_from_tsv, args_string, command
 from midas.models.midasdb import MIDAS_DB
+from midas.models.markersinfo import load_markers_info, MarkersInfo
 from midas.models.sample import Sample
-from midas.params.schemas import BLAST_M8_SCHEMA, MARKER_INFO_SCHEMA, species_profile_schema, format_data, DECIMALS6, species_marker_profile_schema
+from midas.params.schemas import BLAST_M8_SCHEMA, species_profile_schema, format_data, DECIMALS6, species_marker_profile_schema, species_convergence_schema
 from midas.params.inputs import MIDASDB_NAMES
 
 
@@ -19,6 +24,13 @@ DEFAULT_WORD_SIZE = 28
 DEFAULT_ALN_COV = 0.75
 DEFAULT_MARKER_READS = 2
 DEFAULT_MARKER_COVERED = 2
+DEFAULT_SEED = 0
+DEFAULT_ADAPTIVE_TOLERANCE = 0.01
+DEFAULT_ADAPTIVE_BATCHES = 3
+DEFAULT_SKETCH_CONTAINMENT = 0.1
+MIN_SKETCH_MATCHES = 3
+FEED_BLOCK_SIZE = 16 * 1024 * 1024 # bytes of (decompressed) reads converted at once
+M8_BLOCK_SIZE = 16 * 1024 * 1024 # bytes of alignments classified at once
 
 
 def register_args(main_func):
@@ -29,15 +41,18 @@ def register_args(main_func):
                            help="Path to directory to store results.  Name should correspond to unique sample identifier.")
     subparser.add_argument('--sample_name',
                            dest='sample_name',
-                           required=True,
                            help="Unique sample identifier")
     subparser.add_argument('-1',
                            dest='r1',
-                           required=True,
                            help="FASTA/FASTQ file containing 1st mate if using paired-end reads.  Otherwise FASTA/FASTQ containing unpaired reads.")
     subparser.add_argument('-2',
                            dest='r2',
                            help="FASTA/FASTQ file containing 2nd mate if using paired-end reads.")
+    subparser.add_argument('--samples_manifest',
+                           dest='samples_manifest',
+                           type=str,
+                           metavar="CHAR",
+                           help="Batch mode: TSV file with sample_name, r1 and optionally r2 columns.  All the samples are aligned by one hs-blastn process, and profiled into {midas_outdir}/{sample_name}/species as individual runs would.")
 
     subparser.add_argument('--midasdb_name',
                            dest='midasdb_name',
@@ -51,6 +66,31 @@ def register_args(main_func):
                            default="midasdb",
                            help="Path to local MIDAS Database.")
 
+    subparser.add_argument('--screen',
+                           dest='screen',
+                           type=str,
+                           default="markers",
+                           choices=["markers", "sketch"],
+                           help="markers: align the reads to the marker genes with hs-blastn.  sketch: presence/absence screen comparing a FracMinHash sketch of the reads to the rep-genome sketches from build_sketches.  (markers)")
+    subparser.add_argument('--sketch_kmer_size',
+                           dest='sketch_kmer_size',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_KMER_SIZE,
+                           help=f"Sketch screen: k-mer size, as given to build_sketches ({DEFAULT_KMER_SIZE})")
+    subparser.add_argument('--sketch_scaled',
+                           dest='sketch_scaled',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_SCALED,
+                           help=f"Sketch screen: scaled factor, as given to build_sketches ({DEFAULT_SCALED})")
+    subparser.add_argument('--sketch_min_containment',
+                           dest='sketch_min_containment',
+                           type=float,
+                           metavar="FLOAT",
+                           default=DEFAULT_SKETCH_CONTAINMENT,
+                           help=f"Sketch screen: only report species with at least this fraction of their rep-genome sketch in the reads ({DEFAULT_SKETCH_CONTAINMENT})")
+
     subparser.add_argument('--word_size',
                            dest='word_size',
                            default=DEFAULT_WORD_SIZE,
@@ -87,6 +127,34 @@ def register_args(main_func):
                            type=int,
                            metavar="INT",
                            help="Number of reads to use from input file(s).  (All)")
+    subparser.add_argument('--read_length',
+                           dest='read_length',
+                           type=int,
+                           metavar="INT",
+                           help="Trim reads to READ_LENGTH and discard reads shorter than READ_LENGTH.  (No trimming)")
+    subparser.add_argument('--adaptive_batch_reads',
+                           dest='adaptive_batch_reads',
+                           type=int,
+                           metavar="INT",
+                           help="Adaptive read budget: align reads in batches of ADAPTIVE_BATCH_READS reads per input file, and stop once the species profile converged.  (Off)")
+    subparser.add_argument('--adaptive_tolerance',
+                           dest='adaptive_tolerance',
+                           type=float,
+                           metavar="FLOAT",
+                           default=DEFAULT_ADAPTIVE_TOLERANCE,
+                           help=f"Adaptive read budget: the profile converged when the L1 distance between the relative abundances of two successive batches is below ADAPTIVE_TOLERANCE ({DEFAULT_ADAPTIVE_TOLERANCE})")
+    subparser.add_argument('--adaptive_batches',
+                           dest='adaptive_batches',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_ADAPTIVE_BATCHES,
+                           help=f"Adaptive read budget: number of consecutive batches below ADAPTIVE_TOLERANCE to stop ({DEFAULT_ADAPTIVE_BATCHES})")
+    subparser.add_argument('--seed',
+                           dest='seed',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_SEED,
+                           help=f"Seed of the random assignment of ambiguously mapped reads ({DEFAULT_SEED})")
     subparser.add_argument('--num_cores',
                            dest='num_cores',
                            type=int,
@@ -132,7 +200,7 @@ def readfq(fp):
                 break
 
 
-def parse_reads(filename, max_reads=None):
+def parse_reads(filename, max_reads=None, read_length=None):
     if not filename:
         return
     read_count_filter = None
@@ -142,6 +210,10 @@ def parse_reads(filename, max_reads=None):
     with InputStream(filename, read_count_filter) as fp:
         for name, seq, _ in readfq(fp):
             read_count += 1
+            if read_length:
+                if len(seq) < read_length:
+                    continue
+                seq = seq[:read_length]
             new_name = construct_queryid(name, len(seq))  # We need to encode the length in the query id to be able to recover it from hs-blastn output
             yield (new_name, seq)
         if read_count_filter:
@@ -149,13 +221,246 @@ def parse_reads(filename, max_reads=None):
     tsprint(f"parse_reads:: parsed {read_count} reads from {filename}")
 
 
-def map_reads_hsblastn(m8_file, r1, r2, word_size, markers_db, max_reads, num_cores):
-    assert os.path.exists(os.path.dirname(m8_file)), f"{m8_file} doesn't exit."
-    blast_command = f"hs-blastn align -outfmt 6 -num_threads {num_cores} -evalue 1e-3 -word_size {word_size} -query /dev/stdin -db {markers_db}"
-    #blast_command = f"hs-blastn -outfmt 6 -num_threads {num_cores} -evalue 1e-3 /dev/stdin {markers_db}"
-    with OutputStream(m8_file, through=blast_command) as blast_input:
-        for qid, seq in chain(parse_reads(r1, max_reads), parse_reads(r2, max_reads)):
-            blast_input.write(">" + qid + "\n" + seq + "\n")
+def fastq_block_to_fasta(buf, nrecords, read_length=None, tag=b""):
+    """ Convert the first nrecords 4-line FASTQ records of buf into FASTA, with the read length encoded in the query id,
+    and the query id prefixed with tag.
+    Line and read name boundaries are located for the whole block at once with numpy.
+    Returns the FASTA block, the number of reads and bases kept, and the number of bytes of buf consumed. """
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    newlines = np.flatnonzero(arr == 10)[:4 * nrecords]
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+
+    header_start, header_end = line_starts[0::4], newlines[0::4]
+    seq_start, seq_end = line_starts[1::4], newlines[1::4]
+    assert np.all(arr[header_start] == 64) and np.all(arr[line_starts[2::4]] == 43), "Malformed FASTQ: expected 4-line records of @header, sequence, +, quality"
+
+    # Read name is the header up to the first space, as in readfq
+    name_end = header_end
+    spaces = np.flatnonzero(arr[:newlines[-1]] == 32)
+    if len(spaces):
+        first_space = spaces[np.minimum(np.searchsorted(spaces, header_start), len(spaces) - 1)]
+        name_end = np.where((first_space > header_start) & (first_space < header_end), first_space, header_end)
+
+    seq_len = seq_end - seq_start
+    if read_length:
+        keep = seq_len >= read_length
+        header_start, name_end, seq_start = header_start[keep], name_end[keep], seq_start[keep]
+        seq_len = np.full(len(seq_start), read_length)
+
+    fasta = b"".join(b">%s%s_%d\n%s\n" % (tag, buf[hs+1:ne], sl, buf[ss:ss+sl]) \
+        for hs, ne, ss, sl in zip(header_start.tolist(), name_end.tolist(), seq_start.tolist(), seq_len.tolist()))
+    return fasta, len(seq_len), int(seq_len.sum()), int(newlines[-1]) + 1
+
+
+def iter_fasta_blocks(filename, max_reads=None, read_length=None, tag=b""):
+    """ Convert the reads of one FASTQ file to FASTA for the aligner, one large block at a time.
+    FASTA inputs go through readfq instead.  Yields each FASTA block with the number of input reads it covers. """
+    if not filename:
+        return
+    start = time.time()
+    read_count, kept_count, kept_bases = 0, 0, 0
+    carry = b""
+    with InputStream(filename, binary=True) as stream:
+        try:
+            data = stream.read(FEED_BLOCK_SIZE)
+            is_fastq = data.startswith(b"@")
+            if not is_fastq:
+                stream.ignore_errors()
+            while is_fastq:
+                buf = carry + data
+                data = stream.read(FEED_BLOCK_SIZE) # look ahead for the end of file
+                if not data and buf and not buf.endswith(b"\n"):
+                    buf += b"\n"
+                nrecords = buf.count(b"\n") // 4
+                if max_reads is not None:
+                    nrecords = min(nrecords, max_reads - read_count)
+                carry = buf
+                if nrecords > 0:
+                    fasta, nkept, nbases, consumed = fastq_block_to_fasta(buf, nrecords, read_length, tag)
+                    read_count += nrecords
+                    kept_count += nkept
+                    kept_bases += nbases
+                    carry = buf[consumed:]
+                    yield fasta, nrecords
+                if max_reads is not None and read_count >= max_reads:
+                    stream.ignore_errors()
+                    break
+                if not data:
+                    assert not carry.strip(), f"Truncated FASTQ record at the end of {filename}"
+                    break
+        except GeneratorExit:
+            # The caller stopped early, e.g. adaptive mode converged
+            stream.ignore_errors()
+            raise
+
+    if not is_fastq:
+        records = []
+        str_tag = tag.decode()
+        for qid, seq in parse_reads(filename, max_reads, read_length):
+            records.append(">" + str_tag + qid + "\n" + seq + "\n")
+            if len(records) == 100000:
+                yield "".join(records).encode(), len(records)
+                records = []
+        if records:
+            yield "".join(records).encode(), len(records)
+        return
+
+    elapsed = max(time.time() - start, 1e-6)
+    tsprint(f"  MIDAS2::feed_reads::{filename} {kept_count} out of {read_count} reads, {kept_bases} bases in {elapsed:.1f}s ({read_count / elapsed:.0f} reads/s, {kept_bases / elapsed / 1e6:.1f} Mbp/s)")
+
+
+def feed_reads(blast_input, filename, max_reads=None, read_length=None):
+    """ Stream the reads of one input file to the aligner as FASTA """
+    for fasta, _ in iter_fasta_blocks(filename, max_reads, read_length):
+        blast_input.write(fasta)
+
+
+class ReadBatches:
+    """
+    Successive batches of about batch_reads reads from each input file, for the adaptive read budget.
+
+    Each batch is an iterator of FASTA blocks, consumed by the hs-blastn feeder.  The block
+    following each batch is peeked at, so that no batch comes out empty.
+    """
+
+    def __init__(self, filenames, batch_reads, max_reads=None, read_length=None):
+        self.batch_reads = batch_reads
+        self.list_of_blocks = [iter_fasta_blocks(fn, max_reads, read_length) for fn in filenames if fn]
+        self.lookahead = [next(blocks, None) for blocks in self.list_of_blocks]
+        self.reads_consumed = 0
+
+
+    def is_exhausted(self):
+        return all(block is None for block in self.lookahead)
+
+
+    def next_batch(self):
+        for fi, blocks in enumerate(self.list_of_blocks):
+            batch_reads = 0
+            while self.lookahead[fi] is not None and batch_reads < self.batch_reads:
+                fasta, nreads = self.lookahead[fi]
+                batch_reads += nreads
+                self.reads_consumed += nreads
+                yield fasta
+                self.lookahead[fi] = next(blocks, None)
+
+
+    def close(self):
+        for blocks in self.list_of_blocks:
+            blocks.close()
+
+
+def align_reads_hsblastn(blast_command, fasta_blocks, classifier, m8_copy=None):
+    """ Feed the FASTA blocks to hs-blastn and classify the alignments straight from its stdout """
+    feeder_errors = []
+    def feeder(blast_input):
+        try:
+            for fasta in fasta_blocks:
+                blast_input.write(fasta)
+        except Exception as error: # pylint: disable=broad-except
+            feeder_errors.append(error)
+        finally:
+            blast_input.close()
+
+    with command(blast_command, popen=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as blast_proc:
+        feeder_thread = threading.Thread(target=feeder, args=(blast_proc.stdin,), daemon=True)
+        feeder_thread.start()
+        classify_m8_stream(blast_proc.stdout, classifier, m8_copy)
+        feeder_thread.join()
+    if feeder_errors:
+        raise feeder_errors[0]
+    assert blast_proc.returncode == 0, f"Non-zero exit code {blast_proc.returncode} from hs-blastn"
+
+
+def hsblastn_command(word_size, markers_db, num_cores):
+    return f"hs-blastn align -outfmt 6 -num_threads {num_cores} -evalue 1e-3 -word_size {word_size} -query /dev/stdin -db {markers_db}"
+    #return f"hs-blastn -outfmt 6 -num_threads {num_cores} -evalue 1e-3 /dev/stdin {markers_db}"
+
+
+def map_reads_hsblastn(m8_file, r1, r2, word_size, markers_db, max_reads, num_cores, classifier, read_length=None):
+    """ Align the reads with hs-blastn and classify the alignments straight from its stdout.
+    The alignments are only written to m8_file when given (debug). """
+    def fasta_blocks():
+        for filename in (r1, r2):
+            for fasta, _ in iter_fasta_blocks(filename, max_reads, read_length):
+                yield fasta
+
+    blast_command = hsblastn_command(word_size, markers_db, num_cores)
+    if m8_file:
+        with open(m8_file, "wb") as m8_copy:
+            align_reads_hsblastn(blast_command, fasta_blocks(), classifier, m8_copy)
+    else:
+        align_reads_hsblastn(blast_command, fasta_blocks(), classifier)
+
+
+def tag_fasta_block(fasta, tag):
+    """ Prefix the query ids of a FASTA block with tag """
+    if not fasta:
+        return fasta
+    return b">" + tag + fasta[1:].replace(b"\n>", b"\n>" + tag)
+
+
+def map_reads_adaptive(m8_file, markers_db, classifier, markers_info, args):
+    """
+    Align the reads with one hs-blastn process, fed in batches of about adaptive_batch_reads reads per input file.
+    Once all the alignments of a batch are in, the species relative abundance is updated from the new reads only.
+    Stop feeding reads once the L1 distance between two successive profiles stayed below adaptive_tolerance for
+    adaptive_batches consecutive batches, or when the reads (or max_reads) run out.  Reads already fed past the
+    converged batch are not counted.
+
+    Returns the abundance estimated from all the counted reads, and the convergence trace.
+    """
+    blast_command = hsblastn_command(args.word_size, markers_db, args.num_cores)
+    read_batches = ReadBatches([args.r1, args.r2], args.adaptive_batch_reads, args.max_reads, args.read_length)
+    stop_feeding = threading.Event()
+    batches_reads = [] # reads consumed at the end of each fed batch
+
+    def fasta_blocks():
+        # Batch index in the query ids, for the classifier to tell when a batch is complete
+        while not read_batches.is_exhausted() and not stop_feeding.is_set():
+            tag = f"{len(batches_reads)}:".encode()
+            for fasta in read_batches.next_batch():
+                yield tag_fasta_block(fasta, tag)
+            batches_reads.append(read_batches.reads_consumed)
+
+    incremental_abundance = IncrementalAbundance(classifier, markers_info, args)
+    trace = []
+    previous_abundance = None
+    stable_batches = 0
+    def checkpoint(batch_index):
+        """ Update the profile with the reads of batch_index, and tell whether it converged """
+        nonlocal previous_abundance, stable_batches
+        relative_abundance = incremental_abundance.update()
+        distance = None
+        if previous_abundance is not None:
+            list_of_species = set(relative_abundance) | set(previous_abundance)
+            distance = sum(abs(relative_abundance.get(spid, 0.0) - previous_abundance.get(spid, 0.0)) for spid in list_of_species)
+        # No species detected yet is not a stable profile
+        stable_batches = stable_batches + 1 if relative_abundance and distance is not None and distance < args.adaptive_tolerance else 0
+        previous_abundance = relative_abundance
+
+        trace.append({"batch": batch_index + 1, "reads_consumed": batches_reads[batch_index], "species_count": len(relative_abundance), "l1_distance": distance})
+        tsprint(f"  MIDAS2::map_reads_adaptive::batch {batch_index + 1} {batches_reads[batch_index]} reads, {len(relative_abundance)} species, L1 distance {'NA' if distance is None else format(distance, '.6f')}")
+        if stable_batches >= args.adaptive_batches:
+            stop_feeding.set()
+            return True
+        return False
+
+    try:
+        if m8_file:
+            with open(m8_file, "wb") as m8_copy:
+                align_reads_hsblastn(blast_command, fasta_blocks(), BatchesClassifier(classifier, checkpoint, batches_reads, m8_copy))
+        else:
+            align_reads_hsblastn(blast_command, fasta_blocks(), BatchesClassifier(classifier, checkpoint, batches_reads))
+    finally:
+        read_batches.close()
+
+    # Checkpoints are estimates: the reported abundance assigns all the ambiguous reads at once, as without adaptive budget
+    species_abundance, markers_abundance = estimate_abundance(classifier, markers_info, args)
+    converged = stable_batches >= args.adaptive_batches
+    reads_consumed = trace[-1]["reads_consumed"] if trace else 0
+    tsprint(f"  MIDAS2::map_reads_adaptive::{'converged' if converged else 'ran out of reads'} after {len(trace)} batches and {reads_consumed} reads")
+    return species_abundance, markers_abundance, {"converged": converged, "reads_consumed": reads_consumed, "batches": trace}
 
 
 def deconstruct_queryid(rid):
@@ -167,68 +472,248 @@ def construct_queryid(qid, qlen):
     return f"{qid}_{qlen}"
 
 
-def query_coverage(aln):
-    """ Compute alignment coverage of query """
-    _, qlen = deconstruct_queryid(aln['query'])
-    return aln['aln'] / qlen
+def read_markers_info(fasta_file, map_file):
+    """ Marker genes metadata of the fasta and map files, kept as the memory mapped precompiled arrays """
+    return MarkersInfo(load_markers_info(fasta_file, map_file))
+
+
+def parse_m8_block(data):
+    """ Load a block of hs-blastn alignments into typed columns """
+    if not data:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in BLAST_M8_SCHEMA.items()})
+    return pd.read_csv(io.BytesIO(data), sep="\t", header=None, names=list(BLAST_M8_SCHEMA.keys()), dtype=BLAST_M8_SCHEMA, engine="c")
 
 
-def read_markers_info(fasta_file, map_file, genes_that_are_marker_fp):
-    """ Extract gene_id_is_marker - marker_id mapping from fasta and map files """
-    # Read the gene_is_marker_id from phyeco.fa file
-    genes_that_are_marker = []
-    with InputStream(fasta_file) as file:
-        for rec in Bio.SeqIO.parse(file, 'fasta'):
-            genes_that_are_marker.append(rec.id)
+def select_best_hits(alns, target_cutoffs, args):
+    """ Find top scoring alignments for each read.  Returns the best alignments, in input order,
+    with the number of tied best alignments of their read in the hits column. """
 
-    with OutputStream(genes_that_are_marker_fp) as stream:
-        stream.write("\n".join(genes_that_are_marker) + "\n")
+    # Default specific marker genes sequence identity cutoff
+    if args.aln_mapid is not None:
+        cutoff = args.aln_mapid
+    else:
+        cutoff = target_cutoffs[alns['row'].to_numpy()]
+        assert not np.isnan(cutoff).any(), f"No mapping cutoff for the marker of genes {sorted(set(alns['target'][np.isnan(cutoff)]))[:5]}"
 
-    # Extract the mapping of <marker_id, genome_id, species_id> from the phyeco.map file
-    markers_info = defaultdict(dict)
-    markers_length = defaultdict(lambda: defaultdict(int))
+    # Query ids carry the read length, see construct_queryid
+    qlen = alns['query'].str.rsplit('_', n=1).str[1].astype(int)
+    alns = alns[(alns['pid'] >= cutoff) & (alns['aln'] / qlen >= args.aln_cov)] # filter local alignments
+
+    # For each read (query), keep the best hits based on the reported score
+    best_score = alns.groupby('query', sort=False)['score'].transform('max')
+    best_hits = alns[alns['score'] == best_score].copy()
+    best_hits['hits'] = best_hits.groupby('query', sort=False)['query'].transform('size')
+    return best_hits
+
+
+class ReadClassifier:
+    """
+    Best hits of every read, from a stream of alignments grouped by read as emitted by hs-blastn.
 
-    filter_cmd = f"grep -Fwf {genes_that_are_marker_fp}"
-    with InputStream(map_file, filter_cmd) as stream:
-        for r in select_from_tsv(stream, schema=MARKER_INFO_SCHEMA, result_structure=dict):
-            markers_info[r["gene_id"]] = r
-            #markers_length[r['species_id']][r['marker_id']] += int(r["gene_length"])
-            if r["marker_id"] in markers_length[r['species_id']]:
-                markers_length[r['species_id']][r['marker_id']]["marker_length"] += int(r["gene_length"])
-                markers_length[r['species_id']][r['marker_id']]["gene_id"].append(r["gene_id"])
+    The alignments of the last read of each block are held back until the next block, so that
+    every read is resolved once all its alignments are in.  Uniquely mapped reads update the
+    <species, marker> counters right away, ambiguously mapped reads keep their tied best hits
+    for assign_non_unique.
+    """
+
+    def __init__(self, markers_info, marker_cutoffs, args):
+        self.args = args
+        self.markers_info = markers_info
+        self.target_cutoffs = None
+        if args.aln_mapid is None:
+            # Cutoff of each marker gene, by row.  As before, only alignments to a marker without cutoff are an error.
+            marker_ids, marker_of_row = np.unique(markers_info.marker_id, return_inverse=True)
+            self.target_cutoffs = np.array([marker_cutoffs.get(marker_id, np.nan) for marker_id in np.char.decode(marker_ids).tolist()], dtype=np.float64)[marker_of_row]
+
+        self.unique_alns = defaultdict(lambda: defaultdict(dict))
+        self.ambiguous_reads = []
+        self.alignments_count = 0
+        self.unique_count = 0
+        self.pending = b""
+
+
+    def add_block(self, data, final=False):
+        """ Classify the reads of a block of complete m8 lines """
+        data = self.pending + data
+        self.pending = b""
+        if not final and data:
+            # Hold back the lines of the last read, it may continue in the next block
+            last_start = data.rfind(b"\n", 0, len(data) - 1) + 1
+            prefix = data[last_start:data.index(b"\t", last_start) + 1]
+            cut = last_start
+            while cut > 0:
+                prev_start = data.rfind(b"\n", 0, cut - 1) + 1
+                if not data.startswith(prefix, prev_start):
+                    break
+                cut = prev_start
+            self.pending = data[cut:]
+            data = data[:cut]
+        if data:
+            self.classify(parse_m8_block(data))
+
+
+    def classify(self, alns):
+        self.alignments_count += len(alns)
+        targets, target_ids = pd.factorize(alns['target'])
+        target_rows = self.markers_info.rows(target_ids)
+        assert np.all(target_rows >= 0), "Alignments to unknown marker genes"
+        alns = alns.assign(row=target_rows[targets])
+        best_hits = select_best_hits(alns, self.target_cutoffs, self.args)
+
+        unique_hits = best_hits[best_hits['hits'] == 1]
+        unique_rows = unique_hits['row'].to_numpy()
+        species_ids = np.char.decode(self.markers_info.species_id[unique_rows])
+        marker_ids = np.char.decode(self.markers_info.marker_id[unique_rows])
+        per_marker = unique_hits['aln'].groupby([species_ids, marker_ids], sort=False).agg(['sum', 'size'])
+        for (spid, mkid), aln_bps, readcounts in zip(per_marker.index, per_marker['sum'].tolist(), per_marker['size'].tolist()):
+            acc = self.unique_alns[spid].get(mkid)
+            if acc:
+                acc["alns"] += aln_bps
+                acc["readcounts"] += readcounts
             else:
-                markers_length[r['species_id']][r['marker_id']] = {"marker_length": r["gene_length"], "gene_id": [r["gene_id"]]}
+                self.unique_alns[spid][mkid] = {"alns": aln_bps, "readcounts": readcounts}
+        self.unique_count += len(unique_hits)
+
+        self.ambiguous_reads.extend(iter_ambiguous_reads(best_hits))
+
+
+def classify_m8_stream(stream, classifier, m8_copy=None):
+    """ Feed the classifier with blocks of complete lines from a binary m8 stream """
+    carry = b""
+    while True:
+        block = stream.read(M8_BLOCK_SIZE)
+        if m8_copy and block:
+            m8_copy.write(block)
+        if not block:
+            classifier.add_block(carry, final=True)
+            break
+        data = carry + block
+        end = data.rfind(b"\n") + 1
+        carry = data[end:]
+        classifier.add_block(data[:end])
+    tsprint(f"  total alignments: {classifier.alignments_count}")
+
+
+def classify_m8_file(m8_file, classifier):
+    with InputStream(m8_file, binary=True) as m8_stream:
+        classify_m8_stream(m8_stream, classifier)
+
+
+def iter_tagged_blocks(data):
+    """ Split a block of complete m8 lines, whose query ids are prefixed with {index}:, into its runs of lines of the same index """
+    while data:
+        tag = data[:data.index(b":") + 1]
+        # Last line of this index in the block
+        last_start = data.rfind(b"\n" + tag) + 1
+        end = data.find(b"\n", last_start) + 1 or len(data)
+        yield int(tag[:-1]), data[:end]
+        data = data[end:]
+
+
+class DemultiplexClassifier:
+    """
+    Route the alignments of the reads of several samples, whose query ids are prefixed with the
+    sample index as {sample_index}:{read_id}, to the ReadClassifier of each sample.
+
+    hs-blastn reports the reads in input order and the samples are fed one after the other,
+    so the alignments of each sample come out contiguous.
+    """
 
-        stream.ignore_errors()
-    return markers_info, markers_length
+    def __init__(self, classifiers):
+        self.classifiers = classifiers
+        self.current = 0
 
 
-def find_best_hits(m8_file, markers_info, marker_cutoffs, args):
-    """ Find top scoring alignment for each read """
-    best_hits = {}
-    i = 0
-    with InputStream(m8_file) as m8_stream:
-        for aln in select_from_tsv(m8_stream, schema=BLAST_M8_SCHEMA, result_structure=dict):
-            i += 1
+    @property
+    def alignments_count(self):
+        return sum(classifier.alignments_count for classifier in self.classifiers)
 
-            # Default specific marker genes sequence identity cutoff
-            cutoff = marker_cutoffs[markers_info[aln['target']]['marker_id']]
-            cutoff = args.aln_mapid if args.aln_mapid is not None else cutoff
-            if aln['pid'] < cutoff:
-                continue
-            if query_coverage(aln) < args.aln_cov: # filter local alignments
-                continue
 
-            # For each read (query), find the best hits based on the reported score
-            if aln['query'] not in best_hits: # record aln
-                best_hits[aln['query']] = [aln]
-            elif best_hits[aln['query']][0]['score'] == aln['score']: # add aln
-                best_hits[aln['query']] += [aln]
-            elif best_hits[aln['query']][0]['score'] < aln['score']: # update aln
-                best_hits[aln['query']] = [aln]
+    def add_block(self, data, final=False):
+        for sample_index, sample_data in iter_tagged_blocks(data):
+            if sample_index != self.current:
+                assert sample_index > self.current, f"Alignments of sample {sample_index} reported after sample {self.current}"
+                # The last read of the previous sample is complete
+                self.classifiers[self.current].add_block(b"", final=True)
+                self.current = sample_index
+            self.classifiers[sample_index].add_block(sample_data)
+        if final:
+            for classifier in self.classifiers:
+                classifier.add_block(b"", final=True)
 
-    tsprint(f"  total alignments: {i}")
-    return list(best_hits.values())
+
+class BatchesClassifier:
+    """
+    Route the alignments of the reads of successive batches, whose query ids are prefixed with the
+    batch index as {batch_index}:{read_id}, to one ReadClassifier, and call checkpoint(batch_index)
+    once all the alignments of a batch are in.
+
+    hs-blastn reports the reads in input order, so a batch is complete once a later batch shows up,
+    or at the end of the alignments for the last batches_reads fed.  Once checkpoint returns True,
+    the alignments of the later batches are dropped.
+    """
+
+    def __init__(self, classifier, checkpoint, batches_reads, m8_copy=None):
+        self.classifier = classifier
+        self.checkpoint = checkpoint
+        self.batches_reads = batches_reads
+        self.m8_copy = m8_copy
+        self.current = 0
+        self.converged = False
+
+
+    @property
+    def alignments_count(self):
+        return self.classifier.alignments_count
+
+
+    def complete_batches(self, next_batch):
+        """ Checkpoint the batches before next_batch """
+        self.classifier.add_block(b"", final=True)
+        while self.current < next_batch and not self.converged:
+            self.converged = self.checkpoint(self.current)
+            self.current += 1
+
+
+    def add_block(self, data, final=False):
+        for batch_index, batch_data in iter_tagged_blocks(data):
+            if batch_index != self.current:
+                assert batch_index > self.current, f"Alignments of batch {batch_index} reported after batch {self.current}"
+                self.complete_batches(batch_index)
+            if self.converged:
+                return
+            if self.m8_copy:
+                self.m8_copy.write(batch_data)
+            self.classifier.add_block(batch_data)
+        if final and not self.converged:
+            # Every batch was fed by now
+            self.complete_batches(len(self.batches_reads))
+
+
+def map_samples_hsblastn(list_of_samples, markers_db, classifiers, args):
+    """ Align the reads of all the samples with one hs-blastn process, tagging each read with its sample index """
+    def fasta_blocks():
+        for sample_index, sample_reads in enumerate(list_of_samples):
+            for filename in (sample_reads["r1"], sample_reads["r2"]):
+                for fasta, _ in iter_fasta_blocks(filename, args.max_reads, args.read_length, f"{sample_index}:".encode()):
+                    yield fasta
+
+    blast_command = hsblastn_command(args.word_size, markers_db, args.num_cores)
+    align_reads_hsblastn(blast_command, fasta_blocks(), DemultiplexClassifier(classifiers))
+
+
+def iter_ambiguous_reads(best_hits):
+    """ Yield the (targets, alns) of the best hits of each ambiguously mapped read, in input order """
+    ambiguous = best_hits[best_hits['hits'] > 1]
+    if ambiguous.empty:
+        return
+    codes, _ = pd.factorize(ambiguous['query'])
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    targets = ambiguous['target'].to_numpy()[order]
+    aln_bps = ambiguous['aln'].to_numpy()[order]
+    for read_targets, read_alns in zip(np.split(targets, boundaries), np.split(aln_bps, boundaries)):
+        yield read_targets.tolist(), read_alns.tolist()
 
 
 def filter_species_by_alns(alns, min_mreads=2, min_mcounts=2):
@@ -251,7 +736,7 @@ def filter_species_by_alns(alns, min_mreads=2, min_mcounts=2):
     return final_alns, final_covered_markers
 
 
-def assign_unique(alns, markers_info, args):
+def assign_unique(classifier, args):
     """
     Assign uniquely mapped read to each marker gene
     final_unique_alns are indexed by <species_id, marker_id>:
@@ -259,84 +744,84 @@ def assign_unique(alns, markers_info, args):
         - readcounts: totall mapped reads
     """
 
-    unique_alns = defaultdict(lambda: defaultdict(dict))
-    unique_counts = defaultdict(int)
-    non_unique_counts = 0
-    unique_reads = defaultdict(lambda: defaultdict(list))
-    for aln in alns:
-        if len(aln) == 1:
-            gid = aln[0]['target']
-            spid = markers_info[gid]['species_id']
-            mkid = markers_info[gid]['marker_id']
-
-            unique_reads[spid][mkid].append("@"+aln[0]['query'])
-
-            if mkid in unique_alns[spid]:
-                unique_alns[spid][mkid]["alns"] += aln[0]['aln']
-                unique_alns[spid][mkid]["readcounts"] += 1
-            else:
-                unique_alns[spid][mkid] = {"alns": aln[0]['aln'], "readcounts": 1}
-
-            unique_counts[spid] += 1
-        else:
-            non_unique_counts += 1
-
     # At least two markers covered by at least 2 reads each
-    final_unique_alns, final_covered_markers = filter_species_by_alns(unique_alns, args.marker_reads, args.marker_covered)
+    final_unique_alns, final_covered_markers = filter_species_by_alns(classifier.unique_alns, args.marker_reads, args.marker_covered)
 
-    tsprint(f" uniquely mapped reads: {sum(unique_counts.values())}")
-    tsprint(f" ambiguously mapped reads: {non_unique_counts}")
+    tsprint(f" uniquely mapped reads: {classifier.unique_count}")
+    tsprint(f" ambiguously mapped reads: {len(classifier.ambiguous_reads)}")
 
     return final_unique_alns, final_covered_markers
 
 
-def assign_non_unique(alns, unique_alns, markers_info, args):
-    """ Probabilistically assign ambiguously mapped reads to markers """
-
+def assign_ambiguous_reads(ambiguous_reads, unique_alns, markers_info, draws):
+    """ Assign each ambiguously mapped read to one of its candidate genes, proportionally to the uniquely mapped reads
+    of the candidate markers, from its draw.  Reads sharing the same candidate genes are assigned together.
+    Returns the aligned bps and reads assigned to each <species, marker>, and the number of groups of candidate genes. """
+
+    # Group reads by their set of candidate genes, whatever the order hs-blastn reported them in.
+    # Special case: when the same gene was mapped twice to different regions, we only record once.
+    reads_by_candidates = defaultdict(list)
+    list_of_aln_bps = []
+    for read_index, (read_targets, read_alns) in enumerate(ambiguous_reads):
+        candidates = dict(zip(read_targets, read_alns))
+        sorted_candidates = tuple(sorted(candidates))
+        reads_by_candidates[sorted_candidates].append(read_index)
+        list_of_aln_bps.append([candidates[gid] for gid in sorted_candidates])
+
+    reads_count = len(ambiguous_reads)
+    assigned_genes = np.empty(reads_count, dtype=object)
+    assigned_bps = np.zeros(reads_count, dtype=np.int64)
+
+    for candidates, read_indices in reads_by_candidates.items():
+        uniq_counts = np.zeros(len(candidates))
+        candidate_rows = markers_info.rows(candidates)
+        for ci, (spid, mkid) in enumerate(zip(markers_info.species_ids(candidate_rows), markers_info.marker_ids(candidate_rows))):
+            if spid in unique_alns and mkid in unique_alns[spid]:
+                uniq_counts[ci] = unique_alns[spid][mkid]["readcounts"]
+        if uniq_counts.sum() == 0:
+            uniq_counts[:] = 1 # uniformly at random
+        cumulative_probs = np.cumsum(uniq_counts / uniq_counts.sum())
+
+        read_indices = np.array(read_indices)
+        picks = np.minimum(np.searchsorted(cumulative_probs, draws[read_indices], side="right"), len(candidates) - 1)
+        assigned_genes[read_indices] = np.array(candidates, dtype=object)[picks]
+        assigned_bps[read_indices] = [list_of_aln_bps[ri][pi] for ri, pi in zip(read_indices.tolist(), picks.tolist())]
+
+    # Probabilistically assigned genes, accumulated per <species, marker>
     ambiguous_alns = defaultdict(lambda: defaultdict(dict))
-
-    for loaln in alns:
-        if len(loaln) > 1:
-            # Special case: when the same gene was mapped twice to different regions, we only record once.
-            target_dict = defaultdict(dict) # indexed by query gene
-            for aln_item in loaln:
-                gid = aln_item["target"]
-                spid = markers_info[gid]["species_id"]
-                mkid = markers_info[gid]["marker_id"]
-
-                uniq_count = unique_alns[spid][mkid]["readcounts"] if spid in unique_alns and mkid in unique_alns[spid] else 0
-                target_dict[gid] = {"species_id": spid, "marker_id": mkid, "alns": aln_item['aln'], "uniq_count": uniq_count}
-
-            lo_uniq_counts = [_['uniq_count'] for _ in target_dict.values()]
-            if sum(lo_uniq_counts) == 0:
-                gene_id = random.sample(list(target_dict.keys()), 1)[0]
-            else:
-                probs = [float(count)/sum(lo_uniq_counts) for count in lo_uniq_counts]
-                gene_id = np.random.choice(list(target_dict.keys()), 1, p=probs)[0]
-
-            # Probabilistically assigned: gene_id
-            mkid = target_dict[gene_id]['marker_id']
-            spid = target_dict[gene_id]['species_id']
-            aln_bps = target_dict[gene_id]['alns']
-            if mkid in ambiguous_alns[spid]:
-                ambiguous_alns[spid][mkid]["alns"] += aln_bps
-                ambiguous_alns[spid][mkid]["readcounts"] += 1
-            else:
-                ambiguous_alns[spid][mkid] = {"alns": aln_bps, "readcounts": 1}
+    if reads_count:
+        assigned_rows = markers_info.rows(assigned_genes)
+        assigned = pd.DataFrame({
+            "species_id": markers_info.species_ids(assigned_rows),
+            "marker_id": markers_info.marker_ids(assigned_rows),
+            "alns": assigned_bps,
+        })
+        per_marker = assigned.groupby(["species_id", "marker_id"], sort=False)["alns"].agg(["sum", "size"])
+        for (spid, mkid), aln_bps, readcounts in zip(per_marker.index, per_marker["sum"].tolist(), per_marker["size"].tolist()):
+            ambiguous_alns[spid][mkid] = {"alns": aln_bps, "readcounts": readcounts}
+    return ambiguous_alns, len(reads_by_candidates)
+
+
+def assign_non_unique(ambiguous_reads, unique_alns, markers_info, args):
+    """ Probabilistically assign ambiguously mapped reads to markers, proportionally to the uniquely mapped reads
+    of the candidate markers, from one seeded draw per read. """
+    draws = np.random.default_rng(args.seed).random(len(ambiguous_reads))
+    ambiguous_alns, groups_count = assign_ambiguous_reads(ambiguous_reads, unique_alns, markers_info, draws)
+    tsprint(f"  assigned {len(ambiguous_reads)} ambiguously mapped reads in {groups_count} groups of candidate genes with seed {args.seed}")
 
     final_ambiguous_alns, final_covered_markers = filter_species_by_alns(ambiguous_alns, args.marker_reads, args.marker_covered)
 
     return final_ambiguous_alns, final_covered_markers
 
 
-def merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_covered_markers, markers_length):
+def merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_covered_markers, markers_info):
     """ Merge unique and ambiguous alns into full species by marker matrix """
 
     list_of_all_species = set(list(unique_alns.keys()) + list(ambiguous_alns.keys()))
 
     species_alns = defaultdict(lambda: defaultdict(dict))
     for spid in list_of_all_species:
-        list_of_marker_ids = markers_length[spid].keys()
+        list_of_marker_ids = markers_info.species_markers(spid).keys()
         for mkid in list_of_marker_ids:
             uniq_count = unique_alns[spid][mkid]['readcounts'] if spid in unique_alns and mkid in unique_alns[spid] else 0
             amb_count = ambiguous_alns[spid][mkid]['readcounts'] if spid in ambiguous_alns and mkid in ambiguous_alns[spid] else 0
@@ -364,7 +849,7 @@ def merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_
     return species_alns, species_covered_markers
 
 
-def normalize_counts(species_alns, species_covered_markers, markers_length):
+def normalize_counts(species_alns, species_covered_markers, markers_info):
     """ Normalize counts by gene length and sum contrain """
 
     sp_abun = defaultdict(lambda: defaultdict(int)) # indexed by <species_id>
@@ -372,10 +857,10 @@ def normalize_counts(species_alns, species_covered_markers, markers_length):
 
     for spid, sp_mkdict in species_alns.items():
         lomc = []
+        markers_length = markers_info.species_markers(spid)
         for mkid, mkdict in sp_mkdict.items():
             # For each marker gene, compute coverage
-            #mklength = markers_length[spid][mkid]
-            mklength = markers_length[spid][mkid]["marker_length"]
+            mklength = markers_length[mkid]["marker_length"]
             aln_bps = mkdict["unique_bps"] + mkdict["ambiguous_bps"]
             readcounts = mkdict["unique"] + mkdict["ambiguous"]
 
@@ -388,7 +873,7 @@ def normalize_counts(species_alns, species_covered_markers, markers_length):
             sp_abun[spid]["total_marker_length"] += mklength
 
             # Record information for <species_id, marker_id>
-            markers_abun[spid][mkid]["gene_id"] = ",".join(markers_length[spid][mkid]["gene_id"])
+            markers_abun[spid][mkid]["gene_id"] = ",".join(markers_length[mkid]["gene_id"])
             markers_abun[spid][mkid]["length"] = mklength
             markers_abun[spid][mkid]["coverage"] = mkcov
             markers_abun[spid][mkid]["total_reads"] = mkdict["unique"] + mkdict["ambiguous"]
@@ -418,6 +903,63 @@ def normalize_counts(species_alns, species_covered_markers, markers_length):
     return sp_abun, markers_abun
 
 
+def estimate_abundance(classifier, markers_info, args):
+    """ Species and markers abundance from the reads classified so far """
+    tsprint("MIDAS2::assign_unique::start")
+    unique_alns, unique_covered_markers = assign_unique(classifier, args)
+    tsprint("MIDAS2::assign_unique::finish")
+
+    tsprint("MIDAS2::assign_non_unique::start")
+    ambiguous_alns, ambiguous_covered_markers = assign_non_unique(classifier.ambiguous_reads, unique_alns, markers_info, args)
+    tsprint("MIDAS2::assign_non_unique::finish")
+
+    # Estimate species abundance
+    tsprint("MIDAS2::normalize_counts::start")
+    species_alns, species_covered_markers = merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_covered_markers, markers_info)
+    species_abundance, markers_abundance = normalize_counts(species_alns, species_covered_markers, markers_info)
+    tsprint("MIDAS2::normalize_counts::finish")
+    return species_abundance, markers_abundance
+
+
+class IncrementalAbundance:
+    """
+    Species relative abundance of the reads classified so far, for the checkpoints of the adaptive read budget.
+
+    Each ambiguously mapped read is only assigned once, with the uniquely mapped reads of its checkpoint and the same
+    seeded draw as in assign_non_unique, so that every update only costs the reads classified since the previous one.
+    """
+
+    def __init__(self, classifier, markers_info, args):
+        self.classifier = classifier
+        self.markers_info = markers_info
+        self.args = args
+        self.rng = np.random.default_rng(args.seed)
+        self.ambiguous_alns = defaultdict(lambda: defaultdict(dict))
+        self.assigned_count = 0
+
+
+    def update(self):
+        args = self.args
+        unique_alns, unique_covered_markers = filter_species_by_alns(self.classifier.unique_alns, args.marker_reads, args.marker_covered)
+
+        new_reads = self.classifier.ambiguous_reads[self.assigned_count:]
+        new_alns, _ = assign_ambiguous_reads(new_reads, unique_alns, self.markers_info, self.rng.random(len(new_reads)))
+        for spid, sp_alns in new_alns.items():
+            for mkid, mkdict in sp_alns.items():
+                acc = self.ambiguous_alns[spid].get(mkid)
+                if acc:
+                    acc["alns"] += mkdict["alns"]
+                    acc["readcounts"] += mkdict["readcounts"]
+                else:
+                    self.ambiguous_alns[spid][mkid] = mkdict
+        self.assigned_count += len(new_reads)
+
+        ambiguous_alns, ambiguous_covered_markers = filter_species_by_alns(self.ambiguous_alns, args.marker_reads, args.marker_covered)
+        species_alns, species_covered_markers = merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_covered_markers, self.markers_info)
+        species_abundance, _ = normalize_counts(species_alns, species_covered_markers, self.markers_info)
+        return {spid: r["relative_abundance"] for spid, r in species_abundance.items()}
+
+
 def write_abundance(species_path, sp_abun):
     """ Write species results to specified output file """
     # Sort the species by median_coverage
@@ -446,6 +988,138 @@ def write_marker_abundance(markers_path, marker_abun, sp_abun):
 
 
 
+def screen_species_sketch(r1, r2, index, args):
+    """
+    Presence/absence screen of the species from the FracMinHash sketch of the reads, in the species profile format:
+        - unique_fraction_covered: containment, the fraction of the rep-genome sketch found in the reads
+        - coverage, median_coverage: mean and median abundance of the rep-genome sketch hashes in the reads (0 when absent),
+          scaled from k-mer to read coverage
+        - read_counts: estimated number of reads, from the sampled k-mers of the species
+    """
+    sketch = FracMinHash(args.sketch_kmer_size, args.sketch_scaled)
+    for filename in (r1, r2):
+        if filename:
+            sketch.add_file(filename, args.max_reads)
+    hashes, counts = sketch.finalize()
+    tsprint(f"  MIDAS2::screen_species_sketch::sketch {len(hashes)} hashes from {sketch.reads_count} reads and {sketch.bases_count} bases")
+
+    matches, abundance, matched_references, matched_counts = contain(index, hashes, counts)
+    sketch_sizes = index["sketch_sizes"]
+    containment = np.divide(matches, sketch_sizes, out=np.zeros(len(matches)), where=sketch_sizes > 0)
+    detected = np.flatnonzero((containment >= args.sketch_min_containment) & (matches >= MIN_SKETCH_MATCHES))
+
+    # A read of length L covers L-k+1 k-mers
+    mean_read_length = sketch.bases_count / sketch.reads_count if sketch.reads_count else 0
+    kmers_per_read = max(mean_read_length - args.sketch_kmer_size + 1, 1)
+    read_coverage_factor = mean_read_length / kmers_per_read
+
+    order = np.argsort(matched_references, kind="stable")
+    boundaries = np.searchsorted(matched_references[order], np.arange(len(sketch_sizes) + 1))
+    sp_abun = {}
+    for ri in detected.tolist():
+        # Median over the whole rep-genome sketch: the hashes missing from the reads count as zeros
+        species_counts = np.sort(matched_counts[order[boundaries[ri]:boundaries[ri+1]]])
+        missing = sketch_sizes[ri] - len(species_counts)
+        middle = [(sketch_sizes[ri] - 1) // 2, sketch_sizes[ri] // 2]
+        median_counts = np.mean([species_counts[i - missing] if i >= missing else 0 for i in middle])
+        sp_abun[str(index["reference_ids"][ri])] = {
+            "read_counts": int(round(abundance[ri] * args.sketch_scaled / kmers_per_read)),
+            "median_coverage": float(median_counts * read_coverage_factor),
+            "coverage": float(abundance[ri] / sketch_sizes[ri] * read_coverage_factor),
+            "unique_fraction_covered": float(containment[ri]),
+        }
+
+    sample_coverage = sum(r["coverage"] for r in sp_abun.values())
+    for r in sp_abun.values():
+        r["relative_abundance"] = r["coverage"] / sample_coverage if sample_coverage > 0 else 0.0
+    tsprint(f"  MIDAS2::screen_species_sketch::{len(sp_abun)} species with containment >= {args.sketch_min_containment}")
+    return sp_abun
+
+
+def write_convergence(convergence_path, convergence):
+    """ Write the convergence trace of the adaptive read budget, one row per batch """
+    with OutputStream(convergence_path) as outfile:
+        outfile.write('\t'.join(species_convergence_schema.keys()) + '\n')
+        for r in convergence["batches"]:
+            record = [r["batch"], r["reads_consumed"], r["species_count"], "NA" if r["l1_distance"] is None else r["l1_distance"]]
+            outfile.write("\t".join(map(format_data, record, repeat(DECIMALS6, len(record)))) + "\n")
+
+
+def fetch_marker_db(args):
+    """ Marker genes database, mapping cutoffs and marker metadata """
+    tsprint("MIDAS2::fetch_midasdb_files::start")
+    midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name)
+    midas_db.fetch_files("markerdb")
+    midas_db.fetch_files("markerdb_models")
+    marker_db_files = midas_db.fetch_files("marker_db")
+    tsprint("MIDAS2::fetch_midasdb_files::finish")
+
+    with InputStream(midas_db.get_target_layout("marker_db_hmm_cutoffs", False)) as cutoff_params:
+        marker_cutoffs = dict(select_from_tsv(cutoff_params, selected_columns={"marker_id": str, "marker_cutoff": float}))
+
+    tsprint("MIDAS2::read in marker information::start")
+    markers_info = read_markers_info(marker_db_files["fa"], marker_db_files["map"])
+    tsprint("MIDAS2::read in marker information::finish")
+    return marker_db_files, marker_cutoffs, markers_info
+
+
+def read_samples_manifest(manifest_path):
+    """ Samples of the batch mode, from a TSV with the sample_name, r1 and optionally r2 columns """
+    with InputStream(manifest_path) as stream:
+        header = next(stream)
+        selected_columns = ["sample_name", "r1"] + (["r2"] if "r2" in header.rstrip("\n").split("\t") else [])
+        list_of_samples = list(select_from_tsv(chain([header], stream), selected_columns=selected_columns, result_structure=dict))
+    for sample_reads in list_of_samples:
+        assert sample_reads["r1"], f"Sample {sample_reads['sample_name']} has no r1 in {manifest_path}"
+        sample_reads["r2"] = sample_reads.get("r2") or None
+    samples_names = [sample_reads["sample_name"] for sample_reads in list_of_samples]
+    assert samples_names, f"No samples in {manifest_path}"
+    assert len(set(samples_names)) == len(samples_names), f"Duplicated sample names in {manifest_path}"
+    return list_of_samples
+
+
+def run_species_batch(args):
+    """ Profile all the samples of the manifest from a single hs-blastn run, writing the same outputs as individual runs """
+    assert not args.adaptive_batch_reads, "The adaptive read budget is not available in batch mode"
+    assert args.screen == "markers", "The sketch screen is not available in batch mode"
+    list_of_samples = read_samples_manifest(args.samples_manifest)
+
+    samples = []
+    try:
+        for sample_reads in list_of_samples:
+            sample = Sample(sample_reads["sample_name"], args.midas_outdir, "species")
+            sample.create_dirs(["outdir", "tempdir"], args.debug)
+            samples.append(sample)
+            sample_args = dict(args_string(args), sample_name=sample_reads["sample_name"], r1=sample_reads["r1"], r2=sample_reads["r2"])
+            with OutputStream(sample.get_target_layout("species_log")) as stream:
+                stream.write(f"Batch abundant species profiling of {len(list_of_samples)} samples in subcommand {args.subcommand} with args\n{json.dumps(sample_args, indent=4)}\n")
+
+        marker_db_files, marker_cutoffs, markers_info = fetch_marker_db(args)
+
+        # Align the reads of every sample in one pass, and demultiplex the alignments as they come out
+        tsprint(f"MIDAS2::map_samples_hsblastn::start {len(samples)} samples")
+        classifiers = [ReadClassifier(markers_info, marker_cutoffs, args) for _ in samples]
+        map_samples_hsblastn(list_of_samples, marker_db_files["fa"], classifiers, args)
+        tsprint("MIDAS2::map_samples_hsblastn::finish")
+
+        for sample, classifier in zip(samples, classifiers):
+            tsprint(f"MIDAS2::estimate_abundance::{sample.sample_name} {classifier.alignments_count} alignments")
+            species_abundance, markers_abundance = estimate_abundance(classifier, markers_info, args)
+            write_abundance(sample.get_target_layout("species_summary"), species_abundance)
+            write_marker_abundance(sample.get_target_layout("markers_summary"), markers_abundance, species_abundance)
+
+        if not args.debug:
+            for sample in samples:
+                sample.remove_dirs(["tempdir"])
+
+    except Exception as error:
+        if not args.debug:
+            tsprint("Deleting untrustworthy outputs due to error. Specify --debug flag to keep.")
+            for sample in samples:
+                sample.remove_dirs(["outdir", "tempdir"])
+        raise error
+
+
 def run_species(args):
 
     try:
@@ -455,50 +1129,44 @@ def run_species(args):
         with OutputStream(sample.get_target_layout("species_log")) as stream:
             stream.write(f"Single sample abundant species profiling in subcommand {args.subcommand} with args\n{json.dumps(args_string(args), indent=4)}\n")
 
-        tsprint("MIDAS2::fetch_midasdb_files::start")
-        midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name)
-        midas_db.fetch_files("markerdb")
-        midas_db.fetch_files("markerdb_models")
-        marker_db_files = midas_db.fetch_files("marker_db")
-        tsprint("MIDAS2::fetch_midasdb_files::finish")
-
-        with InputStream(midas_db.get_target_layout("marker_db_hmm_cutoffs", False)) as cutoff_params:
-            marker_cutoffs = dict(select_from_tsv(cutoff_params, selected_columns={"marker_id": str, "marker_cutoff": float}))
-
-        # Align reads to marker-genes database
+        if args.screen == "sketch":
+            midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name)
+            index_fp = midas_db.get_target_layout("sketch_index", False, component=sketch_component(args.sketch_kmer_size, args.sketch_scaled))
+            assert os.path.exists(index_fp), f"Missing species sketches {index_fp}, please run build_sketches with the same --sketch_kmer_size and --sketch_scaled"
+            tsprint("MIDAS2::screen_species_sketch::start")
+            species_abundance = screen_species_sketch(args.r1, args.r2, load_sketch_index(index_fp, args.sketch_kmer_size, args.sketch_scaled), args)
+            tsprint("MIDAS2::screen_species_sketch::finish")
+            write_abundance(sample.get_target_layout("species_summary"), species_abundance)
+            if not args.debug:
+                sample.remove_dirs(["tempdir"])
+            return
+
+        marker_db_files, marker_cutoffs, markers_info = fetch_marker_db(args)
+
+        # Align reads to marker-genes database, and classify reads as their alignments come out
         tsprint("MIDAS2::map_reads_hsblastn::start")
+        classifier = ReadClassifier(markers_info, marker_cutoffs, args)
         m8_file = sample.get_target_layout("species_alignments_m8")
+        convergence = None
         if args.debug and os.path.exists(m8_file):
             tsprint(f"Use existing {m8_file} according to --debug flag.")
+            classify_m8_file(m8_file, classifier)
+        elif args.adaptive_batch_reads:
+            # Only keep the alignments for debugging
+            species_abundance, markers_abundance, convergence = map_reads_adaptive(m8_file if args.debug else None, marker_db_files["fa"], classifier, markers_info, args)
         else:
-            map_reads_hsblastn(m8_file, args.r1, args.r2, args.word_size, marker_db_files["fa"], args.max_reads, args.num_cores)
+            # Only keep the alignments for debugging
+            map_reads_hsblastn(m8_file if args.debug else None, args.r1, args.r2, args.word_size, marker_db_files["fa"], args.max_reads, args.num_cores, classifier, args.read_length)
         tsprint("MIDAS2::map_reads_hsblastn::finish")
 
-        tsprint("MIDAS2::read in marker information::start")
-        genes_that_are_marker_fp = sample.get_target_layout("species_marker_genes")
-        markers_info, markers_length = read_markers_info(marker_db_files["fa"], marker_db_files["map"], genes_that_are_marker_fp)
-        tsprint("MIDAS2::read in marker information::finish")
-
-        # Classify reads
-        tsprint("MIDAS2::find_best_hits::start")
-        best_hits = find_best_hits(m8_file, markers_info, marker_cutoffs, args)
-        tsprint("MIDAS2::find_best_hits::finish")
-
-        tsprint("MIDAS2::assign_unique::start")
-        unique_alns, unique_covered_markers = assign_unique(best_hits, markers_info, args)
-        tsprint("MIDAS2::assign_unique::finish")
-
-        tsprint("MIDAS2::assign_non_unique::start")
-        ambiguous_alns, ambiguous_covered_markers = assign_non_unique(best_hits, unique_alns, markers_info, args)
-        tsprint("MIDAS2::assign_non_unique::finish")
-
-        # Estimate species abundance
-        tsprint("MIDAS2::normalize_counts::start")
-        species_alns, species_covered_markers = merge_counts(unique_alns, ambiguous_alns, unique_covered_markers, ambiguous_covered_markers, markers_length)
-        species_abundance, markers_abundance = normalize_counts(species_alns, species_covered_markers, markers_length)
-        tsprint("MIDAS2::normalize_counts::finish")
+        if convergence is None:
+            species_abundance, markers_abundance = estimate_abundance(classifier, markers_info, args)
         write_abundance(sample.get_target_layout("species_summary"), species_abundance)
         write_marker_abundance(sample.get_target_layout("markers_summary"), markers_abundance, species_abundance)
+        if convergence is not None:
+            write_convergence(sample.get_target_layout("species_convergence"), convergence)
+            with open(sample.get_target_layout("species_log"), "a") as stream:
+                stream.write(f"Adaptive read budget {'converged' if convergence['converged'] else 'ran out of reads'} after {len(convergence['batches'])} batches and {convergence['reads_consumed']} reads\n{json.dumps(convergence['batches'], indent=4)}\n")
 
         if not args.debug:
             sample.remove_dirs(["tempdir"])
@@ -513,4 +1181,9 @@ def run_species(args):
 @register_args
 def main(args):
     tsprint(f"Single sample abundant species profiling in subcommand {args.subcommand} with args\n{json.dumps(vars(args), indent=4)}")
-    run_species(args)
+    if args.samples_manifest:
+        run_species_batch(args)
+    else:
+        assert args.sample_name and args.r1, "Please specify --sample_name and -1, or a --samples_manifest"
+        assert not (args.adaptive_batch_reads and args.screen == "sketch"), "The adaptive read budget only applies to the markers screen"
+        run_species(args)
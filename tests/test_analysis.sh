@@ -28,6 +28,19 @@ mkdir -p "${logs_dir}"
 samples_fp="${outdir}/samples.txt"
 pool_fp="${outdir}/samples_list.tsv"
 
+queue_midas_outdir="${outdir}/across_samples_work_queue"
+
+# Same files with the same decompressed content under DIR of both output directories, logs aside
+compare_outputs() {
+    diff <(cd $1 && find $3 -type f \( -name '*.tsv' -o -name '*.tsv.lz4' \) | sort) <(cd $2 && find $3 -type f \( -name '*.tsv' -o -name '*.tsv.lz4' \) | sort)
+    for fp in $(cd $1 && find $3 -type f -name '*.tsv.lz4'); do
+        cmp <(lz4 -dc $1/${fp}) <(lz4 -dc $2/${fp})
+    done
+    for fp in $(cd $1 && find $3 -type f -name '*.tsv'); do
+        cmp $1/${fp} $2/${fp}
+    done
+}
+
 rm -rf ${samples_fp}
 rm -rf ${pool_fp}
 
@@ -69,6 +82,15 @@ midas merge_snps --samples_list ${pool_fp} \
     &> ${logs_dir}/merge_snps_${num_cores}.log
 
 
+echo "Testing Across-Samples SNV Module With Local Work Queue Workers"
+midas merge_snps --samples_list ${pool_fp} \
+    --midasdb_name ${midas_dbname} --midasdb_dir ${midas_db} \
+    --num_cores ${num_cores} --chunk_size 100000 \
+    --genome_coverage 0.7 --work_queue ${outdir}/merge_snps_queue --local_workers 2 ${queue_midas_outdir} \
+    &> ${logs_dir}/merge_snps_${num_cores}_w_work_queue.log
+compare_outputs ${merge_midas_outdir} ${queue_midas_outdir} snps
+
+
 echo "Testing Build Pan-Genome Bowtie2 Databases"
 midas build_bowtie2db --midasdb_name ${midas_dbname} --midasdb_dir ${midas_db} \
     --species_profile  ${merge_midas_outdir}/species/species_prevalence.tsv \
@@ -86,6 +108,34 @@ head -n 2 ${samples_fp} | xargs -Ixx bash -c \
      ${midas_outdir} &> ${logs_dir}/xx_genes_${num_cores}_w_bowtie2.log"
 
 
+echo "Testing Single-Sample CNV Module With K-mer Quantifier"
+kmer_midas_outdir="${outdir}/single_sample_kmer"
+head -n 2 ${samples_fp} | xargs -Ixx bash -c \
+    "midas run_genes --sample_name xx -1 ${testdir}/reads/xx_R1.fastq.gz --num_cores ${num_cores} \
+     --midasdb_name ${midas_dbname} --midasdb_dir ${midas_db} --select_threshold=-1 \
+     --species_list ${merge_midas_outdir}/bt2_indexes/pangenomes.species \
+     --quantifier kmer ${kmer_midas_outdir} &> ${logs_dir}/xx_genes_${num_cores}_w_kmer.log"
+
+# Gene depths of the k-mer quantifier should follow the bowtie2 ones. On simulated reads, the per-species
+# correlation stayed above 0.93 with up to 3% divergent strains and centroids_99 paralogs 1-3% apart;
+# the k-mer depths run lower as the strains diverge, hence the depth ratio in the output.
+head -n 2 ${samples_fp} | xargs -Ixx python -c "
+import glob, os, numpy as np, pandas as pd
+from midas.common.utils import InputStream
+for fp in glob.glob('${kmer_midas_outdir}/xx/genes/*.genes.tsv.lz4'):
+    bt2_fp = '${midas_outdir}/xx/genes/' + os.path.basename(fp)
+    if not os.path.exists(bt2_fp):
+        continue
+    with InputStream(fp) as kmer_stream, InputStream(bt2_fp) as bt2_stream:
+        depths = pd.merge(pd.read_csv(kmer_stream, sep='\t'), pd.read_csv(bt2_stream, sep='\t'), on='cluster_99_id', how='outer', suffixes=('_kmer', '_bt2')).fillna(0)
+    corr = np.corrcoef(depths['mean_depth_kmer'], depths['mean_depth_bt2'])[0, 1] if len(depths) > 1 else 1.0
+    shared = depths[(depths['mean_depth_kmer'] > 0) & (depths['mean_depth_bt2'] > 0)]
+    ratio = (shared['mean_depth_kmer'] / shared['mean_depth_bt2']).median() if len(shared) else float('nan')
+    print(os.path.basename(fp), len(depths), 'genes, mean_depth correlation', round(corr, 4), 'median k-mer/bowtie2 depth ratio', round(ratio, 3))
+    assert corr > 0.9, fp
+"
+
+
 echo "Testing Across-Samples CNV Module"
 midas merge_genes --samples_list ${pool_fp} --midasdb_name ${midas_dbname} --midasdb_dir ${midas_db} \
      --num_cores ${num_cores} --sample_counts 2 ${merge_midas_outdir} \
@@ -93,4 +143,12 @@ midas merge_genes --samples_list ${pool_fp} --midasdb_name ${midas_dbname} --mid
      &> ${logs_dir}/merge_genes_${num_cores}.log
 
 
+echo "Testing Across-Samples CNV Module With Local Work Queue Workers"
+midas merge_genes --samples_list ${pool_fp} --midasdb_name ${midas_dbname} --midasdb_dir ${midas_db} \
+     --num_cores ${num_cores} --sample_counts 2 --work_queue ${outdir}/merge_genes_queue --local_workers 2 ${queue_midas_outdir} \
+     --cluster_level_in 99 --genome_depth 0.4 \
+     &> ${logs_dir}/merge_genes_${num_cores}_w_work_queue.log
+compare_outputs ${merge_midas_outdir} ${queue_midas_outdir} genes
+
+
 echo "MIDASv3 Unit Testing SUCCESS"